@@ -0,0 +1,120 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import asyncio
+from concurrent.futures import Executor
+import contextvars
+import functools
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, TypeVar
+
+from . import guest
+from . import metrics
+from .cache import CheckpointCache, DigestCache
+from .sev_hashes import SevHashes
+from .sev_mode import SevMode
+from .vmm_types import VMMType
+from .vmsa import VMSA, VMSA_SVSM
+
+T = TypeVar('T')
+
+
+async def _stage(executor: Optional[Executor], func: Callable[..., T], *args: Any) -> T:
+    """
+    Run a stage of a measurement in executor, in the context of the awaiting
+    task (so its timings are recorded).  If the awaiting task is cancelled,
+    the stage runs to completion in the background but the measurement stops
+    there.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, func, *args))
+
+
+async def calc_launch_digest_async(mode: SevMode, vcpus: int, vcpu_sig: int, ovmf_file: str,
+                                   kernel: str, initrd: str, append: str, guest_features: int,
+                                   snp_ovmf_hash_str: str = '', vmm_type: VMMType = VMMType.QEMU,
+                                   svsm_file: str = '', ovmf_vars_size: int = 0, workers: int = 1,
+                                   digest_cache: Optional[DigestCache] = None,
+                                   checkpoint_cache: Optional[CheckpointCache] = None,
+                                   executor: Optional[Executor] = None,
+                                   limit: Optional[asyncio.Semaphore] = None,
+                                   timings: Optional[metrics.Timings] = None) -> bytes:
+    """
+    Same as guest.calc_launch_digest, without blocking the event loop: every
+    stage of the measurement (firmware, kernel hashes, metadata sections,
+    VMSA pages) runs in executor (the default executor of the loop if None),
+    and cancelling the calling task stops the measurement before the next
+    stage.  At most as many measurements as limit allows run at a time.  If
+    timings is given, the time spent in each stage is recorded into it.
+
+    File reads and hashing release the GIL, so a thread pool executor lets
+    concurrent measurements use several cores.
+    """
+    # SEV ignores vcpus, as guest.calc_launch_digest does
+    if mode != SevMode.SEV and vcpus < 1:
+        raise ValueError("vcpus must be at least 1")
+    if snp_ovmf_hash_str and mode != SevMode.SEV_SNP:
+        raise ValueError("SNP OVMF hash only works with SNP")
+    if mode == SevMode.SEV_SNP_SVSM and vmm_type != VMMType.QEMU:
+        raise AssertionError("SVSM mode is only implemented for Qemu.")
+    with metrics.record_timings(timings):
+        if limit is None:
+            return await _calc(mode, vcpus, vcpu_sig, ovmf_file, kernel, initrd, append, guest_features,
+                               snp_ovmf_hash_str, vmm_type, svsm_file, ovmf_vars_size, workers, digest_cache,
+                               checkpoint_cache, executor)
+        async with limit:
+            return await _calc(mode, vcpus, vcpu_sig, ovmf_file, kernel, initrd, append, guest_features,
+                               snp_ovmf_hash_str, vmm_type, svsm_file, ovmf_vars_size, workers, digest_cache,
+                               checkpoint_cache, executor)
+
+
+async def _calc(mode: SevMode, vcpus: int, vcpu_sig: int, ovmf_file: str, kernel: str, initrd: str, append: str,
+                guest_features: int, snp_ovmf_hash_str: str, vmm_type: VMMType, svsm_file: str,
+                ovmf_vars_size: int, workers: int, digest_cache: Optional[DigestCache],
+                checkpoint_cache: Optional[CheckpointCache], executor: Optional[Executor]) -> bytes:
+    if mode == SevMode.SEV_SNP:
+        if snp_ovmf_hash_str:
+            checkpoint_cache = None
+        gctx, ovmf, firmware_key = await _stage(executor, guest.snp_firmware_prefix, ovmf_file, snp_ovmf_hash_str,
+                                                workers, checkpoint_cache)
+        sev_hashes = None
+        if kernel:
+            sev_hashes = await _stage(executor, functools.partial(SevHashes, digest_cache=digest_cache), kernel,
+                                      initrd, append)
+        gctx = await _stage(executor, guest.snp_metadata_gctx, gctx, ovmf, sev_hashes, vmm_type, checkpoint_cache,
+                            firmware_key)
+        vmsa = VMSA(SevMode.SEV_SNP, ovmf.sev_es_reset_eip(), vcpu_sig, guest_features, vmm_type)
+        lds = await _stage(executor, guest.snp_vmsa_launch_digests, gctx, vmsa, [vcpus])
+    elif mode == SevMode.SEV_ES:
+        launch_hash, eip = await _stage(executor, guest.seves_pre_vmsa_hash, ovmf_file, kernel, initrd, append,
+                                        digest_cache)
+        vmsa = VMSA(SevMode.SEV_ES, eip, vcpu_sig, 0x0, vmm_type)
+        lds = await _stage(executor, guest.seves_vmsa_launch_digests, launch_hash, vmsa, [vcpus])
+    elif mode == SevMode.SEV:
+        return await _stage(executor, guest.sev_calc_launch_digest, ovmf_file, kernel, initrd, append, digest_cache)
+    elif mode == SevMode.SEV_SNP_SVSM:
+        gctx, eip = await _stage(executor, guest.svsm_pre_vmsa_gctx, ovmf_file, ovmf_vars_size, svsm_file, workers,
+                                 checkpoint_cache)
+        lds = await _stage(executor, guest.snp_vmsa_launch_digests, gctx, VMSA_SVSM(eip, vcpu_sig), [vcpus])
+    else:
+        raise ValueError("unknown mode")
+    return lds[vcpus]
+
+
+async def calc_launch_digest_batch_async(requests: Iterable[Dict[str, Any]], executor: Optional[Executor] = None,
+                                         max_concurrent: int = 0, return_exceptions: bool = False) -> List[Any]:
+    """
+    Calculate the launch digests of requests concurrently, each given as the
+    keyword arguments of calc_launch_digest_async, with at most
+    max_concurrent (the number of CPUs by default) measurements running at a
+    time.  Returns the launch digests in the order of requests; with
+    return_exceptions, the exception raised by a failed measurement takes its
+    place, as with asyncio.gather.
+    """
+    if max_concurrent < 0:
+        raise ValueError("max_concurrent must not be negative")
+    limit = asyncio.Semaphore(max_concurrent or os.cpu_count() or 1)
+    return await asyncio.gather(*(calc_launch_digest_async(**request, executor=executor, limit=limit)
+                                  for request in requests), return_exceptions=return_exceptions)
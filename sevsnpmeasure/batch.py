@@ -0,0 +1,362 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor
+import json
+import pathlib
+import queue
+import threading
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple, TypeVar
+
+from . import metrics
+from . import vcpu_types
+from .cache import CheckpointCache, DigestCache, file_identity
+from .concurrency import MeasurementLimiter
+from .guest import calc_snp_ovmf_hash
+from .sev_hashes import SevHashes
+from .sev_mode import SevMode
+from .sweep import FirmwareSweeper, LaunchConfig, Sweeper, make_firmware_sweeper, vmsa_key
+from .vmm_types import VMMType
+
+# Number of firmware measurement states, pre-VMSA measurement states (and OVMF
+# hashes) kept by each batch process
+SWEEPER_CACHE_SIZE = 16
+
+OVMF_HASH_MODE = 'snp:ovmf-hash'
+
+T = TypeVar('T')
+
+
+class MeasurementRequest(NamedTuple):
+    """
+    A single measurement, with the same parameters as the command line
+    (mode is OVMF_HASH_MODE to calculate the SNP OVMF hash).
+    """
+    mode: str
+    ovmf: str
+    vcpus: int = 1
+    vcpu_sig: int = 0
+    guest_features: int = 0x1
+    vmm_type: VMMType = VMMType.QEMU
+    kernel: str = ''
+    initrd: str = ''
+    append: str = ''
+    snp_ovmf_hash: str = ''
+    svsm: str = ''
+    vars_size: int = 0
+
+
+def _int(value: Any) -> int:
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+
+def _vcpu_sig(obj: Dict[str, Any]) -> int:
+    if obj.get('vcpu_family') is not None:
+        return vcpu_types.cpu_sig(_int(obj['vcpu_family']), _int(obj.get('vcpu_model', 0)),
+                                  _int(obj.get('vcpu_stepping', 0)))
+    elif obj.get('vcpu_sig') is not None:
+        return _int(obj['vcpu_sig'])
+    elif obj.get('vcpu_type'):
+        if obj['vcpu_type'] not in vcpu_types.CPU_SIGS:
+            raise ValueError(f"unknown vcpu type '{obj['vcpu_type']}'")
+        return vcpu_types.CPU_SIGS[obj['vcpu_type']]
+    return 0
+
+
+def parse_request(obj: Any) -> MeasurementRequest:
+    """
+    Parse a measurement request given as a JSON object whose keys are the
+    long command line options, with either dashes or underscores (such as
+    "vcpu-type" or "vcpu_type").
+    """
+    if not isinstance(obj, dict):
+        raise ValueError("measurement request must be a JSON object")
+    obj = {key.replace('-', '_'): value for key, value in obj.items()}
+    mode = obj.get('mode')
+    if mode != OVMF_HASH_MODE:
+        mode = SevMode.from_str(str(mode)).name
+    if not obj.get('ovmf'):
+        raise ValueError("missing ovmf")
+    if (obj.get('initrd') or obj.get('append')) and not obj.get('kernel'):
+        raise ValueError("kernel required when using initrd or append")
+    vmm_name = obj.get('vmm_type', 'QEMU')
+    if vmm_name not in VMMType.__members__:
+        raise ValueError(f"unknown VMM type '{vmm_name}'")
+    vars_size = _int(obj.get('vars_size') or 0)
+    if obj.get('vars_file'):
+        vars_size = pathlib.Path(obj['vars_file']).stat().st_size
+    # As on the command line, the number of vcpus and (with QEMU) the vcpu
+    # signature must be given in the modes which measure VMSAs
+    measures_vmsas = mode not in [SevMode.SEV.name, OVMF_HASH_MODE]
+    if obj.get('vcpus') is None and measures_vmsas:
+        raise ValueError(f"missing vcpus in guest mode '{obj['mode']}'")
+    vcpus = _int(obj['vcpus']) if obj.get('vcpus') is not None else 1
+    if vcpus < 1:
+        raise ValueError("vcpus must be at least 1")
+    if measures_vmsas and vmm_name == VMMType.QEMU.name and \
+            all(obj.get(key) is None for key in ['vcpu_family', 'vcpu_sig', 'vcpu_type']):
+        raise ValueError(f"missing vcpu_type or vcpu_sig or vcpu_family in guest mode '{obj['mode']}'")
+    return MeasurementRequest(mode, obj['ovmf'], vcpus, _vcpu_sig(obj), _int(obj.get('guest_features', 0x1)),
+                              VMMType[vmm_name], obj.get('kernel') or '', obj.get('initrd') or '',
+                              obj.get('append') or '', obj.get('snp_ovmf_hash') or '', obj.get('svsm') or '',
+                              vars_size)
+
+
+def measure_requests(requests: Iterable[Any], processes: int = 1, max_in_flight: int = 0,
+                     ordered: bool = True, cache_dir: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Calculate the measurements of requests (JSON objects as accepted by
+    parse_request), yielding a result object for each: its "index" in
+    requests, its "id" if the request had one, and either the "measurement"
+    in hex or an "error".
+
+    With processes > 1 the measurements run on a process pool, with at most
+    max_in_flight requests (2 * processes by default) read but not yielded
+    at any time.  Requests are read by a separate thread, so results are
+    yielded as soon as they are ready even while the next request hasn't
+    arrived; in the order of requests if ordered is True, or as they
+    complete otherwise.  Each process keeps the measurement state up to
+    the VMSA pages of recently used inputs; the firmware files are mapped
+    read-only, so processes share them through the page cache, and requests
+    only carry file names.
+    """
+    if processes < 1:
+        raise ValueError("processes must be at least 1")
+    if processes == 1:
+        init_state(cache_dir)
+        for index, obj in enumerate(requests):
+            yield measure_result(index, obj)
+        return
+    max_in_flight = max_in_flight or 2 * processes
+    # Events of the reader thread (a request, the end of the requests or the
+    # exception reading them raised) and of completed measurements
+    events: 'queue.Queue[Tuple[str, int, Any]]' = queue.Queue()
+    slots = threading.Semaphore(max_in_flight)
+    stop = threading.Event()
+    try:
+        with ProcessPoolExecutor(processes, initializer=init_state, initargs=(cache_dir,)) as executor:
+            # Start the processes before the reader thread: a process forked
+            # while it reads stdin would deadlock closing its copy of stdin
+            executor.submit(int).result()
+            threading.Thread(target=_read_requests, args=(requests, events, slots, stop), daemon=True).start()
+            pending: Deque[Tuple[int, Any, Future]] = collections.deque()
+            reading = True
+            while reading or pending:
+                kind, index, value = events.get()
+                if kind == 'request':
+                    future = executor.submit(_measure_object, value)
+                    pending.append((index, value, future))
+                    future.add_done_callback(lambda future: events.put(('done', 0, None)))
+                elif kind == 'end':
+                    reading = False
+                elif kind == 'error':
+                    raise value
+                for result in _ready(pending, ordered):
+                    slots.release()
+                    yield result
+    finally:
+        # Let the reader thread stop if it is waiting for a slot
+        stop.set()
+        slots.release()
+
+
+def _read_requests(requests: Iterable[Any], events: 'queue.Queue[Tuple[str, int, Any]]',
+                   slots: threading.Semaphore, stop: threading.Event) -> None:
+    """
+    Pass requests on to events, waiting for a slot before each one.
+    """
+    try:
+        for index, obj in enumerate(requests):
+            slots.acquire()
+            if stop.is_set():
+                return
+            events.put(('request', index, obj))
+        events.put(('end', 0, None))
+    except Exception as e:
+        events.put(('error', 0, e))
+
+
+def _ready(pending: Deque[Tuple[int, Any, Future]], ordered: bool) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the results of the pending requests which are done, without
+    waiting; in order, only those before the first one not done.
+    """
+    if ordered:
+        while pending and pending[0][2].done():
+            index, obj, future = pending.popleft()
+            yield _result(index, obj, future.result())
+        return
+    for item in [item for item in pending if item[2].done()]:
+        pending.remove(item)
+        yield _result(item[0], item[1], item[2].result())
+
+
+def _result(index: int, obj: Any, outcome: Tuple[str, str]) -> Dict[str, Any]:
+    result: Dict[str, Any] = {'index': index}
+    if isinstance(obj, dict) and 'id' in obj:
+        result['id'] = obj['id']
+    key, value = outcome
+    result[key] = value
+    return result
+
+
+def measure_result(index: int, obj: Any) -> Dict[str, Any]:
+    """
+    Calculate the measurement of the request obj with the measurement state
+    of this process, returning its result object.
+    """
+    return _state.measure_result(index, obj)
+
+
+def measure_request(request: MeasurementRequest) -> bytes:
+    """
+    Calculate the measurement of request with the measurement state of this
+    process.
+    """
+    return _state.measure_request(request)
+
+
+def request_key(request: MeasurementRequest) -> tuple:
+    """
+    Return a key identifying the measurement of request: its parameters and
+    the identity of its input files.
+    """
+    return request._replace(ovmf=_identity(request.ovmf), kernel=_identity(request.kernel),
+                            initrd=_identity(request.initrd), svsm=_identity(request.svsm))
+
+
+class MeasurementState(object):
+    """
+    Measurement state reused across requests: the measurements of recently
+    used firmwares, the states up to the VMSA pages of recently used inputs
+    (and their OVMF hashes), and the disk caches in cache_dir if not None.
+    States are keyed by the identity of the input files, so a file which
+    changed is measured again.
+
+    Measurements may run concurrently in several threads; the same state may
+    then be computed more than once, which is harmless.  With a limiter,
+    identical concurrent requests share one measurement, and the number of
+    measurements running and waiting is bounded by it.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, limiter: Optional[MeasurementLimiter] = None):
+        self.limiter = limiter
+        self._lock = threading.Lock()
+        self._firmwares: 'collections.OrderedDict[tuple, FirmwareSweeper]' = collections.OrderedDict()
+        self._sweepers: 'collections.OrderedDict[tuple, Sweeper]' = collections.OrderedDict()
+        self._ovmf_hashes: 'collections.OrderedDict[tuple, bytes]' = collections.OrderedDict()
+        self.digest_cache: Optional[DigestCache] = None
+        self.checkpoint_cache: Optional[CheckpointCache] = None
+        if cache_dir:
+            self.digest_cache = DigestCache(cache_dir)
+            self.checkpoint_cache = CheckpointCache(cache_dir, digest_cache=self.digest_cache)
+
+    def measure_result(self, index: int, obj: Any) -> Dict[str, Any]:
+        """
+        Calculate the measurement of the request obj, returning its result
+        object.
+        """
+        return _result(index, obj, self.measure_object(obj))
+
+    def measure_object(self, obj: Any) -> Tuple[str, str]:
+        """
+        Calculate the measurement of the request obj, returning either
+        ('measurement', hex) or ('error', message).
+        """
+        try:
+            return 'measurement', self.measure_request(parse_request(obj)).hex()
+        except (ValueError, RuntimeError, OSError, KeyError, TypeError, AssertionError) as e:
+            return 'error', str(e)
+
+    def measure_request(self, request: MeasurementRequest) -> bytes:
+        """
+        Calculate the measurement of request, through the limiter if any.
+        """
+        if self.limiter is not None:
+            return self.limiter.coalesce(request_key(request), lambda: self._measure(request))
+        return self._measure(request)
+
+    def _measure(self, request: MeasurementRequest) -> bytes:
+        """
+        Calculate the measurement of request, reusing the state up to the VMSA
+        pages of recent requests with the same inputs, and the measurement of
+        the firmware of recent requests with the same firmware but another
+        kernel, initrd or command line (as long as the input files keep their
+        identity).
+        """
+        if request.mode == OVMF_HASH_MODE:
+            return self._lru_get('ovmf_hash', self._ovmf_hashes, _identity(request.ovmf),
+                                 lambda: calc_snp_ovmf_hash(request.ovmf, checkpoint_cache=self.checkpoint_cache))
+        mode = SevMode[request.mode]
+        if mode == SevMode.SEV_SNP_SVSM and request.vmm_type != VMMType.QEMU:
+            raise AssertionError("SVSM mode is only implemented for Qemu.")
+        firmware_key = (mode, _identity(request.ovmf), request.snp_ovmf_hash, _identity(request.svsm),
+                        request.vars_size)
+        key = (firmware_key, _identity(request.kernel), _identity(request.initrd), request.append)
+
+        def make_sweeper() -> Sweeper:
+            firmware = self._lru_get('firmware', self._firmwares, firmware_key,
+                                     lambda: make_firmware_sweeper(mode, request.ovmf, request.snp_ovmf_hash,
+                                                                   request.svsm, request.vars_size,
+                                                                   checkpoint_cache=self.checkpoint_cache))
+            sev_hashes = None
+            if request.kernel:
+                sev_hashes = SevHashes(request.kernel, request.initrd, request.append, digest_cache=self.digest_cache)
+            return firmware(sev_hashes)
+
+        sweeper = self._lru_get('sweeper', self._sweepers, key, make_sweeper)
+        config = LaunchConfig(request.vcpus, request.vcpu_sig, request.guest_features, request.vmm_type)
+        return sweeper(vmsa_key(config), [request.vcpus])[request.vcpus]
+
+    def _lru_get(self, name: str, lru: 'collections.OrderedDict[Any, T]', key: Any, create: Callable[[], T]) -> T:
+        with self._lock:
+            value = lru.get(key)
+            if value is not None:
+                lru.move_to_end(key)
+        metrics.count_cache(name, value is not None)
+        if value is None:
+            value = create()
+            with self._lock:
+                lru[key] = value
+                if len(lru) > SWEEPER_CACHE_SIZE:
+                    lru.popitem(last=False)
+        return value
+
+
+# Measurement state of a process, set up by init_state
+_state = MeasurementState()
+
+
+def init_state(cache_dir: Optional[str]) -> None:
+    """
+    Reset the measurement state of this process, using the disk caches in
+    cache_dir if not None.
+    """
+    global _state
+    _state = MeasurementState(cache_dir)
+
+
+def _measure_object(obj: Any) -> Tuple[str, str]:
+    return _state.measure_object(obj)
+
+
+def _identity(filename: str) -> Any:
+    return (filename, file_identity(filename)) if filename else None
+
+
+def read_requests(lines: Iterable[str]) -> Iterator[Any]:
+    """
+    Parse JSONL measurement requests, skipping empty lines.  Lines which
+    aren't valid JSON are passed on as their text, and produce an error
+    result.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line.strip()
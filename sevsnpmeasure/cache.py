@@ -0,0 +1,259 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+from typing import NamedTuple, Optional, Union
+
+from . import metrics
+
+from .gctx import LD_SIZE
+from .sev_hashes import DEFAULT_CHUNK_SIZE, sha256_file
+
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+# Leftover temporary files older than this (in seconds) are removed on eviction
+STALE_TMP_AGE = 3600
+
+ENTRY_SUFFIX = '.json'
+TMP_PREFIX = '.tmp-'
+
+
+class FileIdentity(NamedTuple):
+    dev: int
+    ino: int
+    size: int
+    mtime_ns: int
+
+    def key(self) -> str:
+        return f"{self.dev}:{self.ino}:{self.size}:{self.mtime_ns}"
+
+
+def file_identity(filename: str) -> Optional[FileIdentity]:
+    """
+    Return the identity of a regular file, or None for anything else (such as
+    /dev/null or a pipe), whose contents can't be cached by identity.
+    """
+    st = os.stat(filename)
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return FileIdentity(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class DiskCache(object):
+    """
+    A directory of small JSON entries which may be shared by several
+    processes.  Entries are written atomically (to a temporary file which is
+    then renamed), and the least recently used entries are evicted when the
+    total size of the directory exceeds max_size bytes.
+
+    The total size is only scanned on the first write and on eviction, and
+    otherwise tracked by adding the size of each entry written; entries
+    written by other processes are accounted for at the next scan.
+    Malformed entries are treated as misses and removed.
+    """
+
+    # Name of the cache in metrics
+    METRICS_NAME = 'disk'
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Estimated total size of the entries, None until scanned
+        self._size: Optional[int] = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, key: str) -> str:
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + ENTRY_SUFFIX)
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except OSError:
+            self._count(False)
+            return None
+        except ValueError:
+            entry = None
+        if not isinstance(entry, dict) or entry.get('key') != key or not isinstance(entry.get('value'), dict) or \
+                not self._is_valid(entry['value']):
+            _unlink_quietly(path)
+            self._count(False)
+            return None
+        try:
+            # The modification time of an entry is its last use time
+            os.utime(path)
+        except OSError:
+            pass
+        self._count(True)
+        return entry['value']
+
+    def _is_valid(self, value: dict) -> bool:
+        """
+        Return whether value is a well-formed value of an entry of this cache.
+        """
+        return True
+
+    def _count(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.count_cache(self.METRICS_NAME, hit)
+
+    def put(self, key: str, value: dict) -> None:
+        if self._size is None:
+            self.evict()
+        path = self._entry_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'value': value}, f)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            try:
+                size -= os.stat(path).st_size
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._size = (self._size or 0) + size
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache is no larger
+        than max_size.  Entries may concurrently be removed by other
+        processes, which is harmless.
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        with os.scandir(self.cache_dir) as it:
+            for de in it:
+                try:
+                    st = de.stat()
+                except OSError:
+                    continue
+                if de.name.startswith(TMP_PREFIX):
+                    if now - st.st_mtime > STALE_TMP_AGE:
+                        _unlink_quietly(de.path)
+                    continue
+                if not de.name.endswith(ENTRY_SUFFIX):
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, de.path))
+                total += st.st_size
+        if total > self.max_size:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                _unlink_quietly(path)
+                total -= size
+        self._size = total
+
+
+class DigestCache(DiskCache):
+    """
+    Persistent cache of SHA-256 digests of files, keyed by file identity
+    (device, inode, size and modification time).
+
+    If verify is True, cached digests are checked against the file contents
+    and replaced when they don't match; this catches files which were
+    modified without changing their identity, at the cost of hashing them.
+    """
+
+    METRICS_NAME = 'digest'
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_MAX_SIZE, verify: bool = False):
+        super().__init__(cache_dir, max_size)
+        self.verify = verify
+
+    def _is_valid(self, value: dict) -> bool:
+        return _is_hex(value.get('digest'), hashlib.sha256().digest_size)
+
+    def sha256_file(self, filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bytes:
+        identity = file_identity(filename)
+        if identity is None:
+            return sha256_file(filename, chunk_size)
+        key = 'sha256:' + identity.key()
+        entry = self.get(key)
+        if entry is not None and not self.verify:
+            return bytes.fromhex(entry['digest'])
+        digest = sha256_file(filename, chunk_size)
+        if entry is not None and entry['digest'] == digest.hex():
+            return digest
+        # Don't cache a digest of a file which was modified while hashing it
+        if file_identity(filename) == identity:
+            self.put(key, {'digest': digest.hex()})
+        return digest
+
+
+class CheckpointCache(DiskCache):
+    """
+    Persistent cache of SNP launch digest checkpoints: the GCTX launch digest
+    after measuring a firmware image, and after its SEV metadata sections.
+    Checkpoints are keyed by the SHA-256 digests of the firmware contents,
+    which are themselves cached by file identity in digest_cache.
+    """
+
+    VERSION = 1
+    METRICS_NAME = 'checkpoint'
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_MAX_SIZE,
+                 digest_cache: Optional[DigestCache] = None):
+        super().__init__(cache_dir, max_size)
+        if digest_cache is None:
+            digest_cache = DigestCache(cache_dir, max_size)
+        self.digest_cache = digest_cache
+
+    def firmware_key(self, *filenames: Union[str, 'os.PathLike[str]']) -> str:
+        return ':'.join(self.digest_cache.sha256_file(str(filename)).hex() for filename in filenames)
+
+    def _is_valid(self, value: dict) -> bool:
+        return _is_hex(value.get('ld'), LD_SIZE)
+
+    def _key(self, name: str) -> str:
+        return f"checkpoint:v{self.VERSION}:{name}"
+
+    def get_ld(self, name: str) -> Optional[bytes]:
+        entry = self.get(self._key(name))
+        if entry is None:
+            return None
+        return bytes.fromhex(entry['ld'])
+
+    def put_ld(self, name: str, ld: bytes) -> None:
+        self.put(self._key(name), {'ld': ld.hex()})
+
+
+def _is_hex(value: object, size: int) -> bool:
+    if not isinstance(value, str) or len(value) != 2 * size:
+        return False
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _unlink_quietly(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -5,26 +5,99 @@
 
 import argparse
 import base64
+import contextlib
+import http.server
+import json
+import os
 import sys
 import pathlib
+import threading
+from typing import Callable, ContextManager, Dict, List, Optional, Sequence, Set, Tuple, Union
 
+from sevsnpmeasure import batch
+from sevsnpmeasure import cache
+from sevsnpmeasure import daemon
+from sevsnpmeasure import diff
+from sevsnpmeasure import gctx
 from sevsnpmeasure import guest
+from sevsnpmeasure import journal
+from sevsnpmeasure import matrix
+from sevsnpmeasure import metrics
+from sevsnpmeasure import search
+from sevsnpmeasure import shard
+from sevsnpmeasure import sweep
 from sevsnpmeasure import vcpu_types
 from sevsnpmeasure import vmm_types
 from .sev_mode import SevMode
 
 VERSION = '0.0.13'
+CACHE_DIR_ENV = 'SEV_SNP_MEASURE_CACHE_DIR'
 
 
 def auto_base_int(s: str) -> int:
     return int(s, 0)
 
 
-def print_measurement(ld: bytes, sev_mode: SevMode, output_format: str, verbose: bool):
+def vcpus_arg(s: str) -> Union[int, range]:
+    """
+    Parse a number of vcpus N, or an inclusive range N-M of numbers of vcpus.
+    """
+    first, sep, last = s.partition('-')
+    try:
+        if not sep:
+            return int(s)
+        vcpus = range(int(first), int(last) + 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number or range of vcpus: '{s}'")
+    if len(vcpus) == 0 or vcpus.start < 1:
+        raise argparse.ArgumentTypeError(f"invalid range of vcpus: '{s}'")
+    return vcpus
+
+
+def vcpus_list_arg(s: str) -> List[int]:
+    """
+    Parse a comma separated list of numbers of vcpus and ranges N-M.
+    """
+    vcpus: Set[int] = set()
+    for item in s.split(','):
+        n = vcpus_arg(item)
+        vcpus.update(n if isinstance(n, range) else [n])
+    if min(vcpus) < 1:
+        raise argparse.ArgumentTypeError(f"invalid number of vcpus: '{s}'")
+    return sorted(vcpus)
+
+
+def int_list_arg(s: str) -> List[int]:
+    try:
+        return [int(item, 0) for item in s.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid list of values: '{s}'")
+
+
+def shard_arg(s: str) -> Tuple[int, int]:
+    try:
+        return shard.parse_shard(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def measurement_arg(s: str) -> bytes:
+    try:
+        return search.parse_measurement(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def format_measurement(ld: bytes, output_format: str) -> str:
     if output_format == "hex":
-        measurement = ld.hex()
+        return ld.hex()
     elif output_format == "base64":
-        measurement = base64.b64encode(ld).decode()
+        return base64.b64encode(ld).decode()
+    raise ValueError(f"unknown output format '{output_format}'")
+
+
+def print_measurement(ld: bytes, sev_mode: SevMode, output_format: str, verbose: bool):
+    measurement = format_measurement(ld, output_format)
 
     if verbose:
         print(f"Calculated {sev_mode.name} guest measurement: {measurement}")
@@ -32,6 +105,20 @@ def print_measurement(ld: bytes, sev_mode: SevMode, output_format: str, verbose:
         print(measurement)
 
 
+def print_measurements(lds: Dict[int, bytes], sev_mode: SevMode, output_format: str, verbose: bool):
+    for vcpus, ld in lds.items():
+        measurement = format_measurement(ld, output_format)
+        if verbose:
+            print(f"Calculated {sev_mode.name} guest measurement with {vcpus} vcpus: {measurement}")
+        else:
+            print(f"{vcpus} {measurement}")
+
+
+def print_timings(timings: Optional[metrics.Timings]) -> None:
+    if timings is not None:
+        print(json.dumps(timings.to_json(), indent=2), file=sys.stderr)
+
+
 def get_vcpu_sig(parser, args, vmm_type):
     if args.mode == 'sev':
         return 0
@@ -45,14 +132,517 @@ def get_vcpu_sig(parser, args, vmm_type):
         parser.error(f"missing --vcpu-type or --vcpu-sig or --vcpu-family in guest mode '{args.mode}'")
 
 
+def get_vmm_type(parser, args) -> vmm_types.VMMType:
+    if args.vmm_type not in vmm_types.VMMType.__members__.keys():
+        parser.error(f"unknown VMM type '{args.vmm_type}'")
+    return vmm_types.VMMType[args.vmm_type]
+
+
+def check_kernel_args(parser, args) -> None:
+    if args.initrd and args.kernel is None:
+        parser.error("--kernel required when using --initrd")
+
+    if args.append and args.kernel is None:
+        parser.error("--kernel required when using --append")
+
+
+def get_caches(args) -> Tuple[Optional[cache.DigestCache], Optional[cache.CheckpointCache]]:
+    if args.no_cache or not args.cache_dir:
+        return None, None
+    digest_cache = cache.DigestCache(args.cache_dir, max_size=args.cache_max_size, verify=args.cache_verify)
+    checkpoint_cache = cache.CheckpointCache(args.cache_dir, max_size=args.cache_max_size, digest_cache=digest_cache)
+    return digest_cache, checkpoint_cache
+
+
+def add_cache_arguments(parser) -> None:
+    arg_group_cache = parser.add_argument_group(title='Caching',
+                                                description='Persistent cache of file digests, keyed by file identity '
+                                                '(device, inode, size, and modification time), and of SNP launch digest '
+                                                'checkpoints after the firmware and its metadata sections.')
+    arg_group_cache.add_argument('--cache-dir', metavar='PATH', default=os.environ.get(CACHE_DIR_ENV),
+                                 help=f'Cache directory (defaults to ${CACHE_DIR_ENV}; no caching if unset)')
+    arg_group_cache.add_argument('--no-cache', action='store_true', help='Disable caching even if --cache-dir is set')
+    arg_group_cache.add_argument('--cache-verify', action='store_true',
+                                 help='Hash files even on cache hits, and replace cached digests that do not match')
+    arg_group_cache.add_argument('--cache-max-size', metavar='BYTES', type=int, default=cache.DEFAULT_MAX_SIZE,
+                                 help=f'Evict least recently used entries beyond this size '
+                                      f'(defaults to {cache.DEFAULT_MAX_SIZE})')
+
+
+def add_svsm_arguments(parser) -> None:
+    arg_group_svsm = parser.add_argument_group(title='snp:svsm Mode',
+                                               description='AMD SEV-SNP with Coconut-SVSM. This mode additionally requires '
+                                               '--svsm and either --vars-file or --vars-size to be set.')
+    arg_group_svsm.add_argument('--svsm', type=str, metavar='PATH', help='SVSM binary')
+    arg_group_ovmf_vars = arg_group_svsm.add_mutually_exclusive_group(required=False)
+    arg_group_ovmf_vars.add_argument('--vars-size', type=int, metavar='SIZE', help='Size of the OVMF_VARS file in bytes '
+                                     '(conflicts with --vars-file)')
+    arg_group_ovmf_vars.add_argument('--vars-file', type=str, metavar='PATH', help='OVMF_VARS file '
+                                     '(conflicts with --vars-size)')
+
+
+def get_vars_size(parser, args, sev_mode: SevMode) -> int:
+    if sev_mode != SevMode.SEV_SNP_SVSM:
+        return 0
+    if args.vars_file:
+        return pathlib.Path(args.vars_file).stat().st_size
+    elif args.vars_size:
+        return args.vars_size
+    parser.error("snp:svsm mode requires --vars-size or --vars-file")
+    return 0
+
+
+def get_sweep_vcpu_sigs(parser, args, vmm_types_list: List[vmm_types.VMMType], default_all: bool = False) -> List[int]:
+    sigs = list(args.vcpu_sig or [])
+    if not sigs and not args.vcpu_type and default_all:
+        return list(dict.fromkeys(vcpu_types.CPU_SIGS.values()))
+    for vcpu_type in (args.vcpu_type.split(',') if args.vcpu_type else []):
+        if vcpu_type not in vcpu_types.CPU_SIGS:
+            parser.error(f"unknown vcpu type '{vcpu_type}'")
+        sigs.append(vcpu_types.CPU_SIGS[vcpu_type])
+    if not sigs:
+        if args.mode != 'sev' and vmm_types.VMMType.QEMU in vmm_types_list:
+            parser.error(f"missing --vcpu-type or --vcpu-sig in guest mode '{args.mode}'")
+        sigs = [0]
+    return list(dict.fromkeys(sigs))
+
+
+def get_sweep_vmm_types(parser, args) -> List[vmm_types.VMMType]:
+    result = []
+    for name in args.vmm_type.split(','):
+        if name not in vmm_types.VMMType.__members__.keys():
+            parser.error(f"unknown VMM type '{name}'")
+        result.append(vmm_types.VMMType[name])
+    return list(dict.fromkeys(result))
+
+
+def add_parameter_space_arguments(parser, vcpus: str, vmm_type: str) -> None:
+    parser.add_argument('--vcpus', metavar='LIST', type=vcpus_list_arg, default=vcpus_list_arg(vcpus),
+                        help=f'Comma separated numbers of guest vcpus and ranges N-M (defaults to {vcpus})')
+    parser.add_argument('--vcpu-type', metavar='LIST', default=None,
+                        help=f"Comma separated types of guest vcpu ({', '.join(vcpu_types.CPU_SIGS.keys())})")
+    parser.add_argument('--vcpu-sig', metavar='LIST', type=int_list_arg, default=None,
+                        help='Comma separated guest vcpu signature values')
+    parser.add_argument('--vmm-type', metavar='LIST', type=str, default=vmm_type,
+                        help=f"Comma separated types of guest vmm ({', '.join(vmm_types.VMMType.__members__.keys())}; "
+                             f"defaults to {vmm_type})")
+    parser.add_argument('--guest-features', metavar='LIST', type=int_list_arg, default=[0x1],
+                        help='Comma separated guest kernel features values (defaults to 0x1)')
+
+
+def add_input_arguments(parser) -> None:
+    parser.add_argument('--ovmf', metavar='PATH', help='OVMF file to calculate hash from', required=True)
+    parser.add_argument('--kernel', metavar='PATH', help='Kernel file to calculate hash from')
+    parser.add_argument('--initrd', metavar='PATH', help='Initrd file to calculate hash from (use with --kernel)')
+    parser.add_argument('--append', metavar='CMDLINE',
+                        help='Kernel command line to calculate hash from (use with --kernel)')
+    parser.add_argument('--snp-ovmf-hash', metavar='HASH', help='Precalculated hash of the OVMF binary (hex string)')
+
+
+def format_launch_config(config: sweep.LaunchConfig) -> str:
+    return f"vcpus={config.vcpus} vcpu_sig={config.vcpu_sig:#x} " \
+           f"guest_features={config.guest_features:#x} vmm_type={config.vmm_type.name}"
+
+
+def sweep_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure sweep',
+                                     description='Calculate the AMD SEV/SEV-ES/SEV-SNP guest launch measurement for '
+                                     'every combination of the given numbers of vcpus, vcpu signatures, guest features '
+                                     'and VMM types, measuring the firmware and kernel once')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--mode', choices=['sev', 'seves', 'snp', 'snp:svsm'], help='Guest mode', required=True)
+    add_parameter_space_arguments(parser, vcpus='1', vmm_type='QEMU')
+    add_input_arguments(parser)
+    parser.add_argument('--output-format', choices=['hex', 'base64'], help='Measurement output format', default='hex')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of threads hashing firmware pages (defaults to 1)')
+    add_cache_arguments(parser)
+    add_svsm_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    check_kernel_args(parser, args)
+    digest_cache, checkpoint_cache = get_caches(args)
+    sweep_vmm_types = get_sweep_vmm_types(parser, args)
+    vcpu_sigs = get_sweep_vcpu_sigs(parser, args, sweep_vmm_types)
+
+    try:
+        sev_mode = SevMode.from_str(args.mode)
+        vars_size = get_vars_size(parser, args, sev_mode)
+        configs = sweep.launch_configs(args.vcpus, vcpu_sigs, args.guest_features, sweep_vmm_types)
+        lds = sweep.sweep_launch_digests(sev_mode, configs, args.ovmf, args.kernel, args.initrd, args.append,
+                                         args.snp_ovmf_hash, args.svsm, vars_size, args.workers, digest_cache,
+                                         checkpoint_cache)
+        for config, ld in lds.items():
+            measurement = format_measurement(ld, args.output_format)
+            params = format_launch_config(config)
+            if args.verbose:
+                print(f"Calculated {sev_mode.name} guest measurement with {params}: {measurement}")
+            else:
+                print(f"{params} {measurement}")
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+class SearchProgress(object):
+    """
+    Report search progress and throughput on stderr, at most every interval
+    seconds.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last_report = -interval
+
+    def __call__(self, tried: int, total: int, elapsed: float) -> None:
+        if elapsed - self.last_report < self.interval and tried < total:
+            return
+        self.last_report = elapsed
+        rate = tried / elapsed if elapsed > 0 else 0.0
+        print(f"\rTried {tried}/{total} configurations ({rate:.0f}/s)", end='', file=sys.stderr, flush=True)
+
+
+def get_search_features(args) -> List[int]:
+    features = list(args.guest_features)
+    if args.guest_feature_bits:
+        features = [mask for base in features for mask in search.feature_masks(args.guest_feature_bits, base)]
+    return list(dict.fromkeys(features))
+
+
+def search_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure search',
+                                     description='Search for the guest configuration (number of vcpus, vcpu signature, '
+                                     'guest features and VMM type) which produces a given AMD SEV/SEV-ES/SEV-SNP launch '
+                                     'measurement')
+    parser.add_argument('--target', metavar='MEASUREMENT', type=measurement_arg, required=True,
+                        help='Measurement to search for, in hex or base64')
+    parser.add_argument('--mode', choices=['sev', 'seves', 'snp', 'snp:svsm'], help='Guest mode', required=True)
+    add_parameter_space_arguments(parser, vcpus='1-64', vmm_type=','.join(vmm_types.VMMType.__members__.keys()))
+    parser.add_argument('--guest-feature-bits', metavar='MASK', type=auto_base_int, default=0,
+                        help='Also try every combination of these guest features bits with each --guest-features value')
+    add_input_arguments(parser)
+    parser.add_argument('--processes', metavar='N', type=int, default=os.cpu_count() or 1,
+                        help='Number of search processes (defaults to the number of CPUs)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not report progress on stderr')
+    add_svsm_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    check_kernel_args(parser, args)
+    search_vmm_types = get_sweep_vmm_types(parser, args)
+    vcpu_sigs = get_sweep_vcpu_sigs(parser, args, search_vmm_types, default_all=True)
+
+    try:
+        sev_mode = SevMode.from_str(args.mode)
+        if len(args.target) != search.measurement_size(sev_mode):
+            parser.error(f"--target must be {search.measurement_size(sev_mode)} bytes long in {args.mode} mode")
+        vars_size = get_vars_size(parser, args, sev_mode)
+        result = search.search_launch_config(args.target, sev_mode, args.ovmf, args.kernel, args.initrd, args.append,
+                                             args.vcpus, vcpu_sigs, get_search_features(args), search_vmm_types,
+                                             args.snp_ovmf_hash, args.svsm, vars_size, args.processes,
+                                             progress=None if args.quiet else SearchProgress())
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if not args.quiet:
+        print(f"\nTried {result.tried} configurations in {result.elapsed:.2f}s", file=sys.stderr)
+    if result.config is None:
+        print("No matching configuration found", file=sys.stderr)
+        return 1
+    names = [name for name, sig in vcpu_types.CPU_SIGS.items() if sig == result.config.vcpu_sig]
+    vcpu_type = f" vcpu_type={','.join(names)}" if names and result.config.vmm_type == vmm_types.VMMType.QEMU else ""
+    print(format_launch_config(result.config) + vcpu_type)
+    return 0
+
+
+def matrix_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure matrix',
+                                     description='Calculate the AMD SEV/SEV-ES/SEV-SNP guest launch measurement for '
+                                     'every combination of the given numbers of vcpus, vcpu signatures, guest features '
+                                     'and VMM types, and write an index file for looking up the configuration of a '
+                                     'measurement')
+    parser.add_argument('--mode', choices=['sev', 'seves', 'snp', 'snp:svsm'], help='Guest mode', required=True)
+    add_parameter_space_arguments(parser, vcpus='1', vmm_type='QEMU')
+    add_input_arguments(parser)
+    parser.add_argument('--output', metavar='PATH', required=True,
+                        help='Index file to write (or shard output with --shard)')
+    parser.add_argument('--sqlite', action='store_true', help='Write an SQLite database instead of an index file')
+    parser.add_argument('--shard', metavar='I/N', type=shard_arg,
+                        help='Only measure the I-th of N shards of the configurations, writing them as JSON lines '
+                             'to be combined by the merge subcommand; an interrupted shard continues where it '
+                             'stopped when run again')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of threads hashing firmware pages (defaults to 1)')
+    add_cache_arguments(parser)
+    add_svsm_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.shard and args.sqlite:
+        parser.error("--sqlite can only be used with the merge subcommand when using --shard")
+    check_kernel_args(parser, args)
+    digest_cache, checkpoint_cache = get_caches(args)
+    matrix_vmm_types = get_sweep_vmm_types(parser, args)
+    vcpu_sigs = get_sweep_vcpu_sigs(parser, args, matrix_vmm_types)
+
+    try:
+        sev_mode = SevMode.from_str(args.mode)
+        vars_size = get_vars_size(parser, args, sev_mode)
+        configs = sweep.launch_configs(args.vcpus, vcpu_sigs, args.guest_features, matrix_vmm_types)
+        metadata = {'mode': sev_mode.name, 'ovmf': args.ovmf, 'kernel': args.kernel, 'initrd': args.initrd,
+                    'append': args.append, 'svsm': args.svsm}
+        if args.shard:
+            shard_index, shard_count = args.shard
+            shard.run_shard(sev_mode, configs, shard_index, shard_count, args.output, args.ovmf, args.kernel,
+                            args.initrd, args.append, args.snp_ovmf_hash, args.svsm, vars_size, args.workers,
+                            digest_cache, checkpoint_cache, metadata)
+            return 0
+        lds = sweep.sweep_launch_digests(sev_mode, configs, args.ovmf, args.kernel, args.initrd, args.append,
+                                         args.snp_ovmf_hash, args.svsm, vars_size, args.workers, digest_cache,
+                                         checkpoint_cache)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    write = matrix.write_sqlite_index if args.sqlite else matrix.write_index
+    write(args.output, lds, metadata)
+    return 0
+
+
+def merge_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure merge',
+                                     description='Combine the outputs of all the shards of a matrix subcommand run '
+                                     'with --shard into one index file')
+    parser.add_argument('--output', metavar='PATH', required=True, help='Index file to write')
+    parser.add_argument('--sqlite', action='store_true', help='Write an SQLite database instead of an index file')
+    parser.add_argument('shards', metavar='SHARD', nargs='+', help='Shard outputs')
+
+    args = parser.parse_args(argv)
+
+    try:
+        lds, metadata = shard.merge_shards(args.shards)
+    except (OSError, RuntimeError, ValueError, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    write = matrix.write_sqlite_index if args.sqlite else matrix.write_index
+    write(args.output, lds, metadata)
+    return 0
+
+
+def lookup_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure lookup',
+                                     description='Look up the guest configurations producing launch measurements in an '
+                                     'index file written by the matrix subcommand')
+    parser.add_argument('--index', metavar='PATH', required=True, help='Index file (or SQLite database)')
+    parser.add_argument('measurements', metavar='MEASUREMENT', nargs='*',
+                        help='Measurements in hex or base64 (read from stdin, one per line, if none are given)')
+
+    args = parser.parse_args(argv)
+
+    try:
+        index = matrix.open_index(args.index)
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    found_all = True
+    with index:
+        for s in args.measurements or (line for line in sys.stdin if line.strip()):
+            s = s.strip()
+            try:
+                configs = index.lookup(search.parse_measurement(s))
+            except ValueError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                configs = []
+            if not configs:
+                print(f"{s} not-found")
+                found_all = False
+            for config in configs:
+                print(f"{s} {format_launch_config(config)}")
+    return 0 if found_all else 1
+
+
+def batch_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure batch',
+                                     description='Calculate AMD SEV/SEV-ES/SEV-SNP guest launch measurements for JSONL '
+                                     'requests, one JSON object per line whose keys are the long options of '
+                                     'sev-snp-measure (such as {"mode": "snp", "vcpus": 4, "vcpu-type": "EPYC-v4", '
+                                     '"ovmf": "OVMF.fd"}), and write JSONL results')
+    parser.add_argument('--input', metavar='PATH', default='-', help='Requests file (defaults to stdin)')
+    parser.add_argument('--output', metavar='PATH', default='-', help='Results file (defaults to stdout)')
+    parser.add_argument('--output-format', choices=['hex', 'base64'], help='Measurement output format', default='hex')
+    parser.add_argument('--processes', metavar='N', type=int, default=os.cpu_count() or 1,
+                        help='Number of measurement processes (defaults to the number of CPUs)')
+    parser.add_argument('--max-in-flight', metavar='N', type=int, default=0,
+                        help='Maximum number of requests submitted to the processes at any time '
+                             '(defaults to twice the number of processes)')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Write results as they complete instead of in the order of the requests')
+    add_cache_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.max_in_flight < 0:
+        parser.error("--max-in-flight must not be negative")
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    infile = sys.stdin if args.input == '-' else open(args.input, 'r')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    failed = False
+    try:
+        for result in batch.measure_requests(batch.read_requests(infile), args.processes, args.max_in_flight,
+                                             ordered=not args.unordered, cache_dir=cache_dir):
+            if 'measurement' in result:
+                result['measurement'] = format_measurement(bytes.fromhex(result['measurement']), args.output_format)
+            else:
+                failed = True
+            outfile.write(json.dumps(result) + "\n")
+            outfile.flush()
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    return 1 if failed else 0
+
+
+def daemon_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure daemon',
+                                     description='Serve AMD SEV/SEV-ES/SEV-SNP guest launch measurement requests on a '
+                                     'Unix domain socket, one JSON object per line as accepted by the batch '
+                                     'subcommand, keeping the state of recently measured inputs in memory')
+    parser.add_argument('--socket', metavar='PATH', required=True, help='Unix domain socket to listen on')
+    parser.add_argument('--metrics-port', metavar='PORT', type=int,
+                        help='Serve metrics in the Prometheus text format on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--max-concurrent', metavar='N', type=int, default=1,
+                        help='Number of measurements computed at a time (defaults to 1)')
+    parser.add_argument('--max-queue', metavar='N', type=int, default=daemon.DEFAULT_MAX_QUEUE,
+                        help='Number of measurements waiting for their turn beyond which requests are rejected '
+                             f'(defaults to {daemon.DEFAULT_MAX_QUEUE})')
+    add_cache_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.max_concurrent < 1:
+        parser.error("--max-concurrent must be at least 1")
+    if args.max_queue < 0:
+        parser.error("--max-queue must not be negative")
+    cache_dir = None if args.no_cache else args.cache_dir
+    try:
+        server = daemon.MeasurementServer(args.socket, cache_dir, args.max_concurrent, args.max_queue)
+        if args.metrics_port is not None:
+            metrics.REGISTRY.enable()
+            metrics_server = http.server.ThreadingHTTPServer(('127.0.0.1', args.metrics_port), metrics.MetricsHandler)
+            threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def diff_main(argv: Sequence[str]) -> int:
+    parser = argparse.ArgumentParser(prog='sev-snp-measure diff',
+                                     description='Find the first page measured differently by two AMD SEV-SNP guest '
+                                     'configurations, each given as a JSON object whose keys are the long options of '
+                                     'sev-snp-measure (such as {"mode": "snp", "vcpus": 4, "vcpu-type": "EPYC-v4", '
+                                     '"ovmf": "OVMF.fd"}); exits with 1 if they differ')
+    parser.add_argument('first', metavar='FIRST', help='First configuration (JSON object)')
+    parser.add_argument('second', metavar='SECOND', help='Second configuration (JSON object)')
+    parser.add_argument('--json', action='store_true', help='Print the difference as a JSON object')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of threads hashing firmware pages in each measurement (defaults to 1)')
+
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    try:
+        requests = [batch.parse_request(json.loads(arg)) for arg in [args.first, args.second]]
+        difference = diff.diff_measurements(requests[0], requests[1], workers=args.workers)
+    except (ValueError, RuntimeError, OSError, KeyError, AssertionError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    if args.json:
+        print(json.dumps(difference.to_json() if difference is not None else None))
+    elif difference is not None:
+        print(difference)
+    else:
+        print("Same measurement")
+    return 0 if difference is None else 1
+
+
+class SubcommandsHelpFormatter(argparse.HelpFormatter):
+    """
+    Help formatter keeping the lines of texts given with line breaks (the
+    list of subcommands), and wrapping the others.
+    """
+
+    def _fill_text(self, text, width, indent):
+        if '\n' not in text:
+            return super()._fill_text(text, width, indent)
+        return ''.join(indent + line for line in text.splitlines(keepends=True))
+
+
+# Subcommands, given as the first argument; anything else is parsed as the
+# options of a single measurement
+SUBCOMMANDS: Dict[str, Callable[[Sequence[str]], int]] = {
+    'sweep': sweep_main,
+    'search': search_main,
+    'matrix': matrix_main,
+    'merge': merge_main,
+    'lookup': lookup_main,
+    'batch': batch_main,
+    'daemon': daemon_main,
+    'diff': diff_main,
+}
+
+# One-line summaries of the subcommands, listed in the help of main
+SUBCOMMAND_SUMMARIES = {
+    'sweep': 'Measure every combination of vcpus, vcpu types, guest features and VMM types',
+    'search': 'Find the guest configuration producing a given measurement',
+    'matrix': 'Write the measurements of every combination to a searchable index file',
+    'merge': 'Combine the shards of a matrix run into one index file',
+    'lookup': 'Look up the guest configurations producing measurements in an index file',
+    'batch': 'Measure JSONL requests read from a file or stdin',
+    'daemon': 'Serve measurement requests on a Unix domain socket',
+    'diff': 'Find the first page measured differently by two guest configurations',
+}
+
+
 def main() -> int:
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
+    epilog = 'subcommands:\n' + ''.join(f"  {name:<10}{SUBCOMMAND_SUMMARIES[name]}\n" for name in SUBCOMMANDS) + \
+        "\nRun 'sev-snp-measure SUBCOMMAND --help' for the options of a subcommand."
     parser = argparse.ArgumentParser(prog='sev-snp-measure',
-                                     description='Calculate AMD SEV/SEV-ES/SEV-SNP guest launch measurement')
+                                     description='Calculate AMD SEV/SEV-ES/SEV-SNP guest launch measurement',
+                                     epilog=epilog, formatter_class=SubcommandsHelpFormatter)
     parser.add_argument('--version', action='version', version=f'%(prog)s {VERSION}')
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('--mode', choices=['sev', 'seves', 'snp', 'snp:ovmf-hash', 'snp:svsm'], help='Guest mode',
                         required=True)
-    parser.add_argument('--vcpus', metavar='N', type=int, help='Number of guest vcpus', default=None)
+    parser.add_argument('--vcpus', metavar='N', type=vcpus_arg, default=None,
+                        help='Number of guest vcpus, or a range N-M to print the measurement for every number '
+                             'of vcpus in the range')
     parser.add_argument('--vcpu-type', metavar='CPUTYPE', choices=list(vcpu_types.CPU_SIGS.keys()),
                         help=f"Type of guest vcpu ({', '.join(vcpu_types.CPU_SIGS.keys())})",
                         default=None)
@@ -78,60 +668,87 @@ def main() -> int:
     parser.add_argument('--snp-ovmf-hash', metavar='HASH', help='Precalculated hash of the OVMF binary (hex string)')
     parser.add_argument('--dump-vmsa', action='store_true',
                         help='Write measured VMSAs to vmsa<N>.bin (seves, snp, and snp:svsm modes only)')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='Number of threads hashing firmware pages (snp, snp:ovmf-hash, and snp:svsm modes only; '
+                             'defaults to 1)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the wall and CPU time, pages/s and MiB/s of each stage of the measurement as JSON '
+                             'to stderr')
 
-    arg_group_svsm = parser.add_argument_group(title='snp:svsm Mode',
-                                               description='AMD SEV-SNP with Coconut-SVSM. This mode additionally requires '
-                                               '--svsm and either --vars-file or --vars-size to be set.')
-    arg_group_svsm.add_argument('--svsm', type=str, metavar='PATH', help='SVSM binary')
-    arg_group_ovmf_vars = arg_group_svsm.add_mutually_exclusive_group(required=False)
-    arg_group_ovmf_vars.add_argument('--vars-size', type=int, metavar='SIZE', help='Size of the OVMF_VARS file in bytes '
-                                     '(conflicts with --vars-file)')
-    arg_group_ovmf_vars.add_argument('--vars-file', type=str, metavar='PATH', help='OVMF_VARS file '
-                                     '(conflicts with --vars-size)')
+    add_cache_arguments(parser)
+    add_svsm_arguments(parser)
+
+    parser.add_argument('--journal', metavar='PATH',
+                        help='Write a binary journal of every page measured (snp, snp:ovmf-hash, and snp:svsm modes '
+                             'only; disables the checkpoint cache)')
 
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.journal and args.mode in ['sev', 'seves']:
+        parser.error("--journal is only available in the snp, snp:ovmf-hash and snp:svsm modes")
+
+    with open_journal(args.journal):
+        return measure(parser, args)
+
+
+def open_journal(path: Optional[str]) -> ContextManager:
+    """
+    Return a context manager writing the pages measured in its block to a
+    binary journal at path, or doing nothing if path is None.
+    """
+    if path is None:
+        return contextlib.nullcontext()
+    stack = contextlib.ExitStack()
+    f = stack.enter_context(open(path, 'wb'))
+    stack.enter_context(gctx.observing(journal.JournalWriter(f)))
+    return stack
+
+
+def measure(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    digest_cache, checkpoint_cache = get_caches(args)
+    if args.journal:
+        # Pages measured before a cached checkpoint aren't journaled
+        checkpoint_cache = None
+    timings = metrics.Timings() if args.timings else None
+
     if args.mode == 'snp:ovmf-hash':
-        print(guest.calc_snp_ovmf_hash(args.ovmf).hex())
+        print(guest.calc_snp_ovmf_hash(args.ovmf, workers=args.workers, checkpoint_cache=checkpoint_cache,
+                                       timings=timings).hex())
+        print_timings(timings)
         return 0
 
-    if args.initrd and args.kernel is None:
-        parser.error("--kernel required when using --initrd")
-
-    if args.append and args.kernel is None:
-        parser.error("--kernel required when using --append")
+    check_kernel_args(parser, args)
 
     if args.mode != 'sev' and args.vcpus is None:
         parser.error(f"missing --vcpus N in guest mode '{args.mode}'")
 
-    if args.vmm_type in vmm_types.VMMType.__members__.keys():
-        vmm_type = vmm_types.VMMType[args.vmm_type]
-    else:
-        parser.error(f"unknown VMM type '{args.vmm_type}'")
-
+    vmm_type = get_vmm_type(parser, args)
     vcpu_sig = get_vcpu_sig(parser, args, vmm_type)
 
     try:
-        vars_size = 0
         sev_mode = SevMode.from_str(args.mode)
-
-        if sev_mode == SevMode.SEV_SNP_SVSM:
-
-            if args.vars_file:
-                vars_size = pathlib.Path(args.vars_file).stat().st_size
-            elif args.vars_size:
-                vars_size = args.vars_size
-            else:
-                parser.error("snp:svsm mode requires --vars-size or --vars-file")
+        vars_size = get_vars_size(parser, args, sev_mode)
 
         if args.dump_vmsa is True and sev_mode not in [SevMode.SEV_ES, SevMode.SEV_SNP, SevMode.SEV_SNP_SVSM]:
             parser.error("--dump-vmsa is not availibe in the selected mode")
 
+        if isinstance(args.vcpus, range):
+            lds = guest.calc_launch_digests(sev_mode, args.vcpus, vcpu_sig, args.ovmf, args.kernel, args.initrd,
+                                            args.append, args.guest_features, args.snp_ovmf_hash, vmm_type,
+                                            args.dump_vmsa, args.svsm, vars_size, args.workers, digest_cache,
+                                            checkpoint_cache, timings)
+            print_measurements(lds, sev_mode, args.output_format, args.verbose)
+            print_timings(timings)
+            return 0
+
         ld = guest.calc_launch_digest(sev_mode, args.vcpus, vcpu_sig, args.ovmf, args.kernel, args.initrd, args.append,
                                       args.guest_features, args.snp_ovmf_hash, vmm_type, args.dump_vmsa,
-                                      args.svsm, vars_size)
+                                      args.svsm, vars_size, args.workers, digest_cache, checkpoint_cache, timings)
 
         print_measurement(ld, sev_mode, args.output_format, args.verbose)
+        print_timings(timings)
     except RuntimeError as e:
         print(f"Error: {e}", file=sys.stderr)
         return 1
@@ -0,0 +1,156 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import threading
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from . import guest
+from . import metrics
+from .cache import CheckpointCache, DigestCache, file_identity
+from .sev_mode import SevMode
+from .vmm_types import VMMType
+
+
+class Overloaded(RuntimeError):
+    """
+    Raised when a measurement is rejected because the queue is full.
+    """
+
+
+class LimiterStats(NamedTuple):
+    """
+    Counters of a MeasurementLimiter: the measurements running and waiting
+    for their turn (queue depth), and since its creation, the measurements
+    computed, those which failed, the requests coalesced into a measurement
+    already in flight, and the requests rejected because the queue was full.
+    """
+    running: int
+    queued: int
+    computed: int
+    failed: int
+    coalesced: int
+    rejected: int
+
+
+class _Flight(object):
+    """
+    A measurement in flight, which identical requests wait for.
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[bytes] = None
+        self.error: Optional[BaseException] = None
+
+
+class MeasurementLimiter(object):
+    """
+    Wrapper of calc_launch_digest (or of any measurement, with coalesce) for
+    concurrent callers (threads).
+
+    Requests with identical inputs (the same parameters and input files with
+    the same identity) made while one of them is being computed share that
+    computation.  At most max_concurrent measurements are computed at a time,
+    and at most max_queue more wait for their turn; further requests raise
+    Overloaded, so the caller can push back on its clients.
+
+    Besides stats(), the outcomes of requests are counted in the metrics
+    registry.
+    """
+
+    def __init__(self, max_concurrent: int = 1, max_queue: int = 0,
+                 calc: Callable[..., bytes] = guest.calc_launch_digest):
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+        self._max_concurrent = max_concurrent
+        self._max_queue = max_queue
+        self._calc = calc
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_concurrent)
+        self._flights: Dict[tuple, _Flight] = {}
+        self._running = 0
+        self._computed = 0
+        self._failed = 0
+        self._coalesced = 0
+        self._rejected = 0
+
+    def stats(self) -> LimiterStats:
+        with self._lock:
+            return LimiterStats(self._running, len(self._flights) - self._running, self._computed, self._failed,
+                                self._coalesced, self._rejected)
+
+    def calc_launch_digest(self, mode: SevMode, vcpus: int, vcpu_sig: int, ovmf_file: str,
+                           kernel: str, initrd: str, append: str, guest_features: int, snp_ovmf_hash_str: str = '',
+                           vmm_type: VMMType = VMMType.QEMU, svsm_file: str = '', ovmf_vars_size: int = 0,
+                           workers: int = 1, digest_cache: Optional[DigestCache] = None,
+                           checkpoint_cache: Optional[CheckpointCache] = None) -> bytes:
+        """
+        Same as guest.calc_launch_digest, coalescing identical requests and
+        raising Overloaded if the queue is full.
+        """
+        key = (mode, vcpus, vcpu_sig, _identity(ovmf_file), _identity(kernel), _identity(initrd), append or '',
+               guest_features, snp_ovmf_hash_str, vmm_type, _identity(svsm_file), ovmf_vars_size)
+        return self.coalesce(key, lambda: self._calc(
+            mode, vcpus, vcpu_sig, ovmf_file, kernel, initrd, append, guest_features, snp_ovmf_hash_str,
+            vmm_type, svsm_file=svsm_file, ovmf_vars_size=ovmf_vars_size, workers=workers,
+            digest_cache=digest_cache, checkpoint_cache=checkpoint_cache))
+
+    def coalesce(self, key: tuple, calc: Callable[[], bytes]) -> bytes:
+        """
+        Return the result of calc, a measurement identified by key (which must
+        include the identity of its input files), sharing it with the
+        identical requests made while it is computed, and raising Overloaded
+        if the queue is full.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            owner = flight is None
+            if flight is not None:
+                self._coalesced += 1
+                metrics.count_limiter('coalesced')
+            elif len(self._flights) >= self._max_concurrent + self._max_queue:
+                self._rejected += 1
+                metrics.count_limiter('rejected')
+                raise Overloaded(f"Too many measurements in flight ({len(self._flights)})")
+            else:
+                flight = self._flights[key] = _Flight()
+        if owner:
+            self._run(key, flight, calc)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        assert flight.result is not None
+        return flight.result
+
+    def _run(self, key: tuple, flight: _Flight, calc: Callable[[], bytes]) -> None:
+        if not self._slots.acquire(blocking=False):
+            metrics.count_limiter('queued')
+            self._slots.acquire()
+        try:
+            with self._lock:
+                self._running += 1
+            try:
+                flight.result = calc()
+            except BaseException as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    if flight.error is None:
+                        self._computed += 1
+                    else:
+                        self._failed += 1
+                    del self._flights[key]
+                metrics.count_limiter('computed' if flight.error is None else 'failed')
+                flight.done.set()
+        finally:
+            self._slots.release()
+
+
+def _identity(filename: Optional[str]) -> Tuple[str, Any]:
+    return (filename, file_identity(filename)) if filename else ('', None)
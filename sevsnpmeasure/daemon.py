@@ -0,0 +1,127 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import json
+import os
+import socket
+import socketserver
+import stat
+from typing import Any, Dict, Optional
+
+from . import batch
+from .concurrency import MeasurementLimiter
+
+# Number of measurements waiting for their turn beyond which a server
+# rejects requests
+DEFAULT_MAX_QUEUE = 64
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serve the JSON line requests of a connection, answering each with a JSON
+    line result as written by the batch subcommand.
+    """
+
+    server: 'MeasurementServer'
+
+    def handle(self) -> None:
+        lines = (line.decode('utf-8', errors='replace') for line in self.rfile)
+        for index, obj in enumerate(batch.read_requests(lines)):
+            result = self.server.state.measure_result(index, obj)
+            self.wfile.write(json.dumps(result).encode() + b'\n')
+            self.wfile.flush()
+
+
+class MeasurementServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Measurement server listening on a Unix domain socket.  Clients send
+    requests as accepted by the batch subcommand, one JSON object per line,
+    and get a JSON result line for each.
+
+    The server keeps its own measurement state (a batch.MeasurementState)
+    up to the VMSA pages of recently used inputs (their parsed firmware,
+    kernel hashes and launch digest) in memory, keyed by the identity of the
+    input files, so a request for known inputs only measures the VMSA pages,
+    and a file which changed is measured again.
+
+    Each connection is served by its own thread, so clients connect, send
+    requests and read results concurrently.  Measurements go through a
+    concurrency.MeasurementLimiter: identical requests in flight share one
+    measurement, at most max_concurrent measurements run at a time and at
+    most max_queue more wait for their turn; further requests get an error
+    result.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, cache_dir: Optional[str] = None, max_concurrent: int = 1,
+                 max_queue: int = DEFAULT_MAX_QUEUE):
+        self.limiter = MeasurementLimiter(max_concurrent, max_queue)
+        self.state = batch.MeasurementState(cache_dir, self.limiter)
+        _remove_stale_socket(path)
+        self.path = path
+        super().__init__(path, _RequestHandler)
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_stale_socket(path: str) -> None:
+    """
+    Remove the socket at path if it was left behind by a server which didn't
+    shut down cleanly, or raise RuntimeError if a server is listening on it.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise RuntimeError(f"A measurement server is already listening on '{path}'")
+
+
+class MeasurementClient(object):
+    """
+    Client of a MeasurementServer.
+    """
+
+    def __init__(self, path: str):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path)
+        except BaseException:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile('rwb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+        self._socket.close()
+
+    def measure(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Send a measurement request, and return its result.
+        """
+        self._file.write(json.dumps(request).encode() + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise RuntimeError("Measurement server closed the connection")
+        return json.loads(line)
@@ -0,0 +1,279 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import queue
+import threading
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from . import gctx
+from . import guest
+from .batch import OVMF_HASH_MODE, MeasurementRequest
+from .cache import DigestCache
+from .gctx import PageType
+from .journal import JournalRecord
+from .ovmf import OVMF, SVSM, OvmfSevMetadataSectionDesc, SectionType
+from .sev_mode import SevMode
+
+# Records are passed from the measurements to the comparison in chunks of
+# this many pages, with at most QUEUE_CHUNKS chunks waiting per measurement
+CHUNK_PAGES = 4096
+QUEUE_CHUNKS = 4
+
+# Regions of the guest memory a measured page can belong to
+FIRMWARE = 'firmware'
+SVSM_REGION = 'svsm'
+METADATA = 'metadata'
+VMSA_REGION = 'vmsa'
+
+# Inputs of a measurement request which can change the pages of each region
+# (and of each metadata section type)
+_REGION_INPUTS = {
+    FIRMWARE: ('mode', 'ovmf', 'snp_ovmf_hash'),
+    SVSM_REGION: ('mode', 'svsm', 'vars_size'),
+    VMSA_REGION: ('mode', 'vcpus', 'vcpu_sig', 'guest_features', 'vmm_type', 'ovmf', 'svsm'),
+}
+_SECTION_INPUTS = {
+    SectionType.SNP_KERNEL_HASHES: ('mode', 'ovmf', 'svsm', 'kernel', 'initrd', 'append'),
+}
+_DEFAULT_SECTION_INPUTS = ('mode', 'ovmf', 'svsm', 'vmm_type')
+
+
+class DiffPage(object):
+    """
+    A page measured by one of the compared measurements: its journal record,
+    and the region of memory (FIRMWARE, SVSM_REGION, METADATA or VMSA_REGION)
+    and SEV metadata section it belongs to.
+    """
+
+    def __init__(self, record: JournalRecord, region: str, section: Optional[OvmfSevMetadataSectionDesc]):
+        self.record = record
+        self.region = region
+        self.section = section
+
+    def inputs(self) -> Tuple[str, ...]:
+        """
+        Return the inputs of a measurement request which can change this page.
+        """
+        if self.section is not None:
+            return _SECTION_INPUTS.get(self.section.section_type(), _DEFAULT_SECTION_INPUTS)
+        return _REGION_INPUTS[self.region]
+
+    def to_json(self) -> Dict[str, Any]:
+        obj: Dict[str, Any] = {'page_type': PageType(self.record.page_type).name, 'gpa': f"0x{self.record.gpa:x}",
+                               'contents': self.record.contents.hex(), 'ld': self.record.ld.hex(),
+                               'region': self.region, 'section': None}
+        if self.section is not None:
+            obj['section'] = {'section_type': self.section.section_type().name, 'gpa': f"0x{self.section.gpa:x}",
+                              'size': f"0x{self.section.size:x}"}
+        return obj
+
+    def __str__(self) -> str:
+        text = f"{PageType(self.record.page_type).name} page gpa=0x{self.record.gpa:x}"
+        if self.section is not None:
+            return text + (f" in {self.section.section_type().name} section gpa=0x{self.section.gpa:x} "
+                           f"size=0x{self.section.size:x}")
+        return text + f" in {self.region}"
+
+
+class MeasurementDiff(NamedTuple):
+    """
+    The first page whose PAGE_INFO differs between two measurements: its
+    index in the order of measurement, the page of each measurement (None if
+    that measurement had ended), the PAGE_INFO fields which differ
+    ('page_type', 'gpa', 'contents', or 'ld' when only the launch digest
+    before the page does), and the inputs differing between the two requests
+    which can change that page.
+    """
+    page_index: int
+    first: Optional[DiffPage]
+    second: Optional[DiffPage]
+    fields: Tuple[str, ...]
+    inputs: Tuple[str, ...]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {'page_index': self.page_index, 'fields': list(self.fields), 'inputs': list(self.inputs),
+                'first': self.first.to_json() if self.first is not None else None,
+                'second': self.second.to_json() if self.second is not None else None}
+
+    def __str__(self) -> str:
+        lines = [f"First difference at page {self.page_index}" + (f" ({', '.join(self.fields)})" if self.fields else '')]
+        for name, page in [('first', self.first), ('second', self.second)]:
+            lines.append(f"  {name}: {page if page is not None else 'end of measurement'}")
+        lines.append(f"  inputs: {', '.join(self.inputs) if self.inputs else 'none'}")
+        return '\n'.join(lines)
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _Stream(object):
+    """
+    Measurement running in a thread, passing the records of the pages it
+    measures to the comparison through a bounded queue.
+    """
+
+    def __init__(self, request: MeasurementRequest, workers: int, digest_cache: Optional[DigestCache],
+                 stop: threading.Event):
+        self._request = request
+        self._workers = workers
+        self._digest_cache = digest_cache
+        self._stop = stop
+        self._queue: 'queue.Queue[Any]' = queue.Queue(QUEUE_CHUNKS)
+        self._chunk: List[JournalRecord] = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __call__(self, page_type: int, gpa: int, contents: bytes, ld: bytes) -> None:
+        self._chunk.append(JournalRecord(page_type, gpa, contents, ld))
+        if len(self._chunk) >= CHUNK_PAGES:
+            self._put(self._chunk)
+            self._chunk = []
+
+    def _put(self, item: Any) -> None:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self) -> None:
+        try:
+            with gctx.observing(self):
+                _measure(self._request, self._workers, self._digest_cache)
+            if self._chunk:
+                self._put(self._chunk)
+            self._put(None)
+        except _Stopped:
+            pass
+        except Exception as e:
+            try:
+                self._put(e)
+            except _Stopped:
+                pass
+
+    def chunks(self) -> Iterator[List[JournalRecord]]:
+        """
+        Yield the chunks of records of the measurement, raising the exception
+        it failed with, if any.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def _measure(request: MeasurementRequest, workers: int, digest_cache: Optional[DigestCache]) -> None:
+    # No checkpoint cache: the pages measured before a checkpoint must be
+    # seen by the observer
+    if request.mode == OVMF_HASH_MODE:
+        guest.calc_snp_ovmf_hash(request.ovmf, workers=workers)
+        return
+    guest.calc_launch_digest(SevMode[request.mode], request.vcpus, request.vcpu_sig, request.ovmf, request.kernel,
+                             request.initrd, request.append, request.guest_features, request.snp_ovmf_hash,
+                             request.vmm_type, svsm_file=request.svsm, ovmf_vars_size=request.vars_size,
+                             workers=workers, digest_cache=digest_cache)
+
+
+def diff_measurements(first: MeasurementRequest, second: MeasurementRequest, workers: int = 1,
+                      digest_cache: Optional[DigestCache] = None) -> Optional[MeasurementDiff]:
+    """
+    Find the first page whose PAGE_INFO differs between the SNP measurements
+    of the requests first and second (in the snp, snp:svsm or snp:ovmf-hash
+    modes), or return None if they measure the same pages.
+
+    Both measurements run side by side in threads, each passing the records
+    of the pages it measures through a bounded queue, and stop at the first
+    difference, so only a few chunks of records are held in memory.
+    """
+    for request in [first, second]:
+        if request.mode not in [SevMode.SEV_SNP.name, SevMode.SEV_SNP_SVSM.name, OVMF_HASH_MODE]:
+            raise ValueError("diff only works with the snp, snp:svsm and snp:ovmf-hash modes")
+    stop = threading.Event()
+    streams = [_Stream(request, workers, digest_cache, stop) for request in [first, second]]
+    for stream in streams:
+        stream.thread.start()
+    try:
+        found = _first_difference(streams[0].chunks(), streams[1].chunks())
+    finally:
+        stop.set()
+        for stream in streams:
+            stream.thread.join()
+    if found is None:
+        return None
+    index, first_record, second_record = found
+    return _describe(index, first, first_record, second, second_record)
+
+
+def _first_difference(first: Iterator[List[JournalRecord]], second: Iterator[List[JournalRecord]]) \
+        -> Optional[Tuple[int, Optional[JournalRecord], Optional[JournalRecord]]]:
+    """
+    Return the index of the first record differing between the chunks first
+    and second, and the records at that index (None past the end).
+    """
+    index = 0
+    while True:
+        a = next(first, [])
+        b = next(second, [])
+        if not a and not b:
+            return None
+        # Each launch digest covers all the pages before it, so aligned
+        # chunks ending with the same one are the same
+        if len(a) == len(b) and a[-1].ld == b[-1].ld:
+            index += len(a)
+            continue
+        for i in range(min(len(a), len(b))):
+            if a[i].ld != b[i].ld:
+                return index + i, a[i], b[i]
+        i = min(len(a), len(b))
+        return index + i, a[i] if i < len(a) else None, b[i] if i < len(b) else None
+
+
+def _describe(index: int, first: MeasurementRequest, first_record: Optional[JournalRecord],
+              second: MeasurementRequest, second_record: Optional[JournalRecord]) -> MeasurementDiff:
+    first_page = _locate(first, first_record) if first_record is not None else None
+    second_page = _locate(second, second_record) if second_record is not None else None
+    fields: Tuple[str, ...] = ()
+    if first_record is not None and second_record is not None:
+        fields = tuple(field for field in ['page_type', 'gpa', 'contents']
+                       if getattr(first_record, field) != getattr(second_record, field)) or ('ld',)
+    relevant: Set[str] = set()
+    if fields == ('ld',):
+        # Only the launch digests before the first page differ: the firmware
+        # (or its precalculated hash)
+        relevant.update(_REGION_INPUTS[FIRMWARE])
+    for page in [first_page, second_page]:
+        if page is not None:
+            relevant.update(page.inputs())
+    inputs = tuple(field for field in MeasurementRequest._fields
+                   if field in relevant and getattr(first, field) != getattr(second, field))
+    return MeasurementDiff(index, first_page, second_page, fields, inputs)
+
+
+def _locate(request: MeasurementRequest, record: JournalRecord) -> DiffPage:
+    """
+    Return the page of record, measured by request, with the region and SEV
+    metadata section it belongs to.
+    """
+    if record.page_type == PageType.VMSA:
+        return DiffPage(record, VMSA_REGION, None)
+    with OVMF(request.ovmf, lazy=True) as ovmf:
+        if ovmf.gpa() <= record.gpa < ovmf.end_gpa():
+            return DiffPage(record, FIRMWARE, None)
+        metadata = ovmf.metadata_items()
+        if request.mode == SevMode.SEV_SNP_SVSM.name:
+            with SVSM(request.svsm, end_at=ovmf.gpa() - request.vars_size, lazy=True) as svsm:
+                if svsm.gpa() <= record.gpa < svsm.end_gpa():
+                    return DiffPage(record, SVSM_REGION, None)
+                metadata = svsm.metadata_items()
+    for desc in metadata:
+        if desc.gpa <= record.gpa < desc.gpa + desc.size:
+            return DiffPage(record, METADATA, desc)
+    return DiffPage(record, FIRMWARE, None)
@@ -3,10 +3,22 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
+import collections
+import contextlib
+import contextvars
+import enum
 import hashlib
+import itertools
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from . import metrics
 
 LD_SIZE = hashlib.sha384().digest_size
 ZEROS = bytes(LD_SIZE)
+PAGE_SIZE = 4096
 
 
 def le8(n: int) -> bytes:
@@ -25,10 +37,87 @@ def le64(n: int) -> bytes:
     return n.to_bytes(8, byteorder='little')
 
 
-def sha384(buf: bytes) -> bytes:
+def sha384(buf) -> bytes:
     return hashlib.sha384(buf).digest()
 
 
+# SNP spec 8.17.2 Table 67 Layout of the PAGE_INFO structure
+PAGE_INFO_LEN = 0x70
+_DIGEST_OFFSET = 0
+_CONTENTS_OFFSET = LD_SIZE
+_PAGE_TYPE_OFFSET = 2 * LD_SIZE + 2
+_GPA_OFFSET = 2 * LD_SIZE + 8
+# length, page_type, is_imi, vmpl3_perms, vmpl2_perms, vmpl1_perms, reserved
+_PAGE_INFO_FIELDS = struct.Struct('<HBBBBBB')
+_GPA = struct.Struct('<Q')
+# Number of pages hashed by each task in pipelined update_normal_pages
+PIPELINE_BATCH_PAGES = 256
+# Binary GCTX snapshot: magic, version, pages, length of last_op; followed by
+# the launch digest and the UTF-8 last_op
+_SNAPSHOT_MAGIC = b'GCTX'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<4sBQH')
+
+# Called for every page measured with its page type, GPA, contents digest and
+# the launch digest after it
+Observer = Callable[[int, int, bytes, bytes], None]
+
+# Observer of the GCTXs created without one, set by observing()
+_default_observer: 'contextvars.ContextVar[Optional[Observer]]' = \
+    contextvars.ContextVar('sevsnpmeasure_gctx_observer', default=None)
+
+
+class PageType(enum.IntEnum):
+    NORMAL = 0x01
+    VMSA = 0x02
+    ZERO = 0x03
+    UNMEASURED = 0x04
+    SECRETS = 0x05
+    CPUID = 0x06
+
+
+class GCTXSnapshot(NamedTuple):
+    """
+    State of a GCTX chain: the launch digest, the number of pages measured so
+    far and a description of the last update.  Snapshots can be serialized to
+    a compact binary form or to JSON, to resume or hand off a computation.
+    """
+    ld: bytes
+    pages: int
+    last_op: str
+
+    def to_bytes(self) -> bytes:
+        op = self.last_op.encode()
+        return _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, self.pages, len(op)) + self.ld + op
+
+    @classmethod
+    def from_bytes(cls, buf: bytes) -> 'GCTXSnapshot':
+        header_size = _SNAPSHOT_HEADER.size
+        if len(buf) < header_size:
+            raise ValueError("GCTX snapshot too short")
+        magic, version, pages, op_len = _SNAPSHOT_HEADER.unpack_from(buf)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise ValueError("Not a GCTX snapshot")
+        if len(buf) != header_size + LD_SIZE + op_len:
+            raise ValueError("Wrong GCTX snapshot size")
+        ld = bytes(buf[header_size:header_size + LD_SIZE])
+        return cls(ld, pages, bytes(buf[header_size + LD_SIZE:]).decode())
+
+    def to_json(self) -> str:
+        return json.dumps({'version': _SNAPSHOT_VERSION, 'ld': self.ld.hex(), 'pages': self.pages,
+                           'last_op': self.last_op})
+
+    @classmethod
+    def from_json(cls, s: str) -> 'GCTXSnapshot':
+        obj = json.loads(s)
+        if not isinstance(obj, dict) or obj.get('version') != _SNAPSHOT_VERSION:
+            raise ValueError("Not a GCTX snapshot")
+        ld = bytes.fromhex(obj['ld'])
+        if len(ld) != LD_SIZE:
+            raise ValueError("Wrong GCTX snapshot digest size")
+        return cls(ld, int(obj['pages']), str(obj['last_op']))
+
+
 class GCTX(object):
     """
     SNP Guest Context
@@ -39,8 +128,20 @@ class GCTX(object):
     # 51 are cleared.
     VMSA_GPA = 0xFFFFFFFFF000
 
-    def __init__(self, seed: bytes = ZEROS):
+    def __init__(self, seed: bytes = ZEROS, pages: int = 0, last_op: str = '',
+                 observer: Optional[Observer] = None):
         self._ld = seed
+        # Measurements take a slower path which reports every page when an
+        # observer is set
+        self.observer = observer if observer is not None else _default_observer.get()
+        # Number of pages measured so far, and the last update as
+        # (page_type, gpa, pages); formatted only when a snapshot is taken.
+        self._pages = pages
+        self._last_op: Optional[Tuple[int, int, int]] = None
+        self._initial_op = last_op
+        # A single PAGE_INFO record which is filled in place for every page
+        self._page_info = bytearray(PAGE_INFO_LEN)
+        _PAGE_INFO_FIELDS.pack_into(self._page_info, 2 * LD_SIZE, PAGE_INFO_LEN, 0, 0, 0, 0, 0, 0)
 
     def ld(self) -> bytes:
         return self._ld
@@ -48,48 +149,205 @@ class GCTX(object):
     def hex_ld(self) -> str:
         return self._ld.hex()
 
-    def _update(self, page_type, gpa, contents):
+    def pages(self) -> int:
+        return self._pages
+
+    def last_op(self) -> str:
+        if self._last_op is None:
+            return self._initial_op
+        page_type, gpa, pages = self._last_op
+        return f"{PageType(page_type).name} gpa=0x{gpa:x} pages={pages}"
+
+    def snapshot(self) -> 'GCTXSnapshot':
+        return GCTXSnapshot(self._ld, self._pages, self.last_op())
+
+    @classmethod
+    def restore(cls, snapshot: 'GCTXSnapshot') -> 'GCTX':
+        return cls(seed=snapshot.ld, pages=snapshot.pages, last_op=snapshot.last_op)
+
+    def fork(self) -> 'GCTX':
+        """
+        Return an independent GCTX in the same state, to branch measurements
+        from a shared prefix.
+        """
+        return GCTX.restore(self.snapshot())
+
+    def _record(self, page_type: int, gpa: int, pages: int) -> None:
+        self._pages += pages
+        self._last_op = (page_type, gpa, pages)
+        if metrics.recording():
+            metrics.count_pages(PageType(page_type).name, pages)
+
+    def _update(self, page_type: int, gpa: int, contents: bytes) -> None:
         assert len(contents) == LD_SIZE
-        page_info_len = 0x70
-        is_imi = 0
-        vmpl3_perms = vmpl2_perms = vmpl1_perms = 0
-        # SNP spec 8.17.2 Table 67 Layout of the PAGE_INFO structure
-        page_info = self._ld + contents
-        page_info += le16(page_info_len) + le8(page_type) + le8(is_imi)
-        page_info += le8(vmpl3_perms) + le8(vmpl2_perms) + le8(vmpl1_perms) + le8(0)
-        page_info += le64(gpa)
-        assert len(page_info) == page_info_len
-        # Update the launch digest
-        self._ld = sha384(page_info)
-
-    def update_normal_pages(self, start_gpa, data):
-        assert len(data) % 4096 == 0
-        offset = 0
-        while offset < len(data):
-            page_data = data[offset:offset+4096]
-            self._update(0x01, start_gpa + offset, sha384(page_data))
-            offset += 4096
-
-    def update_vmsa_page(self, data):
-        assert len(data) == 4096
-        self._update(0x02, self.VMSA_GPA, sha384(data))
-
-    def update_zero_pages(self, gpa, length_bytes):
-        assert length_bytes % 4096 == 0
-        offset = 0
-        while offset < length_bytes:
-            self._update(0x03, gpa + offset, ZEROS)
-            offset += 4096
-
-    def update_unmeasured_pages(self, gpa, length_bytes):
-        assert length_bytes % 4096 == 0
-        offset = 0
-        while offset < length_bytes:
-            self._update(0x04, gpa + offset, ZEROS)
-            offset += 4096
-
-    def update_secrets_page(self, gpa):
-        self._update(0x05, gpa, ZEROS)
-
-    def update_cpuid_page(self, gpa):
-        self._update(0x06, gpa, ZEROS)
+        self._update_range(page_type, gpa, PAGE_SIZE, contents)
+
+    def _update_range(self, page_type: int, gpa: int, length_bytes: int, contents: bytes) -> None:
+        """
+        Measure length_bytes/4096 consecutive pages which all share the same
+        page type and contents digest.
+        """
+        if self.observer is not None:
+            self._observed_update_pages(page_type, gpa, itertools.repeat(contents, length_bytes // PAGE_SIZE))
+            return
+        page_info = self._page_info
+        page_info[_CONTENTS_OFFSET:_CONTENTS_OFFSET + LD_SIZE] = contents
+        page_info[_PAGE_TYPE_OFFSET] = page_type
+        pack_gpa = _GPA.pack_into
+        new_sha384 = hashlib.sha384
+        ld = self._ld
+        for page_gpa in range(gpa, gpa + length_bytes, PAGE_SIZE):
+            page_info[_DIGEST_OFFSET:_DIGEST_OFFSET + LD_SIZE] = ld
+            pack_gpa(page_info, _GPA_OFFSET, page_gpa)
+            ld = new_sha384(page_info).digest()
+        self._ld = ld
+        self._record(page_type, gpa, length_bytes // PAGE_SIZE)
+
+    def _update_pages(self, page_type: int, start_gpa: int, digests: Iterable[bytes]) -> None:
+        """
+        Measure consecutive pages whose contents digests are given in order.
+        """
+        if self.observer is not None:
+            self._observed_update_pages(page_type, start_gpa, digests)
+            return
+        page_info = self._page_info
+        page_info[_PAGE_TYPE_OFFSET] = page_type
+        pack_gpa = _GPA.pack_into
+        new_sha384 = hashlib.sha384
+        ld = self._ld
+        gpa = start_gpa
+        for contents in digests:
+            page_info[_DIGEST_OFFSET:_DIGEST_OFFSET + LD_SIZE] = ld
+            page_info[_CONTENTS_OFFSET:_CONTENTS_OFFSET + LD_SIZE] = contents
+            pack_gpa(page_info, _GPA_OFFSET, gpa)
+            ld = new_sha384(page_info).digest()
+            gpa += PAGE_SIZE
+        self._ld = ld
+        self._record(page_type, start_gpa, (gpa - start_gpa) // PAGE_SIZE)
+
+    def _observed_update_pages(self, page_type: int, start_gpa: int, digests: Iterable[bytes]) -> None:
+        """
+        Same as _update_pages, reporting every page to the observer.
+        """
+        observer = self.observer
+        assert observer is not None
+        page_info = self._page_info
+        page_info[_PAGE_TYPE_OFFSET] = page_type
+        ld = self._ld
+        gpa = start_gpa
+        for contents in digests:
+            page_info[_DIGEST_OFFSET:_DIGEST_OFFSET + LD_SIZE] = ld
+            page_info[_CONTENTS_OFFSET:_CONTENTS_OFFSET + LD_SIZE] = contents
+            _GPA.pack_into(page_info, _GPA_OFFSET, gpa)
+            ld = sha384(page_info)
+            observer(page_type, gpa, contents, ld)
+            gpa += PAGE_SIZE
+        self._ld = ld
+        self._record(page_type, start_gpa, (gpa - start_gpa) // PAGE_SIZE)
+
+    def update_normal_pages(self, start_gpa: int, data, workers: int = 1) -> None:
+        """
+        Measure the pages of data.  With workers > 1 the contents of the pages
+        are hashed by a thread pool ahead of the (sequential) PAGE_INFO chain.
+        """
+        assert len(data) % PAGE_SIZE == 0
+        if workers > 1 and len(data) > PIPELINE_BATCH_PAGES * PAGE_SIZE:
+            with memoryview(data) as view:
+                self._update_pages(PageType.NORMAL, start_gpa, _pipelined_page_digests(view, workers))
+            return
+        if self.observer is not None:
+            with memoryview(data) as view:
+                self._observed_update_pages(PageType.NORMAL, start_gpa, (
+                    sha384(view[offset:offset + PAGE_SIZE]) for offset in range(0, len(view), PAGE_SIZE)))
+            return
+        page_info = self._page_info
+        page_info[_PAGE_TYPE_OFFSET] = PageType.NORMAL
+        pack_gpa = _GPA.pack_into
+        new_sha384 = hashlib.sha384
+        ld = self._ld
+        with memoryview(data) as view:
+            for offset in range(0, len(view), PAGE_SIZE):
+                page_info[_DIGEST_OFFSET:_DIGEST_OFFSET + LD_SIZE] = ld
+                page_info[_CONTENTS_OFFSET:_CONTENTS_OFFSET + LD_SIZE] = \
+                    new_sha384(view[offset:offset + PAGE_SIZE]).digest()
+                pack_gpa(page_info, _GPA_OFFSET, start_gpa + offset)
+                ld = new_sha384(page_info).digest()
+        self._ld = ld
+        self._record(PageType.NORMAL, start_gpa, len(data) // PAGE_SIZE)
+
+    def update_vmsa_page(self, data) -> None:
+        assert len(data) == PAGE_SIZE
+        self._update(PageType.VMSA, self.VMSA_GPA, sha384(data))
+
+    def update_vmsa_page_digest(self, digest: bytes) -> None:
+        """
+        Measure a VMSA page given the precomputed SHA-384 digest of its contents.
+        """
+        self._update(PageType.VMSA, self.VMSA_GPA, digest)
+
+    def update_vmsa_pages(self, pages) -> None:
+        for data in pages:
+            self.update_vmsa_page(data)
+
+    def update_zero_pages(self, gpa: int, length_bytes: int) -> None:
+        assert length_bytes % PAGE_SIZE == 0
+        self._update_range(PageType.ZERO, gpa, length_bytes, ZEROS)
+
+    def update_unmeasured_pages(self, gpa: int, length_bytes: int) -> None:
+        assert length_bytes % PAGE_SIZE == 0
+        self._update_range(PageType.UNMEASURED, gpa, length_bytes, ZEROS)
+
+    def update_secrets_page(self, gpa: int) -> None:
+        self._update(PageType.SECRETS, gpa, ZEROS)
+
+    def update_secrets_pages(self, gpa: int, length_bytes: int) -> None:
+        assert length_bytes % PAGE_SIZE == 0
+        self._update_range(PageType.SECRETS, gpa, length_bytes, ZEROS)
+
+    def update_cpuid_page(self, gpa: int) -> None:
+        self._update(PageType.CPUID, gpa, ZEROS)
+
+    def update_cpuid_pages(self, gpa: int, length_bytes: int) -> None:
+        assert length_bytes % PAGE_SIZE == 0
+        self._update_range(PageType.CPUID, gpa, length_bytes, ZEROS)
+
+
+@contextlib.contextmanager
+def observing(observer: Observer):
+    """
+    Set observer as the observer of the GCTXs created in the block (in the
+    current context).  Launch digests seeded from cached checkpoints don't
+    report the pages measured before the checkpoint.
+    """
+    token = _default_observer.set(observer)
+    try:
+        yield observer
+    finally:
+        _default_observer.reset(token)
+
+
+def _page_digests(view: memoryview) -> List[bytes]:
+    return [sha384(view[offset:offset + PAGE_SIZE]) for offset in range(0, len(view), PAGE_SIZE)]
+
+
+def _pipelined_page_digests(view: memoryview, workers: int) -> Iterator[bytes]:
+    """
+    Yield the SHA-384 digest of every page of view, in order, hashing batches
+    of pages on a thread pool (hashlib releases the GIL for page-sized input).
+    At most 2 * workers batches are in flight at any time.
+    """
+    batch_size = PIPELINE_BATCH_PAGES * PAGE_SIZE
+    offsets = iter(range(0, len(view), batch_size))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(executor.submit(_page_digests, view[offset:offset + batch_size])
+                                    for offset in itertools.islice(offsets, 2 * workers))
+        try:
+            while pending:
+                digests = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(_page_digests, view[offset:offset + batch_size]))
+                yield from digests
+        finally:
+            for future in pending:
+                future.cancel()
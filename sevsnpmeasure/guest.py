@@ -5,12 +5,14 @@
 
 import hashlib
 import pathlib
-from typing import Optional
+from typing import Collection, Dict, Optional, Tuple
 
+from . import metrics
+from .cache import CheckpointCache, DigestCache
 from .gctx import GCTX
 from .ovmf import OVMF, SectionType, OvmfSevMetadataSectionDesc, SVSM
 from .sev_hashes import SevHashes
-from .vmsa import VMSA, VMSA_SVSM
+from .vmsa import VMSA, VMSA_SVSM, VMSAPages
 from .sev_mode import SevMode
 from .vmm_types import VMMType
 
@@ -20,26 +22,100 @@ PAGE_MASK = 0xfff
 def calc_launch_digest(mode: SevMode, vcpus: int, vcpu_sig: int, ovmf_file: str,
                        kernel: str, initrd: str, append: str, guest_features: int, snp_ovmf_hash_str: str = '',
                        vmm_type: VMMType = VMMType.QEMU, dump_vmsa: bool = False, svsm_file: str = '',
-                       ovmf_vars_size: int = 0) -> bytes:
+                       ovmf_vars_size: int = 0, workers: int = 1,
+                       digest_cache: Optional[DigestCache] = None,
+                       checkpoint_cache: Optional[CheckpointCache] = None,
+                       timings: Optional[metrics.Timings] = None) -> bytes:
+    """
+    Calculate the launch digest of a guest.  If timings is given, the time
+    spent in each stage of the measurement is recorded into it.
+    """
+    with metrics.record_timings(timings):
+        return _calc_launch_digest(mode, vcpus, vcpu_sig, ovmf_file, kernel, initrd, append, guest_features,
+                                   snp_ovmf_hash_str, vmm_type, dump_vmsa, svsm_file, ovmf_vars_size, workers,
+                                   digest_cache, checkpoint_cache)
+
+
+def _calc_launch_digest(mode: SevMode, vcpus: int, vcpu_sig: int, ovmf_file: str,
+                        kernel: str, initrd: str, append: str, guest_features: int, snp_ovmf_hash_str: str,
+                        vmm_type: VMMType, dump_vmsa: bool, svsm_file: str, ovmf_vars_size: int, workers: int,
+                        digest_cache: Optional[DigestCache],
+                        checkpoint_cache: Optional[CheckpointCache]) -> bytes:
     if snp_ovmf_hash_str and mode != SevMode.SEV_SNP:
         raise ValueError("SNP OVMF hash only works with SNP")
 
     if mode == SevMode.SEV_SNP:
         return snp_calc_launch_digest(vcpus, vcpu_sig, ovmf_file, kernel, initrd, append, guest_features,
-                                      snp_ovmf_hash_str, vmm_type, dump_vmsa=dump_vmsa)
+                                      snp_ovmf_hash_str, vmm_type, dump_vmsa=dump_vmsa, workers=workers,
+                                      digest_cache=digest_cache, checkpoint_cache=checkpoint_cache)
     elif mode == SevMode.SEV_ES:
         return seves_calc_launch_digest(vcpus, vcpu_sig, ovmf_file, kernel, initrd, append,
-                                        vmm_type=vmm_type, dump_vmsa=dump_vmsa)
+                                        vmm_type=vmm_type, dump_vmsa=dump_vmsa, digest_cache=digest_cache)
     elif mode == SevMode.SEV:
-        return sev_calc_launch_digest(ovmf_file, kernel, initrd, append)
+        return sev_calc_launch_digest(ovmf_file, kernel, initrd, append, digest_cache=digest_cache)
     elif mode == SevMode.SEV_SNP_SVSM:
         if vmm_type != VMMType.QEMU:
             raise AssertionError("SVSM mode is only implemented for Qemu.")
-        return svsm_calc_launch_digest(vcpus, vcpu_sig, ovmf_file, ovmf_vars_size, svsm_file, dump_vmsa)
+        return svsm_calc_launch_digest(vcpus, vcpu_sig, ovmf_file, ovmf_vars_size, svsm_file, dump_vmsa,
+                                       workers=workers, checkpoint_cache=checkpoint_cache)
     else:
         raise ValueError("unknown mode")
 
 
+def calc_launch_digests(mode: SevMode, vcpus: range, vcpu_sig: int, ovmf_file: str,
+                        kernel: str, initrd: str, append: str, guest_features: int, snp_ovmf_hash_str: str = '',
+                        vmm_type: VMMType = VMMType.QEMU, dump_vmsa: bool = False, svsm_file: str = '',
+                        ovmf_vars_size: int = 0, workers: int = 1,
+                        digest_cache: Optional[DigestCache] = None,
+                        checkpoint_cache: Optional[CheckpointCache] = None,
+                        timings: Optional[metrics.Timings] = None) -> Dict[int, bytes]:
+    """
+    Same as calc_launch_digest for every number of vCPUs in the vcpus range,
+    in a single pass: the VMSA pages are measured last, so the launch digest
+    for N vCPUs is an intermediate state of the computation for N+1 vCPUs.
+    Returns a dict mapping each number of vCPUs to its launch digest.
+    """
+    with metrics.record_timings(timings):
+        return _calc_launch_digests(mode, vcpus, vcpu_sig, ovmf_file, kernel, initrd, append, guest_features,
+                                    snp_ovmf_hash_str, vmm_type, dump_vmsa, svsm_file, ovmf_vars_size, workers,
+                                    digest_cache, checkpoint_cache)
+
+
+def _calc_launch_digests(mode: SevMode, vcpus: range, vcpu_sig: int, ovmf_file: str,
+                         kernel: str, initrd: str, append: str, guest_features: int, snp_ovmf_hash_str: str,
+                         vmm_type: VMMType, dump_vmsa: bool, svsm_file: str, ovmf_vars_size: int, workers: int,
+                         digest_cache: Optional[DigestCache],
+                         checkpoint_cache: Optional[CheckpointCache]) -> Dict[int, bytes]:
+    check_vcpus_range(vcpus)
+    if snp_ovmf_hash_str and mode != SevMode.SEV_SNP:
+        raise ValueError("SNP OVMF hash only works with SNP")
+
+    if mode == SevMode.SEV_SNP:
+        gctx, ovmf = snp_pre_vmsa_gctx(ovmf_file, kernel, initrd, append, snp_ovmf_hash_str, vmm_type,
+                                       workers, digest_cache, checkpoint_cache)
+        vmsa = VMSA(SevMode.SEV_SNP, ovmf.sev_es_reset_eip(), vcpu_sig, guest_features, vmm_type)
+        return snp_vmsa_launch_digests(gctx, vmsa, vcpus, dump_vmsa)
+    elif mode == SevMode.SEV_ES:
+        launch_hash, eip = seves_pre_vmsa_hash(ovmf_file, kernel, initrd, append, digest_cache)
+        vmsa = VMSA(SevMode.SEV_ES, eip, vcpu_sig, 0x0, vmm_type)
+        return seves_vmsa_launch_digests(launch_hash, vmsa, vcpus, dump_vmsa)
+    elif mode == SevMode.SEV:
+        ld = sev_calc_launch_digest(ovmf_file, kernel, initrd, append, digest_cache=digest_cache)
+        return {n: ld for n in vcpus}
+    elif mode == SevMode.SEV_SNP_SVSM:
+        if vmm_type != VMMType.QEMU:
+            raise AssertionError("SVSM mode is only implemented for Qemu.")
+        gctx, eip = svsm_pre_vmsa_gctx(ovmf_file, ovmf_vars_size, svsm_file, workers, checkpoint_cache)
+        return snp_vmsa_launch_digests(gctx, VMSA_SVSM(eip, vcpu_sig), vcpus, dump_vmsa)
+    else:
+        raise ValueError("unknown mode")
+
+
+def check_vcpus_range(vcpus: range) -> None:
+    if len(vcpus) == 0 or vcpus.start < 1 or vcpus.step < 1:
+        raise ValueError("vcpus range must be non-empty, ascending and start at 1 or more")
+
+
 def snp_update_kernel_hashes(gctx: GCTX, ovmf: OVMF, sev_hashes: Optional[SevHashes], gpa: int, size: int) -> None:
     if sev_hashes:
         sev_hashes_table_gpa = ovmf.sev_hashes_table_gpa()
@@ -71,33 +147,188 @@ def snp_update_section(desc: OvmfSevMetadataSectionDesc, gctx: GCTX, ovmf: OVMF,
         raise ValueError("unknown OVMF metadata section type")
 
 
-def snp_update_metadata_pages(gctx: GCTX, ovmf: OVMF, sev_hashes: Optional[SevHashes], vmm_type: VMMType) -> None:
-    for desc in ovmf.metadata_items():
-        snp_update_section(desc, gctx, ovmf, sev_hashes, vmm_type)
+def snp_update_metadata_pages(gctx: GCTX, ovmf: OVMF, sev_hashes: Optional[SevHashes], vmm_type: VMMType,
+                              start: int = 0) -> None:
+    """
+    Measure the SEV metadata sections of ovmf, starting with section number
+    start (all previous sections must already have been measured).
+    """
+    for desc in ovmf.metadata_items()[start:]:
+        with metrics.stage('metadata_section', _section_detail(desc)):
+            snp_update_section(desc, gctx, ovmf, sev_hashes, vmm_type)
 
     if vmm_type == VMMType.ec2:
-        for desc in ovmf.metadata_items():
-            if desc.section_type() == SectionType.CPUID:
+        for desc in ovmf.metadata_items_of_type(SectionType.CPUID):
+            with metrics.stage('metadata_section', _section_detail(desc)):
                 gctx.update_cpuid_page(desc.gpa)
 
     if sev_hashes is not None and not ovmf.has_metadata_section(SectionType.SNP_KERNEL_HASHES):
         raise RuntimeError("Kernel specified but OVMF metadata doesn't include SNP_KERNEL_HASHES section")
 
 
-def calc_snp_ovmf_hash(ovmf_file: str) -> bytes:
-    ovmf = OVMF(ovmf_file)
-
+def _section_detail(desc: OvmfSevMetadataSectionDesc) -> str:
+    return f"{desc.section_type().name} gpa=0x{desc.gpa:x} size=0x{desc.size:x}"
+
+
+def snp_kernel_hashes_section_index(ovmf: OVMF) -> int:
+    """
+    Return the index of the first SNP_KERNEL_HASHES metadata section (or the
+    number of sections if there is none); the chain before it doesn't depend
+    on the kernel, initrd and command line.
+    """
+    for i, desc in enumerate(ovmf.metadata_items()):
+        if desc.section_type_int == SectionType.SNP_KERNEL_HASHES.value:
+            return i
+    return len(ovmf.metadata_items())
+
+
+def snp_firmware_gctx(ovmf: OVMF, workers: int = 1, checkpoint_cache: Optional[CheckpointCache] = None,
+                      firmware_key: str = '') -> GCTX:
+    """
+    Return a GCTX after measuring the pages of the firmware, reusing a cached
+    checkpoint if available.
+    """
+    if checkpoint_cache is not None:
+        ld = checkpoint_cache.get_ld(f"snp-firmware:{firmware_key}")
+        if ld is not None:
+            return GCTX(seed=ld)
     gctx = GCTX()
-    gctx.update_normal_pages(ovmf.gpa(), ovmf.data())
+    with metrics.stage('firmware_pages'):
+        gctx.update_normal_pages(ovmf.gpa(), ovmf.data(), workers=workers)
+    if checkpoint_cache is not None:
+        checkpoint_cache.put_ld(f"snp-firmware:{firmware_key}", gctx.ld())
+    return gctx
+
+
+def snp_checkpointed_metadata_gctx(gctx: GCTX, ovmf: OVMF, sev_hashes: Optional[SevHashes], vmm_type: VMMType,
+                                   checkpoint_cache: CheckpointCache, firmware_key: str) -> GCTX:
+    """
+    Same as snp_update_metadata_pages on a GCTX holding the firmware
+    checkpoint of firmware_key, but reuses cached checkpoints of the
+    metadata sections which don't depend on the kernel hashes.  Returns the
+    resulting GCTX, which may not be gctx.
+    """
+    if sev_hashes is not None:
+        gctx, start = snp_pre_kernel_hashes_gctx(gctx, ovmf, vmm_type, checkpoint_cache, firmware_key)
+        snp_update_metadata_pages(gctx, ovmf, sev_hashes, vmm_type, start=start)
+        return gctx
+    name = f"snp-metadata:{firmware_key}:{vmm_type.name}"
+    ld = checkpoint_cache.get_ld(name)
+    if ld is not None:
+        return GCTX(seed=ld)
+    snp_update_metadata_pages(gctx, ovmf, None, vmm_type)
+    checkpoint_cache.put_ld(name, gctx.ld())
+    return gctx
+
+
+def snp_pre_kernel_hashes_gctx(gctx: GCTX, ovmf: OVMF, vmm_type: VMMType,
+                               checkpoint_cache: Optional[CheckpointCache] = None,
+                               firmware_key: str = '') -> Tuple[GCTX, int]:
+    """
+    Measure the metadata sections before the first SNP_KERNEL_HASHES section
+    after the firmware pages in gctx, reusing a cached checkpoint if
+    available.  Returns the resulting GCTX (which may not be gctx) and the
+    index of the section to continue from with snp_update_metadata_pages.
+    """
+    start = snp_kernel_hashes_section_index(ovmf)
+    name = f"snp-pre-kernel-hashes:{firmware_key}:{vmm_type.name}"
+    if checkpoint_cache is not None:
+        ld = checkpoint_cache.get_ld(name)
+        if ld is not None:
+            return GCTX(seed=ld), start
+    for desc in ovmf.metadata_items()[:start]:
+        snp_update_section(desc, gctx, ovmf, None, vmm_type)
+    if checkpoint_cache is not None:
+        checkpoint_cache.put_ld(name, gctx.ld())
+    return gctx, start
+
+
+def snp_update_vmsa_pages(gctx: GCTX, vmsa: VMSAPages, vcpus: int, dump_vmsa: bool = False) -> None:
+    with metrics.stage('vmsa_pages'):
+        for digest in vmsa.page_digests(vcpus):
+            gctx.update_vmsa_page_digest(digest)
+    if dump_vmsa:
+        dump_vmsa_pages(vmsa, vcpus)
+
+
+def snp_vmsa_launch_digests(gctx: GCTX, vmsa: VMSAPages, vcpus: Collection[int],
+                            dump_vmsa: bool = False) -> Dict[int, bytes]:
+    """
+    Measure the VMSA pages for the largest number of vCPUs in vcpus, and
+    return the launch digest after the VMSA page of every number in vcpus
+    (in increasing order).
+    """
+    lds = {}
+    wanted = vcpus if isinstance(vcpus, range) else set(vcpus)
+    with metrics.stage('vmsa_pages'):
+        for n, digest in enumerate(vmsa.page_digests(max(vcpus)), start=1):
+            gctx.update_vmsa_page_digest(digest)
+            if n in wanted:
+                lds[n] = gctx.ld()
+    if dump_vmsa:
+        dump_vmsa_pages(vmsa, max(vcpus))
+    return lds
+
+
+def dump_vmsa_pages(vmsa: VMSAPages, vcpus: int) -> None:
+    for i, vmsa_page in enumerate(vmsa.pages(vcpus)):
+        pathlib.Path(f"vmsa{i}.bin").write_bytes(vmsa_page)
+
+
+def calc_snp_ovmf_hash(ovmf_file: str, workers: int = 1, checkpoint_cache: Optional[CheckpointCache] = None,
+                       timings: Optional[metrics.Timings] = None) -> bytes:
+    with metrics.record_timings(timings):
+        firmware_key = checkpoint_cache.firmware_key(ovmf_file) if checkpoint_cache is not None else ''
+        with OVMF(ovmf_file, lazy=checkpoint_cache is not None) as ovmf:
+            gctx = snp_firmware_gctx(ovmf, workers, checkpoint_cache, firmware_key)
     return gctx.ld()
 
 
 def snp_calc_launch_digest(vcpus: int, vcpu_sig: int, ovmf_file: str,
                            kernel: str, initrd: str, append: str, guest_features: int,
-                           ovmf_hash_str: str, vmm_type: VMMType = VMMType.QEMU, dump_vmsa: bool = False) -> bytes:
+                           ovmf_hash_str: str, vmm_type: VMMType = VMMType.QEMU, dump_vmsa: bool = False,
+                           workers: int = 1, digest_cache: Optional[DigestCache] = None,
+                           checkpoint_cache: Optional[CheckpointCache] = None) -> bytes:
+    gctx, ovmf = snp_pre_vmsa_gctx(ovmf_file, kernel, initrd, append, ovmf_hash_str, vmm_type,
+                                   workers, digest_cache, checkpoint_cache)
 
-    gctx = GCTX()
-    ovmf = OVMF(ovmf_file)
+    vmsa = VMSA(SevMode.SEV_SNP, ovmf.sev_es_reset_eip(), vcpu_sig, guest_features, vmm_type)
+    snp_update_vmsa_pages(gctx, vmsa, vcpus, dump_vmsa)
+
+    return gctx.ld()
+
+
+def snp_pre_vmsa_gctx(ovmf_file: str, kernel: str, initrd: str, append: str, ovmf_hash_str: str,
+                      vmm_type: VMMType = VMMType.QEMU, workers: int = 1,
+                      digest_cache: Optional[DigestCache] = None,
+                      checkpoint_cache: Optional[CheckpointCache] = None) -> Tuple[GCTX, OVMF]:
+    """
+    Return the GCTX after measuring everything but the VMSA pages of an SNP
+    guest (which come last), and the parsed firmware.
+    """
+    if ovmf_hash_str:
+        checkpoint_cache = None
+    gctx, ovmf, firmware_key = snp_firmware_prefix(ovmf_file, ovmf_hash_str, workers, checkpoint_cache)
+
+    sev_hashes = None
+    if kernel:
+        sev_hashes = SevHashes(kernel, initrd, append, digest_cache=digest_cache)
+
+    gctx = snp_metadata_gctx(gctx, ovmf, sev_hashes, vmm_type, checkpoint_cache, firmware_key)
+    return gctx, ovmf
+
+
+def snp_firmware_prefix(ovmf_file: str, ovmf_hash_str: str = '', workers: int = 1,
+                        checkpoint_cache: Optional[CheckpointCache] = None) -> Tuple[GCTX, OVMF, str]:
+    """
+    Return the GCTX after measuring the firmware pages (or seeded with the
+    precalculated ovmf_hash_str), the parsed firmware and its checkpoint key.
+    """
+    firmware_key = checkpoint_cache.firmware_key(ovmf_file) if checkpoint_cache is not None else ''
+    # With a precalculated OVMF hash (or a cached checkpoint) only the footer
+    # table and SEV metadata at the end of the file are needed, so don't read
+    # the whole firmware unless it has to be measured.
+    ovmf = OVMF(ovmf_file, lazy=bool(ovmf_hash_str) or checkpoint_cache is not None)
 
     # Allow users to provide a precalculated OVMF hash.
     # Ignores the contents of the OVMF file in front of us.
@@ -105,69 +336,124 @@ def snp_calc_launch_digest(vcpus: int, vcpu_sig: int, ovmf_file: str,
         ovmf_hash = bytes.fromhex(ovmf_hash_str)
         gctx = GCTX(seed=ovmf_hash)
     else:
-        gctx.update_normal_pages(ovmf.gpa(), ovmf.data())
+        gctx = snp_firmware_gctx(ovmf, workers, checkpoint_cache, firmware_key)
+    # The caller keeps ovmf for its metadata, which doesn't need the mapping
+    ovmf.close()
+    return gctx, ovmf, firmware_key
 
-    sev_hashes = None
-    if kernel:
-        sev_hashes = SevHashes(kernel, initrd, append)
 
-    snp_update_metadata_pages(gctx, ovmf, sev_hashes, vmm_type)
-
-    vmsa = VMSA(SevMode.SEV_SNP, ovmf.sev_es_reset_eip(), vcpu_sig, guest_features, vmm_type)
-    for i, vmsa_page in enumerate(vmsa.pages(vcpus)):
-        gctx.update_vmsa_page(vmsa_page)
-        if dump_vmsa:
-            pathlib.Path(f"vmsa{i}.bin").write_bytes(vmsa_page)
-
-    return gctx.ld()
+def snp_metadata_gctx(gctx: GCTX, ovmf: OVMF, sev_hashes: Optional[SevHashes], vmm_type: VMMType,
+                      checkpoint_cache: Optional[CheckpointCache] = None, firmware_key: str = '') -> GCTX:
+    """
+    Measure the SEV metadata sections of ovmf after the firmware pages in
+    gctx, and return the resulting GCTX (which may not be gctx).
+    """
+    with metrics.stage('metadata_sections'):
+        if checkpoint_cache is not None:
+            return snp_checkpointed_metadata_gctx(gctx, ovmf, sev_hashes, vmm_type, checkpoint_cache, firmware_key)
+        snp_update_metadata_pages(gctx, ovmf, sev_hashes, vmm_type)
+    return gctx
 
 
 def svsm_calc_launch_digest(vcpus: int, vcpu_sig: int, ovmf_file: str, ovmf_vars_size: int, svsm_file: str,
-                            dump_vmsa: bool) -> bytes:
+                            dump_vmsa: bool, workers: int = 1,
+                            checkpoint_cache: Optional[CheckpointCache] = None) -> bytes:
+    gctx, eip = svsm_pre_vmsa_gctx(ovmf_file, ovmf_vars_size, svsm_file, workers, checkpoint_cache)
 
-    gctx = GCTX()
-    ovmf = OVMF(ovmf_file)
-    svsm = SVSM(svsm_file, end_at=ovmf.gpa() - ovmf_vars_size)
+    vmsa = VMSA_SVSM(eip, vcpu_sig)
+    snp_update_vmsa_pages(gctx, vmsa, vcpus, dump_vmsa)
 
-    eip = svsm.sev_es_reset_eip()
+    return gctx.ld()
 
-    gctx.update_normal_pages(ovmf.gpa(), ovmf.data())
-    gctx.update_normal_pages(svsm.gpa(), svsm.data())
 
-    snp_update_metadata_pages(gctx, svsm, None, VMMType.QEMU)
+def svsm_pre_vmsa_gctx(ovmf_file: str, ovmf_vars_size: int, svsm_file: str, workers: int = 1,
+                       checkpoint_cache: Optional[CheckpointCache] = None) -> Tuple[GCTX, int]:
+    """
+    Return the GCTX after measuring everything but the VMSA pages of an
+    SNP guest with SVSM, and the SVSM reset EIP.
+    """
+    lazy = checkpoint_cache is not None
+    with OVMF(ovmf_file, lazy=lazy) as ovmf, SVSM(svsm_file, end_at=ovmf.gpa() - ovmf_vars_size, lazy=lazy) as svsm:
+        eip = svsm.sev_es_reset_eip()
+
+        name = ''
+        ld = None
+        if checkpoint_cache is not None:
+            name = f"snp-svsm:{checkpoint_cache.firmware_key(ovmf_file, svsm_file)}:{ovmf_vars_size}"
+            ld = checkpoint_cache.get_ld(name)
+        if ld is not None:
+            gctx = GCTX(seed=ld)
+        else:
+            gctx = GCTX()
+            with metrics.stage('firmware_pages'):
+                gctx.update_normal_pages(ovmf.gpa(), ovmf.data(), workers=workers)
+                gctx.update_normal_pages(svsm.gpa(), svsm.data(), workers=workers)
 
-    vmsa = VMSA_SVSM(eip, vcpu_sig)
-    for i, vmsa_page in enumerate(vmsa.pages(vcpus)):
-        gctx.update_vmsa_page(vmsa_page)
-        if dump_vmsa:
-            pathlib.Path(f"vmsa{i}.bin").write_bytes(vmsa_page)
+            with metrics.stage('metadata_sections'):
+                snp_update_metadata_pages(gctx, svsm, None, VMMType.QEMU)
+            if checkpoint_cache is not None:
+                checkpoint_cache.put_ld(name, gctx.ld())
 
-    return gctx.ld()
+    return gctx, eip
 
 
 def seves_calc_launch_digest(vcpus: int, vcpu_sig: int, ovmf_file: str, kernel: str, initrd: str, append: str,
-                             vmm_type: VMMType = VMMType.QEMU, dump_vmsa: bool = False) -> bytes:
-    ovmf = OVMF(ovmf_file)
-    launch_hash = hashlib.sha256(ovmf.data())
+                             vmm_type: VMMType = VMMType.QEMU, dump_vmsa: bool = False,
+                             digest_cache: Optional[DigestCache] = None) -> bytes:
+    launch_hash, eip = seves_pre_vmsa_hash(ovmf_file, kernel, initrd, append, digest_cache)
+    vmsa = VMSA(SevMode.SEV_ES, eip, vcpu_sig, 0x0, vmm_type)
+    with metrics.stage('vmsa_pages'):
+        for i, vmsa_page in enumerate(vmsa.pages(vcpus)):
+            launch_hash.update(vmsa_page)
+            if dump_vmsa:
+                pathlib.Path(f"vmsa{i}.bin").write_bytes(vmsa_page)
+    return launch_hash.digest()
+
+
+def seves_pre_vmsa_hash(ovmf_file: str, kernel: str, initrd: str, append: str,
+                        digest_cache: Optional[DigestCache] = None) -> Tuple['hashlib._Hash', int]:
+    """
+    Return the SEV-ES launch hash object after measuring everything but the
+    VMSA pages, and the reset EIP of the firmware.
+    """
+    with OVMF(ovmf_file) as ovmf:
+        with metrics.stage('firmware_pages'):
+            launch_hash = hashlib.sha256(ovmf.data())
     if kernel:
         if not ovmf.is_sev_hashes_table_supported():
             raise RuntimeError("Kernel specified but OVMF doesn't support kernel/initrd/cmdline measurement")
-        sev_hashes_table = SevHashes(kernel, initrd, append).construct_table()
+        sev_hashes_table = SevHashes(kernel, initrd, append, digest_cache=digest_cache).construct_table()
         launch_hash.update(sev_hashes_table)
-    vmsa = VMSA(SevMode.SEV_ES, ovmf.sev_es_reset_eip(), vcpu_sig, 0x0, vmm_type)
-    for i, vmsa_page in enumerate(vmsa.pages(vcpus)):
-        launch_hash.update(vmsa_page)
-        if dump_vmsa:
-            pathlib.Path(f"vmsa{i}.bin").write_bytes(vmsa_page)
-    return launch_hash.digest()
-
-
-def sev_calc_launch_digest(ovmf_file: str, kernel: str, initrd: str, append: str) -> bytes:
-    ovmf = OVMF(ovmf_file)
-    launch_hash = hashlib.sha256(ovmf.data())
+    return launch_hash, ovmf.sev_es_reset_eip()
+
+
+def seves_vmsa_launch_digests(launch_hash: 'hashlib._Hash', vmsa: VMSAPages, vcpus: Collection[int],
+                              dump_vmsa: bool = False) -> Dict[int, bytes]:
+    """
+    Measure the VMSA pages for the largest number of vCPUs in vcpus, and
+    return the launch digest after the VMSA page of every number in vcpus
+    (in increasing order).
+    """
+    lds = {}
+    wanted = vcpus if isinstance(vcpus, range) else set(vcpus)
+    with metrics.stage('vmsa_pages'):
+        for i, vmsa_page in enumerate(vmsa.pages(max(vcpus))):
+            launch_hash.update(vmsa_page)
+            if i + 1 in wanted:
+                lds[i + 1] = launch_hash.copy().digest()
+            if dump_vmsa:
+                pathlib.Path(f"vmsa{i}.bin").write_bytes(vmsa_page)
+    return lds
+
+
+def sev_calc_launch_digest(ovmf_file: str, kernel: str, initrd: str, append: str,
+                           digest_cache: Optional[DigestCache] = None) -> bytes:
+    with OVMF(ovmf_file) as ovmf:
+        with metrics.stage('firmware_pages'):
+            launch_hash = hashlib.sha256(ovmf.data())
     if kernel:
         if not ovmf.is_sev_hashes_table_supported():
             raise RuntimeError("Kernel specified but OVMF doesn't support kernel/initrd/cmdline measurement")
-        sev_hashes_table = SevHashes(kernel, initrd, append).construct_table()
+        sev_hashes_table = SevHashes(kernel, initrd, append, digest_cache=digest_cache).construct_table()
         launch_hash.update(sev_hashes_table)
     return launch_hash.digest()
@@ -0,0 +1,123 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import array
+import struct
+from typing import BinaryIO, Iterator, NamedTuple
+
+from .gctx import LD_SIZE, PageType
+
+# Binary journal: header (magic, version, digest size), then one record per
+# page measured until the end of the file
+JOURNAL_MAGIC = b'SNPJRNL\0'
+JOURNAL_VERSION = 1
+_JOURNAL_HEADER = struct.Struct('<8sHH')
+# page type, GPA, contents digest, launch digest
+_RECORD = struct.Struct(f'<BQ{LD_SIZE}s{LD_SIZE}s')
+
+
+class JournalRecord(NamedTuple):
+    """
+    A page measured into a launch digest: its page type, GPA, contents
+    digest, and the launch digest after it.
+    """
+    page_type: int
+    gpa: int
+    contents: bytes
+    ld: bytes
+
+    def __str__(self) -> str:
+        return f"{PageType(self.page_type).name} gpa=0x{self.gpa:x} contents={self.contents.hex()} ld={self.ld.hex()}"
+
+
+class MeasurementJournal(object):
+    """
+    Journal of the pages measured by a GCTX, used as its observer:
+
+        journal = MeasurementJournal()
+        with gctx.observing(journal):
+            guest.calc_launch_digest(...)
+
+    Records are stored in arrays (page types, GPAs and the concatenated
+    digests) rather than as Python objects, about 105 bytes per page.
+    """
+
+    def __init__(self) -> None:
+        self._page_types = array.array('B')
+        self._gpas = array.array('Q')
+        self._digests = bytearray()
+
+    def __call__(self, page_type: int, gpa: int, contents: bytes, ld: bytes) -> None:
+        self._page_types.append(page_type)
+        self._gpas.append(gpa)
+        self._digests += contents
+        self._digests += ld
+
+    def __len__(self) -> int:
+        return len(self._page_types)
+
+    def __getitem__(self, i: int) -> JournalRecord:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("journal record index out of range")
+        offset = 2 * LD_SIZE * i
+        return JournalRecord(self._page_types[i], self._gpas[i], bytes(self._digests[offset:offset + LD_SIZE]),
+                             bytes(self._digests[offset + LD_SIZE:offset + 2 * LD_SIZE]))
+
+    def __iter__(self) -> Iterator[JournalRecord]:
+        return (self[i] for i in range(len(self)))
+
+    def write(self, f: BinaryIO) -> None:
+        """
+        Write the journal to the binary file f.
+        """
+        writer = JournalWriter(f)
+        for record in self:
+            writer(*record)
+
+    @classmethod
+    def read(cls, f: BinaryIO) -> 'MeasurementJournal':
+        """
+        Read a journal written by write() or JournalWriter from the binary
+        file f.
+        """
+        journal = cls()
+        for record in read_journal(f):
+            journal(*record)
+        return journal
+
+
+class JournalWriter(object):
+    """
+    GCTX observer writing every page measured to the binary file f as it
+    goes, so journals don't have to be held in memory.
+    """
+
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        f.write(_JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, LD_SIZE))
+
+    def __call__(self, page_type: int, gpa: int, contents: bytes, ld: bytes) -> None:
+        self._f.write(_RECORD.pack(page_type, gpa, contents, ld))
+
+
+def read_journal(f: BinaryIO) -> Iterator[JournalRecord]:
+    """
+    Yield the records of a binary journal read from f, one at a time.
+    """
+    header = f.read(_JOURNAL_HEADER.size)
+    if len(header) != _JOURNAL_HEADER.size:
+        raise RuntimeError("Invalid measurement journal")
+    magic, version, digest_size = _JOURNAL_HEADER.unpack(header)
+    if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION or digest_size != LD_SIZE:
+        raise RuntimeError("Invalid measurement journal")
+    while True:
+        buf = f.read(_RECORD.size)
+        if not buf:
+            return
+        if len(buf) != _RECORD.size:
+            raise RuntimeError("Truncated measurement journal")
+        yield JournalRecord(*_RECORD.unpack(buf))
@@ -0,0 +1,206 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import json
+import mmap
+import os
+import pathlib
+import sqlite3
+import struct
+from typing import Dict, List, Optional, Union
+
+from .sweep import LaunchConfig
+from .vmm_types import VMMType
+
+# Index file layout: header, records sorted by digest (digest followed by the
+# u32 id of its configuration), and a JSON document holding the metadata and
+# the list of configurations.
+INDEX_MAGIC = b'SNPMIDX\0'
+INDEX_VERSION = 1
+# magic, version, digest size, number of records, JSON offset, JSON length
+_INDEX_HEADER = struct.Struct('<8sHHQQQ')
+_CONFIG_ID = struct.Struct('<I')
+
+SQLITE_MAGIC = b'SQLite format 3\0'
+
+
+def _config_to_json(config: LaunchConfig) -> list:
+    return [config.vcpus, config.vcpu_sig, config.guest_features, config.vmm_type.name]
+
+
+def _config_from_json(obj: list) -> LaunchConfig:
+    vcpus, vcpu_sig, guest_features, vmm_type = obj
+    return LaunchConfig(vcpus, vcpu_sig, guest_features, VMMType[vmm_type])
+
+
+def write_index(path: str, lds: Dict[LaunchConfig, bytes], metadata: Optional[dict] = None) -> None:
+    """
+    Write the launch digests of configurations to a memory-mappable index
+    file at path, which MeasurementIndex looks digests up in.  metadata (such
+    as the measured inputs) is stored along with the configurations.
+    """
+    configs = list(lds)
+    digest_size = len(lds[configs[0]]) if configs else 0
+    if any(len(ld) != digest_size for ld in lds.values()):
+        raise ValueError("all launch digests must have the same size")
+    records = sorted((ld, config_id) for config_id, ld in enumerate(lds.values()))
+    doc = json.dumps({'metadata': metadata or {}, 'configs': [_config_to_json(c) for c in configs]}).encode()
+    json_offset = _INDEX_HEADER.size + len(records) * (digest_size + _CONFIG_ID.size)
+
+    with open(path, 'wb') as f:
+        f.write(_INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, digest_size, len(records), json_offset, len(doc)))
+        for ld, config_id in records:
+            f.write(ld)
+            f.write(_CONFIG_ID.pack(config_id))
+        f.write(doc)
+
+
+def write_sqlite_index(path: str, lds: Dict[LaunchConfig, bytes], metadata: Optional[dict] = None) -> None:
+    """
+    Same as write_index, but write an SQLite database with an index on the
+    digests, which other tools can query.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    db = sqlite3.connect(path)
+    try:
+        with db:
+            db.execute("CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("CREATE TABLE configs (id INTEGER PRIMARY KEY, vcpus INTEGER, vcpu_sig INTEGER, "
+                       "guest_features INTEGER, vmm_type TEXT)")
+            db.execute("CREATE TABLE measurements (digest BLOB, config_id INTEGER)")
+            db.executemany("INSERT INTO metadata VALUES (?, ?)",
+                           ((key, json.dumps(value)) for key, value in (metadata or {}).items()))
+            db.executemany("INSERT INTO configs VALUES (?, ?, ?, ?, ?)",
+                           ((i, *_config_to_json(config)) for i, config in enumerate(lds)))
+            db.executemany("INSERT INTO measurements VALUES (?, ?)",
+                           ((ld, i) for i, ld in enumerate(lds.values())))
+            db.execute("CREATE INDEX measurements_digest ON measurements (digest)")
+    finally:
+        db.close()
+
+
+class MeasurementIndex(object):
+    """
+    Index file written by write_index, mapped read-only.  lookup() finds the
+    configurations producing a digest by binary search over the sorted
+    records, in logarithmic time and without reading the whole file.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _INDEX_HEADER.size:
+                raise RuntimeError("Invalid measurement index")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_header()
+        except BaseException:
+            self._mmap.close()
+            raise
+        self._doc: Optional[dict] = None
+
+    def _parse_header(self) -> None:
+        magic, version, digest_size, count, json_offset, json_length = _INDEX_HEADER.unpack_from(self._mmap)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise RuntimeError("Invalid measurement index")
+        self.digest_size = digest_size
+        self._record_size = digest_size + _CONFIG_ID.size
+        self._count = count
+        self._json_offset = json_offset
+        self._json_length = json_length
+        if _INDEX_HEADER.size + count * self._record_size != json_offset or \
+                json_offset + json_length != len(self._mmap):
+            raise RuntimeError("Invalid measurement index size")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _document(self) -> dict:
+        if self._doc is None:
+            self._doc = json.loads(self._mmap[self._json_offset:self._json_offset + self._json_length])
+        return self._doc
+
+    def metadata(self) -> dict:
+        return self._document()['metadata']
+
+    def _digest(self, i: int) -> bytes:
+        offset = _INDEX_HEADER.size + i * self._record_size
+        return self._mmap[offset:offset + self.digest_size]
+
+    def _config_id(self, i: int) -> int:
+        offset = _INDEX_HEADER.size + i * self._record_size + self.digest_size
+        return _CONFIG_ID.unpack_from(self._mmap, offset)[0]
+
+    def lookup(self, digest: bytes) -> List[LaunchConfig]:
+        """
+        Return the configurations whose launch digest is digest.
+        """
+        if len(digest) != self.digest_size:
+            return []
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        configs = self._document()['configs']
+        result = []
+        while lo < self._count and self._digest(lo) == digest:
+            result.append(_config_from_json(configs[self._config_id(lo)]))
+            lo += 1
+        return result
+
+
+class SQLiteMeasurementIndex(object):
+    """
+    Index database written by write_sqlite_index, with the same interface as
+    MeasurementIndex.
+    """
+
+    def __init__(self, path: str):
+        uri = pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+        self._db = sqlite3.connect(uri, uri=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM measurements").fetchone()[0]
+
+    def metadata(self) -> dict:
+        return {key: json.loads(value) for key, value in self._db.execute("SELECT key, value FROM metadata")}
+
+    def lookup(self, digest: bytes) -> List[LaunchConfig]:
+        rows = self._db.execute("SELECT configs.vcpus, configs.vcpu_sig, configs.guest_features, configs.vmm_type "
+                                "FROM measurements JOIN configs ON measurements.config_id = configs.id "
+                                "WHERE measurements.digest = ? ORDER BY configs.id", (digest,))
+        return [_config_from_json(list(row)) for row in rows]
+
+
+def open_index(path: str) -> Union[MeasurementIndex, SQLiteMeasurementIndex]:
+    """
+    Open an index file written by write_index or write_sqlite_index.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(SQLITE_MAGIC))
+    if magic == SQLITE_MAGIC:
+        return SQLiteMeasurementIndex(path)
+    return MeasurementIndex(path)
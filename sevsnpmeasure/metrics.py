@@ -0,0 +1,319 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import bisect
+import contextlib
+import contextvars
+import http.server
+import threading
+import time
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
+
+# Stages of a measurement whose latency is recorded
+STAGES = ('firmware_load', 'firmware_pages', 'metadata_sections', 'kernel_hashes', 'vmsa_pages')
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+PAGE_SIZE = 4096
+# Page types whose contents are hashed (the others are measured with a
+# fixed contents digest)
+HASHED_PAGE_TYPES = ('NORMAL', 'VMSA')
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed buckets, as exported to Prometheus.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # counts[i] is the number of observations in bucket i (the last one
+        # holds the observations above the largest bound)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    """
+    Counters of the measurements made by this process: the latency of each
+    stage, the pages measured per page type, the bytes read from input files
+    (and mapped, which are only read as pages are measured), the hits and
+    misses of each cache, and the requests of MeasurementLimiters by outcome.
+
+    Nothing is recorded unless the registry is enabled, and the
+    instrumentation only checks the enabled flag otherwise.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._latency: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+            self._pages: Dict[str, int] = {}
+            self._bytes_read = 0
+            self._bytes_mapped = 0
+            self._cache: Dict[Tuple[str, str], int] = {}
+            self._limiter: Dict[str, int] = {}
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._latency[stage].observe(seconds)
+
+    def count_pages(self, page_type: str, pages: int) -> None:
+        with self._lock:
+            self._pages[page_type] = self._pages.get(page_type, 0) + pages
+
+    def count_bytes_read(self, n: int) -> None:
+        with self._lock:
+            self._bytes_read += n
+
+    def count_bytes_mapped(self, n: int) -> None:
+        with self._lock:
+            self._bytes_mapped += n
+
+    def count_cache(self, cache: str, hit: bool) -> None:
+        key = (cache, 'hit' if hit else 'miss')
+        with self._lock:
+            self._cache[key] = self._cache.get(key, 0) + 1
+
+    def count_limiter(self, outcome: str) -> None:
+        with self._lock:
+            self._limiter[outcome] = self._limiter.get(outcome, 0) + 1
+
+    def render_prometheus(self) -> str:
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines: List[str] = []
+        with self._lock:
+            lines.append('# HELP sevsnpmeasure_stage_seconds Latency of the stages of measurements.')
+            lines.append('# TYPE sevsnpmeasure_stage_seconds histogram')
+            for stage, histogram in self._latency.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'sevsnpmeasure_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'sevsnpmeasure_stage_seconds_sum{{stage="{stage}"}} {histogram.sum!r}')
+                lines.append(f'sevsnpmeasure_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines.append('# HELP sevsnpmeasure_pages_total Pages measured, per page type.')
+            lines.append('# TYPE sevsnpmeasure_pages_total counter')
+            for page_type, pages in sorted(self._pages.items()):
+                lines.append(f'sevsnpmeasure_pages_total{{page_type="{page_type}"}} {pages}')
+            lines.append('# HELP sevsnpmeasure_read_bytes_total Bytes read from input files.')
+            lines.append('# TYPE sevsnpmeasure_read_bytes_total counter')
+            lines.append(f'sevsnpmeasure_read_bytes_total {self._bytes_read}')
+            lines.append('# HELP sevsnpmeasure_mapped_bytes_total Bytes of input files mapped into memory.')
+            lines.append('# TYPE sevsnpmeasure_mapped_bytes_total counter')
+            lines.append(f'sevsnpmeasure_mapped_bytes_total {self._bytes_mapped}')
+            lines.append('# HELP sevsnpmeasure_cache_requests_total Cache lookups, per cache and result.')
+            lines.append('# TYPE sevsnpmeasure_cache_requests_total counter')
+            for (cache, result), count in sorted(self._cache.items()):
+                lines.append(f'sevsnpmeasure_cache_requests_total{{cache="{cache}",result="{result}"}} {count}')
+            lines.append('# HELP sevsnpmeasure_limiter_requests_total Requests of measurement limiters, per outcome '
+                         '(computed, failed, coalesced, rejected, or queued before being computed).')
+            lines.append('# TYPE sevsnpmeasure_limiter_requests_total counter')
+            for outcome, count in sorted(self._limiter.items()):
+                lines.append(f'sevsnpmeasure_limiter_requests_total{{result="{outcome}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class StageTiming(object):
+    """
+    Wall and CPU time spent in a stage, and the pages measured and bytes
+    processed (read from input files, or page contents hashed) meanwhile.
+    Bytes of input files which are only mapped into memory are counted
+    separately, as they aren't read until they are hashed.
+    """
+
+    def __init__(self, name: str, detail: str):
+        self.name = name
+        self.detail = detail
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.pages = 0
+        self.bytes = 0
+        self.mapped_bytes = 0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {'stage': self.name, 'detail': self.detail, 'wall_s': self.wall, 'cpu_s': self.cpu,
+                'pages': self.pages, 'bytes': self.bytes, 'mapped_bytes': self.mapped_bytes,
+                'pages_per_s': self.pages / self.wall if self.wall else 0.0,
+                'mib_per_s': self.bytes / (1024 * 1024) / self.wall if self.wall else 0.0}
+
+
+class Timings(object):
+    """
+    Per-stage timing report of the measurements made while it is recorded
+    (see record_timings): the firmware load, firmware pages, each SEV
+    metadata section (within all the metadata sections), kernel hashes and
+    VMSA pages, in the order they ran, and the total.  CPU times are those
+    of the whole process.
+    """
+
+    def __init__(self) -> None:
+        self.stages: List[StageTiming] = []
+        self.total = StageTiming('total', '')
+        self._open: List[StageTiming] = [self.total]
+
+    def _count(self, pages: int, n: int, mapped: int = 0) -> None:
+        for timing in self._open:
+            timing.pages += pages
+            timing.bytes += n
+            timing.mapped_bytes += mapped
+
+    def to_json(self) -> Dict[str, Any]:
+        return {'stages': [timing.to_json() for timing in self.stages], 'total': self.total.to_json()}
+
+
+_timings: 'contextvars.ContextVar[Optional[Timings]]' = contextvars.ContextVar('sevsnpmeasure_timings', default=None)
+
+
+@contextlib.contextmanager
+def _record_timings(timings: Timings):
+    token = _timings.set(timings)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield timings
+    finally:
+        timings.total.wall += time.perf_counter() - wall
+        timings.total.cpu += time.process_time() - cpu
+        _timings.reset(token)
+
+
+def record_timings(timings: Optional[Timings]) -> ContextManager:
+    """
+    Return a context manager recording the stages of the measurements made
+    in its block (in the current context) into timings, or doing nothing if
+    timings is None.
+    """
+    return _NO_STAGE if timings is None else _record_timings(timings)
+
+
+class _Stage(object):
+    """
+    Context manager recording the latency of a stage in the registry and in
+    the current timings.
+    """
+
+    def __init__(self, name: str, detail: str, timings: Optional[Timings]):
+        self._name = name
+        self._detail = detail
+        self._timings = timings
+
+    def __enter__(self):
+        if self._timings is not None:
+            self._timing = StageTiming(self._name, self._detail)
+            self._timings.stages.append(self._timing)
+            self._timings._open.append(self._timing)
+            self._cpu = time.process_time()
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        wall = time.perf_counter() - self._start
+        if REGISTRY.enabled and self._name in STAGES:
+            REGISTRY.observe_stage(self._name, wall)
+        if self._timings is not None:
+            self._timing.wall = wall
+            self._timing.cpu = time.process_time() - self._cpu
+            self._timings._open.remove(self._timing)
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def stage(name: str, detail: str = '') -> ContextManager:
+    """
+    Return a context manager recording the latency of the stage name (one of
+    STAGES, or a part of one described by detail) around its block, or doing
+    nothing when neither metrics nor timings are recorded.
+    """
+    timings = _timings.get()
+    if timings is None and not REGISTRY.enabled:
+        return _NO_STAGE
+    return _Stage(name, detail, timings)
+
+
+def recording() -> bool:
+    """
+    Return whether metrics or timings are recorded.
+    """
+    return REGISTRY.enabled or _timings.get() is not None
+
+
+def count_pages(page_type: str, pages: int) -> None:
+    if REGISTRY.enabled:
+        REGISTRY.count_pages(page_type, pages)
+    timings = _timings.get()
+    if timings is not None:
+        timings._count(pages, pages * PAGE_SIZE if page_type in HASHED_PAGE_TYPES else 0)
+
+
+def count_bytes_read(n: int) -> None:
+    if REGISTRY.enabled:
+        REGISTRY.count_bytes_read(n)
+    timings = _timings.get()
+    if timings is not None:
+        timings._count(0, n)
+
+
+def count_bytes_mapped(n: int) -> None:
+    if REGISTRY.enabled:
+        REGISTRY.count_bytes_mapped(n)
+    timings = _timings.get()
+    if timings is not None:
+        timings._count(0, 0, n)
+
+
+def count_cache(cache: str, hit: bool) -> None:
+    if REGISTRY.enabled:
+        REGISTRY.count_cache(cache, hit)
+
+
+def count_limiter(outcome: str) -> None:
+    if REGISTRY.enabled:
+        REGISTRY.count_limiter(outcome)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP request handler serving REGISTRY in the Prometheus text format on
+    /metrics.
+    """
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
@@ -6,9 +6,18 @@
 import ctypes
 from ctypes import c_uint8, c_uint16, c_uint32
 from enum import Enum
+import functools
+import mmap
+import os
+import stat
+import struct
+from typing import Dict, List, Optional, Union
 import uuid
 
+from . import metrics
+
 FOUR_GB = 0x100000000
+PAGE_SIZE = 4096
 
 
 # Types of sections declared by OVMF SEV Metadata, as appears in:
@@ -57,24 +66,129 @@ class OvmfFooterTableEntry(ctypes.LittleEndianStructure):
     ]
 
 
+# Same layout as OvmfFooterTableEntry: size, guid
+_FOOTER_ENTRY = struct.Struct('<H16s')
+assert _FOOTER_ENTRY.size == ctypes.sizeof(OvmfFooterTableEntry)
+
+
+@functools.lru_cache(maxsize=None)
+def guid_bytes(guid: str) -> bytes:
+    """
+    Convert a GUID string to its little-endian binary form, as it appears in
+    the firmware.
+    """
+    return uuid.UUID("{" + guid + "}").bytes_le
+
+
+def _is_mappable(fd: int) -> bool:
+    st = os.fstat(fd)
+    return stat.S_ISREG(st.st_mode) and st.st_size > 0
+
+
 class OVMF(object):
     OVMF_TABLE_FOOTER_GUID = "96b582de-1fb2-45f7-baea-a366c55a082d"
     SEV_HASH_TABLE_RV_GUID = "7255371f-3a3b-4b04-927b-1da6efa8d454"
     SEV_ES_RESET_BLOCK_GUID = "00f771de-1a7e-4fcb-890e-68c77e2fb44e"
     OVMF_SEV_META_DATA_GUID = "dc886566-984a-4798-a75e-5585a7bf67cc"
 
-    def __init__(self, _filename: str, end_at: int = FOUR_GB):
-        with open(_filename, "rb") as f:
-            self._data = f.read()
-        self._parse_footer_table()
-        self._parse_sev_metadata()
-        self._gpa = end_at - len(self._data)
+    # Number of bytes initially read from the end of the file in lazy mode
+    LAZY_TAIL_SIZE = 4 * PAGE_SIZE
+
+    def __init__(self, _filename: str, end_at: int = FOUR_GB, use_mmap: bool = True, lazy: bool = False):
+        """
+        Load a firmware image which ends at GPA end_at.  If use_mmap is True
+        (the default) and the file is a regular file, it is mapped read-only
+        and data() is a zero-copy view into the mapping; this lets concurrent
+        measurement processes share the page cache instead of each holding a
+        private copy of the firmware.
 
-    def data(self) -> bytes:
+        If lazy is True, only the last pages of the file (which hold the
+        footer table and the SEV metadata) are read; the whole firmware is
+        loaded on the first call to data().
+        """
+        self._filename = _filename
+        self._use_mmap = use_mmap
+        self._mmap: Optional[mmap.mmap] = None
+        self._data: Optional[Union[bytes, memoryview]] = None
+        # _tail holds the bytes of the file from offset _tail_start to its end
+        self._tail: Union[bytes, memoryview] = b''
+        with metrics.stage('firmware_load'):
+            if lazy:
+                self._size = os.stat(_filename).st_size
+                self._tail_start = self._size
+            else:
+                self._load()
+            self._parse_footer_table()
+            self._parse_sev_metadata()
+        self._gpa = end_at - self._size
+
+    def _load(self) -> Union[bytes, memoryview]:
+        data: Union[bytes, memoryview]
+        with open(self._filename, "rb") as f:
+            if self._use_mmap and _is_mappable(f.fileno()):
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(self._mmap, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+                data = memoryview(self._mmap)
+                metrics.count_bytes_mapped(len(data))
+            else:
+                data = f.read()
+                metrics.count_bytes_read(len(data))
+        self._data = self._tail = data
+        self._size = len(data)
+        self._tail_start = 0
+        return data
+
+    def _read(self, offset: int, length: int) -> Union[bytes, memoryview]:
+        """
+        Return length bytes of the firmware file starting at offset, reading
+        more of the end of the file if it wasn't loaded yet.
+        """
+        if offset < 0 or length < 0 or offset + length > self._size:
+            raise RuntimeError("Firmware structure out of bounds")
+        if offset < self._tail_start:
+            start = min(offset, self._size - self.LAZY_TAIL_SIZE) & ~(PAGE_SIZE - 1)
+            start = max(start, 0)
+            with open(self._filename, "rb") as f:
+                f.seek(start)
+                tail = f.read(self._size - start)
+            metrics.count_bytes_read(len(tail))
+            if len(tail) != self._size - start:
+                raise RuntimeError("Firmware file changed while reading it")
+            self._tail = tail
+            self._tail_start = start
+        start = offset - self._tail_start
+        return self._tail[start:start + length]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Release the firmware mapping, if any.  The view returned by data()
+        must not be used after this, and views sliced from it must have been
+        released already.  The parsed tables stay available, and a later call
+        to data() maps the file again.
+        """
+        if self._mmap is not None:
+            assert isinstance(self._data, memoryview)
+            self._data.release()
+            self._data = None
+            self._tail = b''
+            self._tail_start = self._size
+            self._mmap.close()
+            self._mmap = None
+
+    def data(self) -> Union[bytes, memoryview]:
+        if self._data is None:
+            return self._load()
         return self._data
 
     def size(self) -> int:
-        return len(self._data)
+        return self._size
 
     def end_gpa(self) -> int:
         return self.gpa() + self.size()
@@ -83,66 +197,79 @@ class OVMF(object):
         return self._gpa
 
     def table_item(self, guid: str) -> bytes:
-        return self._table[guid]
+        return self._table[guid_bytes(guid)]
 
-    def metadata_items(self):
+    def _table_entry(self, guid: str) -> Optional[bytes]:
+        return self._table.get(guid_bytes(guid))
+
+    def metadata_items(self) -> List[OvmfSevMetadataSectionDesc]:
         return self._metadata_items
 
+    def metadata_items_of_type(self, section_type: SectionType) -> List[OvmfSevMetadataSectionDesc]:
+        return self._metadata_sections.get(section_type.value, [])
+
     def has_metadata_section(self, section_type: SectionType) -> bool:
-        return any(True for s in self.metadata_items() if s.section_type() == section_type)
+        return section_type.value in self._metadata_sections
 
     def is_sev_hashes_table_supported(self) -> bool:
-        return self.SEV_HASH_TABLE_RV_GUID in self._table and self.sev_hashes_table_gpa() != 0
+        return self._table_entry(self.SEV_HASH_TABLE_RV_GUID) is not None and self.sev_hashes_table_gpa() != 0
 
     def sev_hashes_table_gpa(self) -> int:
-        if self.SEV_HASH_TABLE_RV_GUID not in self._table:
+        entry = self._table_entry(self.SEV_HASH_TABLE_RV_GUID)
+        if entry is None:
             raise RuntimeError("Can't find SEV_HASH_TABLE_RV_GUID entry in OVMF table")
-        entry = self._table[self.SEV_HASH_TABLE_RV_GUID]
         return int.from_bytes(entry[:4], byteorder='little')
 
     def sev_es_reset_eip(self) -> int:
-        if self.SEV_ES_RESET_BLOCK_GUID not in self._table:
+        entry = self._table_entry(self.SEV_ES_RESET_BLOCK_GUID)
+        if entry is None:
             raise RuntimeError("Can't find SEV_ES_RESET_BLOCK_GUID entry in OVMF table")
-        entry = self._table[self.SEV_ES_RESET_BLOCK_GUID]
         return int.from_bytes(entry[:4], byteorder='little')
 
     def _parse_footer_table(self) -> None:
-        self._table = {}
-        size = len(self._data)
-        entry_header_size = ctypes.sizeof(OvmfFooterTableEntry)
+        """
+        Parse the GUIDed footer table, which is walked backwards from its end.
+        Every entry is visited once and its bounds are checked against the
+        table, so parsing time is linear in the (at most 64KiB) table size.
+        """
+        self._table: Dict[bytes, bytes] = {}
+        entry_header_size = _FOOTER_ENTRY.size
         # The OVMF table ends 32 bytes before the end of the firmware binary
-        start_of_footer_table = size - 32 - entry_header_size
-        footer = OvmfFooterTableEntry.from_buffer_copy(self._data[start_of_footer_table:])
-        expected_footer_guid = uuid.UUID("{" + self.OVMF_TABLE_FOOTER_GUID + "}").bytes_le
-        if bytes(footer.guid) != expected_footer_guid:
+        start_of_footer_table = self._size - 32 - entry_header_size
+        footer_size, footer_guid = _FOOTER_ENTRY.unpack(self._read(start_of_footer_table, entry_header_size))
+        if footer_guid != guid_bytes(self.OVMF_TABLE_FOOTER_GUID):
             return
-        table_size = footer.size - entry_header_size
+        table_size = footer_size - entry_header_size
         if table_size < 0:
             return
-        table_bytes = self._data[start_of_footer_table-table_size:start_of_footer_table]
-        while len(table_bytes) >= entry_header_size:
-            entry = OvmfFooterTableEntry.from_buffer_copy(table_bytes[-entry_header_size:])
-            if entry.size < entry_header_size:
-                raise RuntimeError("Invalid entry size")
-            entry_guid_str = str(uuid.UUID(bytes_le=bytes(entry.guid)))
-            entry_data = table_bytes[-entry.size:-entry_header_size]
-            self._table[entry_guid_str] = entry_data
-            table_bytes = table_bytes[:-entry.size]
+        with memoryview(self._read(start_of_footer_table - table_size, table_size)) as table:
+            end = table_size
+            while end >= entry_header_size:
+                entry_size, entry_guid = _FOOTER_ENTRY.unpack_from(table, end - entry_header_size)
+                if entry_size < entry_header_size or entry_size > end:
+                    raise RuntimeError("Invalid entry size")
+                self._table[entry_guid] = bytes(table[end - entry_size:end - entry_header_size])
+                end -= entry_size
 
     def _parse_sev_metadata(self) -> None:
-        self._metadata_items = []
-        if self.OVMF_SEV_META_DATA_GUID not in self._table:
+        self._metadata_items: List[OvmfSevMetadataSectionDesc] = []
+        self._metadata_sections: Dict[int, List[OvmfSevMetadataSectionDesc]] = {}
+        entry = self._table_entry(self.OVMF_SEV_META_DATA_GUID)
+        if entry is None:
             return
-        entry = self._table[self.OVMF_SEV_META_DATA_GUID]
         offset_from_end = int.from_bytes(entry[:4], byteorder='little')
-        start = len(self._data) - offset_from_end
-        header = OvmfSevMetadataHeader.from_buffer_copy(self._data, start)
+        start = self._size - offset_from_end
+        header_size = ctypes.sizeof(OvmfSevMetadataHeader)
+        header = OvmfSevMetadataHeader.from_buffer_copy(self._read(start, header_size))
         header.verify()
-        items = self._data[start+ctypes.sizeof(OvmfSevMetadataHeader):start+header.size]
-        for i in range(header.num_items):
-            offset = i * ctypes.sizeof(OvmfSevMetadataSectionDesc)
+        desc_size = ctypes.sizeof(OvmfSevMetadataSectionDesc)
+        if header.size < header_size or header.num_items * desc_size > header.size - header_size:
+            raise RuntimeError("Invalid SEV metadata size")
+        items = self._read(start + header_size, header.num_items * desc_size)
+        for offset in range(0, len(items), desc_size):
             item = OvmfSevMetadataSectionDesc.from_buffer_copy(items, offset)
             self._metadata_items.append(item)
+            self._metadata_sections.setdefault(item.section_type_int, []).append(item)
 
 
 class SVSM(OVMF):
@@ -151,7 +278,7 @@ class SVSM(OVMF):
     def sev_es_reset_eip(self) -> int:
         # See https://github.com/coconut-svsm/qemu/blob/0e64fb84eeeb86e2b263068c098a64d2f3d5a661/target/i386/sev.c#L2175
 
-        if self.SVSM_INFO_GUID not in self._table:
+        entry = self._table_entry(self.SVSM_INFO_GUID)
+        if entry is None:
             raise RuntimeError("Can't find SVSM_INFO_GUID entry in SVSM table")
-        entry = self._table[self.SVSM_INFO_GUID]
         return int.from_bytes(entry[:4], byteorder='little') + self.gpa()
@@ -0,0 +1,157 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import base64
+import binascii
+import hashlib
+import itertools
+import multiprocessing
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from .gctx import LD_SIZE
+from .sev_mode import SevMode
+from .sweep import LaunchConfig, Sweeper, launch_configs, make_sweeper, vmsa_key
+from .vmm_types import VMMType
+
+# Size of SEV-SNP launch measurements (SHA-384) and of SEV and SEV-ES launch
+# measurements (SHA-256)
+SNP_MEASUREMENT_SIZE = LD_SIZE
+SEV_MEASUREMENT_SIZE = hashlib.sha256().digest_size
+
+# Called with the number of configurations tried, the total number of
+# configurations and the elapsed time in seconds
+ProgressCallback = Callable[[int, int, float], None]
+
+
+class SearchResult(NamedTuple):
+    """
+    The configuration producing the target measurement (None if no
+    configuration matched), and how many configurations were tried in how
+    many seconds.  For VMM types other than QEMU the vCPU signature is not
+    measured, and vcpu_sig is 0.
+    """
+    config: Optional[LaunchConfig]
+    tried: int
+    elapsed: float
+
+
+def parse_measurement(s: str) -> bytes:
+    """
+    Parse a launch measurement given in hex or base64, which must be
+    SNP_MEASUREMENT_SIZE (SEV-SNP) or SEV_MEASUREMENT_SIZE (SEV and SEV-ES)
+    bytes long.
+    """
+    s = s.strip()
+    decoded = []
+    try:
+        decoded.append(bytes.fromhex(s))
+    except ValueError:
+        pass
+    try:
+        decoded.append(base64.b64decode(s, validate=True))
+    except binascii.Error:
+        pass
+    if not decoded:
+        raise ValueError(f"measurement is neither hex nor base64: '{s}'")
+    for ld in decoded:
+        if len(ld) in [SNP_MEASUREMENT_SIZE, SEV_MEASUREMENT_SIZE]:
+            return ld
+    raise ValueError(f"measurement is {len(decoded[0])} bytes long instead of {SNP_MEASUREMENT_SIZE} (SEV-SNP) "
+                     f"or {SEV_MEASUREMENT_SIZE} (SEV and SEV-ES): '{s}'")
+
+
+def measurement_size(mode: SevMode) -> int:
+    """
+    Return the size of the launch measurements of guests in mode.
+    """
+    return SEV_MEASUREMENT_SIZE if mode in [SevMode.SEV, SevMode.SEV_ES] else SNP_MEASUREMENT_SIZE
+
+
+def feature_masks(bits: int, base: int = 0) -> List[int]:
+    """
+    Return base combined with every subset of the bits set in bits.
+    """
+    single_bits = [1 << i for i in range(bits.bit_length()) if bits & (1 << i)]
+    masks = []
+    for n in range(len(single_bits) + 1):
+        for combination in itertools.combinations(single_bits, n):
+            masks.append(base | sum(combination))
+    return list(dict.fromkeys(masks))
+
+
+def search_launch_config(target: bytes, mode: SevMode, ovmf_file: str, kernel: str, initrd: str, append: str,
+                         vcpus: Sequence[int], vcpu_sigs: Iterable[int], guest_features: Iterable[int],
+                         vmm_types: Iterable[VMMType], snp_ovmf_hash_str: str = '', svsm_file: str = '',
+                         ovmf_vars_size: int = 0, processes: int = 1,
+                         progress: Optional[ProgressCallback] = None) -> SearchResult:
+    """
+    Search the cartesian product of the given parameter values for the
+    configuration whose launch digest is target, and stop at the first match.
+
+    Everything before the VMSA pages is measured once per process (processes
+    run the search in a process pool when more than 1), and all numbers of
+    vCPUs of a VMSA configuration are measured in a single pass.
+    """
+    if not vcpus or min(vcpus) < 1:
+        raise ValueError("vcpus must be at least 1")
+    if processes < 1:
+        raise ValueError("processes must be at least 1")
+    if len(target) != measurement_size(mode):
+        raise ValueError(f"target must be {measurement_size(mode)} bytes long in {mode.name} mode")
+    vcpus = sorted(set(vcpus))
+    if mode == SevMode.SEV_SNP_SVSM:
+        vmm_types = [VMMType.QEMU]
+    # Configurations which only differ in parameters that aren't measured
+    # share their VMSA key, and are only tried once
+    keys = list(dict.fromkeys(vmsa_key(config) for config in launch_configs([1], vcpu_sigs, guest_features, vmm_types)))
+    total = len(keys) * len(vcpus)
+    sweeper_args = (mode, ovmf_file, kernel, initrd, append, snp_ovmf_hash_str, svsm_file, ovmf_vars_size)
+
+    start_time = time.monotonic()
+    if processes == 1:
+        _init_worker(sweeper_args, target, vcpus)
+        results: Iterable[Tuple[Tuple[int, int, VMMType], Optional[int]]] = map(_search_key, keys)
+        return _collect(results, len(vcpus), total, start_time, progress)
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(sweeper_args, target, vcpus)) as pool:
+        # Leaving the with block terminates the workers, so the search stops
+        # at the first match
+        return _collect(pool.imap_unordered(_search_key, keys), len(vcpus), total, start_time, progress)
+
+
+def _collect(results: Iterable[Tuple[Tuple[int, int, VMMType], Optional[int]]], vcpus_per_key: int, total: int,
+             start_time: float, progress: Optional[ProgressCallback]) -> SearchResult:
+    tried = 0
+    for key, match in results:
+        tried += vcpus_per_key
+        elapsed = time.monotonic() - start_time
+        if progress is not None:
+            progress(tried, total, elapsed)
+        if match is not None:
+            vcpu_sig, guest_features, vmm_type = key
+            return SearchResult(LaunchConfig(match, vcpu_sig, guest_features, vmm_type), tried, elapsed)
+    return SearchResult(None, tried, time.monotonic() - start_time)
+
+
+# State of a search process, set up once by _init_worker
+_worker_sweeper: Optional[Sweeper] = None
+_worker_target = b''
+_worker_vcpus: List[int] = []
+
+
+def _init_worker(sweeper_args: tuple, target: bytes, vcpus: List[int]) -> None:
+    global _worker_sweeper, _worker_target, _worker_vcpus
+    _worker_sweeper = make_sweeper(*sweeper_args)
+    _worker_target = target
+    _worker_vcpus = vcpus
+
+
+def _search_key(key: Tuple[int, int, VMMType]) -> Tuple[Tuple[int, int, VMMType], Optional[int]]:
+    assert _worker_sweeper is not None
+    lds: Dict[int, bytes] = _worker_sweeper(key, _worker_vcpus)
+    for n, ld in lds.items():
+        if ld == _worker_target:
+            return key, n
+    return key, None
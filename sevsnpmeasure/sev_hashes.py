@@ -6,11 +6,45 @@
 import ctypes
 from ctypes import c_uint8, c_uint16
 import hashlib
+import os
+from typing import TYPE_CHECKING, Optional
 import uuid
 
+from . import metrics
+
+if TYPE_CHECKING:
+    from .cache import DigestCache
+
 
 Sha256Hash = c_uint8 * hashlib.sha256().digest_size
 
+# Size of the buffer used to hash the kernel and initrd files
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_file(filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> bytes:
+    """
+    Calculate the SHA-256 digest of a file, reading it in chunks into a single
+    reused buffer so memory usage doesn't grow with the size of the file.
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk size must be positive")
+    h = hashlib.sha256()
+    buf = memoryview(bytearray(chunk_size))
+    with open(filename, 'rb', buffering=0) as fh:
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            h.update(buf[:n])
+            metrics.count_bytes_read(n)
+    return h.digest()
+
 
 class GuidLe(ctypes.Array):
     _length_ = 16
@@ -57,22 +91,38 @@ class SevHashes:
     SEV_INITRD_ENTRY_GUID = "44baf731-3a2f-4bd7-9af1-41e29169781d"
     SEV_CMDLINE_ENTRY_GUID = "97d02dd8-bd20-4c94-aa78-e7714d36ab2a"
 
-    def __init__(self, kernel: str, initrd: str, append: str):
-        with open(kernel, 'rb') as fh:
-            self.kernel_hash = hashlib.sha256(fh.read()).digest()
-
-        if initrd:
-            with open(initrd, 'rb') as fh:
-                initrd_data = fh.read()
-        else:
-            initrd_data = b''
-        self.initrd_hash = hashlib.sha256(initrd_data).digest()
+    def __init__(self, kernel: str, initrd: str, append: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 digest_cache: Optional['DigestCache'] = None):
+        hash_file = digest_cache.sha256_file if digest_cache is not None else sha256_file
+        with metrics.stage('kernel_hashes'):
+            self.kernel_hash = hash_file(kernel, chunk_size)
+
+            if initrd:
+                self.initrd_hash = hash_file(initrd, chunk_size)
+            else:
+                self.initrd_hash = hashlib.sha256(b'').digest()
+
+        self.cmdline_hash = self._cmdline_hash(append)
+
+    @classmethod
+    def from_digests(cls, kernel_hash: bytes, initrd_hash: bytes, append: str) -> 'SevHashes':
+        """
+        Create SevHashes from the SHA-256 digests of the kernel and initrd
+        files (initrd_hash is the digest of b'' when there is no initrd).
+        """
+        hashes = cls.__new__(cls)
+        hashes.kernel_hash = kernel_hash
+        hashes.initrd_hash = initrd_hash
+        hashes.cmdline_hash = cls._cmdline_hash(append)
+        return hashes
 
+    @staticmethod
+    def _cmdline_hash(append: str) -> bytes:
         if append:
             cmdline = append.encode() + b'\x00'
         else:
             cmdline = b'\x00'
-        self.cmdline_hash = hashlib.sha256(cmdline).digest()
+        return hashlib.sha256(cmdline).digest()
 
     #
     # Generate the SEV hashes area - this must be *identical* to the way QEMU
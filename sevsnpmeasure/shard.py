@@ -0,0 +1,213 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .cache import CheckpointCache, DigestCache
+from .sev_hashes import sha256_file
+from .sev_mode import SevMode
+from .sweep import LaunchConfig, make_sweeper, vmsa_key
+from .vmm_types import VMMType
+
+PROGRESS_SUFFIX = '.progress'
+
+
+class ShardProgress(NamedTuple):
+    """
+    Progress of a shard, saved next to its output: the shard (1-based index
+    and count), a digest of the parameters of the whole job, the number of
+    groups of configurations done, the size of the output written for them,
+    whether the shard is complete, and the metadata of the job.
+    """
+    shard: int
+    shards: int
+    job_digest: str
+    groups_done: int
+    output_size: int
+    complete: bool
+    metadata: dict
+
+
+def parse_shard(s: str) -> Tuple[int, int]:
+    """
+    Parse a shard given as i/N, where 1 <= i <= N.
+    """
+    index, sep, count = s.partition('/')
+    try:
+        shard = (int(index), int(count))
+    except ValueError:
+        raise ValueError(f"invalid shard '{s}' (expected i/N)")
+    if not sep or not 1 <= shard[0] <= shard[1]:
+        raise ValueError(f"invalid shard '{s}' (expected i/N with 1 <= i <= N)")
+    return shard
+
+
+def job_inputs(ovmf_file: str, kernel: str, initrd: str, append: str, snp_ovmf_hash_str: str = '',
+               svsm_file: str = '', ovmf_vars_size: int = 0,
+               digest_cache: Optional[DigestCache] = None) -> dict:
+    """
+    Return the inputs of a job which determine its measurements: the SHA-256
+    digests of the input files (so the same files at other paths make the
+    same job, and files changed in place don't), the kernel command line, the
+    precalculated OVMF hash and the size of the OVMF_VARS file.
+    """
+    file_digest = digest_cache.sha256_file if digest_cache is not None else sha256_file
+    files = {'ovmf': ovmf_file, 'kernel': kernel, 'initrd': initrd, 'svsm': svsm_file}
+    inputs: dict = {name: file_digest(filename).hex() if filename else None for name, filename in files.items()}
+    inputs.update(append=append or None, snp_ovmf_hash=(snp_ovmf_hash_str or '').lower() or None,
+                  vars_size=ovmf_vars_size)
+    return inputs
+
+
+def job_digest(mode: SevMode, configs: Iterable[LaunchConfig], inputs: dict) -> str:
+    """
+    Return a digest identifying a job (given its inputs as returned by
+    job_inputs), which all its shards must agree on.
+    """
+    doc = {'mode': mode.name, 'inputs': inputs,
+           'configs': [[c.vcpus, c.vcpu_sig, c.guest_features, c.vmm_type.name] for c in configs]}
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode()).hexdigest()
+
+
+def shard_groups(configs: Iterable[LaunchConfig], shard: int, shards: int) -> List[List[LaunchConfig]]:
+    """
+    Return the groups of configurations of a shard.  Configurations which only
+    differ in their number of vCPUs (and are measured in one pass) form a
+    group, and groups are dealt to the shards round robin in the order of
+    configs, so the partition only depends on the job.
+    """
+    groups: Dict[Tuple[int, int, VMMType], List[LaunchConfig]] = {}
+    for config in configs:
+        groups.setdefault(vmsa_key(config), []).append(config)
+    return [group for i, group in enumerate(groups.values()) if i % shards == shard - 1]
+
+
+def progress_path(output: str) -> str:
+    return output + PROGRESS_SUFFIX
+
+
+def read_progress(output: str) -> Optional[ShardProgress]:
+    try:
+        with open(progress_path(output), 'r') as f:
+            return ShardProgress(**json.load(f))
+    except FileNotFoundError:
+        return None
+    except (TypeError, ValueError):
+        raise RuntimeError(f"Invalid shard progress file '{progress_path(output)}'")
+
+
+def _write_progress(output: str, progress: ShardProgress) -> None:
+    path = progress_path(output)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(progress._asdict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def run_shard(mode: SevMode, configs: Iterable[LaunchConfig], shard: int, shards: int, output: str,
+              ovmf_file: str, kernel: str, initrd: str, append: str, snp_ovmf_hash_str: str = '',
+              svsm_file: str = '', ovmf_vars_size: int = 0, workers: int = 1,
+              digest_cache: Optional[DigestCache] = None, checkpoint_cache: Optional[CheckpointCache] = None,
+              metadata: Optional[dict] = None) -> ShardProgress:
+    """
+    Measure the configurations of one shard of a job, appending a JSON line
+    per configuration to output.  The progress is checkpointed after every
+    group of configurations, and an interrupted shard continues where it
+    stopped when run again with the same parameters (and input file
+    contents).  The metadata is only recorded for the index, and doesn't
+    identify the job.
+    """
+    configs = list(configs)
+    if any(config.vcpus < 1 for config in configs):
+        raise ValueError("vcpus must be at least 1")
+    if mode == SevMode.SEV_SNP_SVSM and any(config.vmm_type != VMMType.QEMU for config in configs):
+        raise AssertionError("SVSM mode is only implemented for Qemu.")
+    metadata = metadata or {}
+    digest = job_digest(mode, configs, job_inputs(ovmf_file, kernel, initrd, append, snp_ovmf_hash_str, svsm_file,
+                                                  ovmf_vars_size, digest_cache))
+    groups = shard_groups(configs, shard, shards)
+    progress = read_progress(output)
+    if progress is None:
+        progress = ShardProgress(shard, shards, digest, 0, 0, False, metadata)
+    elif (progress.shard, progress.shards, progress.job_digest) != (shard, shards, digest):
+        raise RuntimeError(f"'{output}' belongs to a different shard or job")
+    if progress.complete:
+        return progress
+
+    sweeper = None
+    with open(output, 'ab') as f:
+        # Drop anything written after the last checkpoint
+        f.truncate(progress.output_size)
+        for group in groups[progress.groups_done:]:
+            if sweeper is None:
+                sweeper = make_sweeper(mode, ovmf_file, kernel, initrd, append, snp_ovmf_hash_str, svsm_file,
+                                       ovmf_vars_size, workers, digest_cache, checkpoint_cache)
+            lds = sweeper(vmsa_key(group[0]), [config.vcpus for config in group])
+            for config in group:
+                record = {'vcpus': config.vcpus, 'vcpu_sig': config.vcpu_sig, 'guest_features': config.guest_features,
+                          'vmm_type': config.vmm_type.name, 'measurement': lds[config.vcpus].hex()}
+                f.write(json.dumps(record).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+            progress = progress._replace(groups_done=progress.groups_done + 1, output_size=f.tell())
+            _write_progress(output, progress)
+    progress = progress._replace(complete=True)
+    _write_progress(output, progress)
+    return progress
+
+
+def merge_shards(outputs: Iterable[str]) -> Tuple[Dict[LaunchConfig, bytes], dict]:
+    """
+    Combine the outputs of all the shards of a job, checking that they are
+    complete and belong to the same job.  Returns the launch digest of every
+    configuration (configurations found in several outputs must agree) and
+    the metadata of the job.
+    """
+    lds: Dict[LaunchConfig, bytes] = {}
+    seen = set()
+    job = None
+    metadata: dict = {}
+    for output in outputs:
+        progress = read_progress(output)
+        if progress is None or not progress.complete:
+            raise RuntimeError(f"Shard '{output}' is not complete")
+        if job is None:
+            job = (progress.job_digest, progress.shards)
+            metadata = progress.metadata
+        elif job != (progress.job_digest, progress.shards):
+            raise RuntimeError(f"Shard '{output}' belongs to a different job")
+        seen.add(progress.shard)
+        _read_shard_output(output, progress.output_size, lds)
+    if job is None:
+        raise RuntimeError("No shards to merge")
+    missing = sorted(set(range(1, job[1] + 1)) - seen)
+    if missing:
+        raise RuntimeError(f"Missing shards {', '.join(f'{i}/{job[1]}' for i in missing)}")
+    return lds, metadata
+
+
+def _read_shard_output(output: str, size: int, lds: Dict[LaunchConfig, bytes]) -> None:
+    with open(output, 'rb') as f:
+        data = f.read(size)
+    for line in data.splitlines():
+        record = json.loads(line)
+        config = LaunchConfig(record['vcpus'], record['vcpu_sig'], record['guest_features'],
+                              VMMType[record['vmm_type']])
+        ld = bytes.fromhex(record['measurement'])
+        if lds.setdefault(config, ld) != ld:
+            raise RuntimeError(f"Conflicting measurements for {config}")
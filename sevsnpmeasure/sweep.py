@@ -0,0 +1,309 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import hashlib
+import itertools
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from . import metrics
+from .cache import CheckpointCache, DigestCache
+from .gctx import GCTX
+from .guest import (seves_pre_vmsa_hash, seves_vmsa_launch_digests, sev_calc_launch_digest, snp_firmware_prefix,
+                    snp_metadata_gctx, snp_pre_kernel_hashes_gctx, snp_update_metadata_pages,
+                    snp_vmsa_launch_digests, svsm_pre_vmsa_gctx)
+from .ovmf import OVMF
+from .sev_hashes import DEFAULT_CHUNK_SIZE, SevHashes, sha256_file
+from .sev_mode import SevMode
+from .vmm_types import VMMType
+from .vmsa import VMSA, VMSA_SVSM, VMSAPages
+
+
+class LaunchConfig(NamedTuple):
+    """
+    The guest parameters which only influence the VMSA pages, measured at the
+    end of the launch digest (apart from the VMM type, which for SNP also
+    changes how some metadata sections are measured).
+    """
+    vcpus: int
+    vcpu_sig: int
+    guest_features: int
+    vmm_type: VMMType
+
+
+class KernelInputs(NamedTuple):
+    """
+    The kernel, initrd and kernel command line of a guest; an empty kernel
+    means that no kernel hashes are measured.
+    """
+    kernel: str
+    initrd: str = ''
+    append: str = ''
+
+
+def launch_configs(vcpus: Iterable[int], vcpu_sigs: Iterable[int], guest_features: Iterable[int],
+                   vmm_types: Iterable[VMMType]) -> List[LaunchConfig]:
+    """
+    Return the cartesian product of the given parameter values.
+    """
+    return [LaunchConfig(n, sig, features, vmm_type)
+            for vmm_type, sig, features, n in itertools.product(vmm_types, vcpu_sigs, guest_features, vcpus)]
+
+
+def sweep_launch_digests(mode: SevMode, configs: Iterable[LaunchConfig], ovmf_file: str,
+                         kernel: str, initrd: str, append: str, snp_ovmf_hash_str: str = '',
+                         svsm_file: str = '', ovmf_vars_size: int = 0, workers: int = 1,
+                         digest_cache: Optional[DigestCache] = None,
+                         checkpoint_cache: Optional[CheckpointCache] = None) -> Dict[LaunchConfig, bytes]:
+    """
+    Calculate the launch digest of a guest for every config in configs.
+
+    The firmware, its metadata sections and the kernel hashes are measured
+    once (the metadata once per VMM type in SNP mode), and every distinct
+    combination of VMSA pages is measured once, for the largest number of
+    vCPUs it is requested with, from a fork of that shared state.  Returns a
+    dict mapping each config to its launch digest, in the order of configs.
+    """
+    configs = list(configs)
+    if any(config.vcpus < 1 for config in configs):
+        raise ValueError("vcpus must be at least 1")
+    if mode == SevMode.SEV_SNP_SVSM and any(config.vmm_type != VMMType.QEMU for config in configs):
+        raise AssertionError("SVSM mode is only implemented for Qemu.")
+    measure = make_sweeper(mode, ovmf_file, kernel, initrd, append, snp_ovmf_hash_str, svsm_file, ovmf_vars_size,
+                           workers, digest_cache, checkpoint_cache)
+
+    # Measure each group of configs which only differ in the number of vCPUs
+    # in one pass
+    groups: Dict[Tuple[int, int, VMMType], List[int]] = {}
+    for config in configs:
+        groups.setdefault(vmsa_key(config), []).append(config.vcpus)
+    lds = {key: measure(key, vcpus) for key, vcpus in groups.items()}
+    return {config: lds[vmsa_key(config)][config.vcpus] for config in configs}
+
+
+# Measures the VMSA pages of a (vcpu_sig, guest_features, vmm_type) key for
+# the given numbers of vCPUs, returning the launch digest for each number
+Sweeper = Callable[[Tuple[int, int, VMMType], List[int]], Dict[int, bytes]]
+
+
+def vmsa_key(config: LaunchConfig) -> Tuple[int, int, VMMType]:
+    """
+    Return the parameters of config which determine its VMSA pages.
+    """
+    # Only QEMU puts the vCPU signature into the VMSA pages
+    vcpu_sig = config.vcpu_sig if config.vmm_type == VMMType.QEMU else 0
+    return vcpu_sig, config.guest_features, config.vmm_type
+
+
+def make_sweeper(mode: SevMode, ovmf_file: str, kernel: str, initrd: str, append: str, snp_ovmf_hash_str: str = '',
+                 svsm_file: str = '', ovmf_vars_size: int = 0, workers: int = 1,
+                 digest_cache: Optional[DigestCache] = None,
+                 checkpoint_cache: Optional[CheckpointCache] = None) -> Sweeper:
+    """
+    Measure everything before the VMSA pages of a guest, and return a
+    function which completes the measurement for given VMSA parameters.
+    """
+    if snp_ovmf_hash_str and mode != SevMode.SEV_SNP:
+        raise ValueError("SNP OVMF hash only works with SNP")
+
+    if mode == SevMode.SEV_SNP:
+        return _snp_sweeper(ovmf_file, kernel, initrd, append, snp_ovmf_hash_str, workers,
+                            digest_cache, checkpoint_cache)
+    elif mode == SevMode.SEV_ES:
+        return _seves_sweeper(ovmf_file, kernel, initrd, append, digest_cache)
+    elif mode == SevMode.SEV:
+        ld = sev_calc_launch_digest(ovmf_file, kernel, initrd, append, digest_cache=digest_cache)
+        return _constant_sweeper(ld)
+    elif mode == SevMode.SEV_SNP_SVSM:
+        return _svsm_sweeper(ovmf_file, ovmf_vars_size, svsm_file, workers, checkpoint_cache)
+    else:
+        raise ValueError("unknown mode")
+
+
+def _constant_sweeper(ld: bytes) -> Sweeper:
+    return lambda key, vcpus: {n: ld for n in vcpus}
+
+
+def _snp_sweeper(ovmf_file: str, kernel: str, initrd: str, append: str, ovmf_hash_str: str, workers: int,
+                 digest_cache: Optional[DigestCache], checkpoint_cache: Optional[CheckpointCache]) -> Sweeper:
+    if ovmf_hash_str:
+        checkpoint_cache = None
+    firmware_gctx, ovmf, firmware_key = snp_firmware_prefix(ovmf_file, ovmf_hash_str, workers, checkpoint_cache)
+    sev_hashes = None
+    if kernel:
+        sev_hashes = SevHashes(kernel, initrd, append, digest_cache=digest_cache)
+    eip = ovmf.sev_es_reset_eip()
+    prefixes: Dict[VMMType, GCTX] = {}
+
+    def measure(key: Tuple[int, int, VMMType], vcpus: List[int]) -> Dict[int, bytes]:
+        vcpu_sig, guest_features, vmm_type = key
+        if vmm_type not in prefixes:
+            prefixes[vmm_type] = snp_metadata_gctx(firmware_gctx.fork(), ovmf, sev_hashes, vmm_type,
+                                                   checkpoint_cache, firmware_key)
+        vmsa = VMSA(SevMode.SEV_SNP, eip, vcpu_sig, guest_features, vmm_type)
+        return snp_vmsa_launch_digests(prefixes[vmm_type].fork(), vmsa, vcpus)
+
+    return measure
+
+
+def _seves_sweeper(ovmf_file: str, kernel: str, initrd: str, append: str,
+                   digest_cache: Optional[DigestCache]) -> Sweeper:
+    launch_hash, eip = seves_pre_vmsa_hash(ovmf_file, kernel, initrd, append, digest_cache)
+    return _seves_vmsa_sweeper(launch_hash, eip)
+
+
+def _seves_vmsa_sweeper(launch_hash: 'hashlib._Hash', eip: int) -> Sweeper:
+    def measure(key: Tuple[int, int, VMMType], vcpus: List[int]) -> Dict[int, bytes]:
+        vcpu_sig, _, vmm_type = key
+        # SEV-ES guests have no guest features in their VMSA
+        vmsa: VMSAPages = VMSA(SevMode.SEV_ES, eip, vcpu_sig, 0x0, vmm_type)
+        return seves_vmsa_launch_digests(launch_hash.copy(), vmsa, vcpus)
+
+    return measure
+
+
+def _svsm_sweeper(ovmf_file: str, ovmf_vars_size: int, svsm_file: str, workers: int,
+                  checkpoint_cache: Optional[CheckpointCache]) -> Sweeper:
+    prefix, eip = svsm_pre_vmsa_gctx(ovmf_file, ovmf_vars_size, svsm_file, workers, checkpoint_cache)
+
+    def measure(key: Tuple[int, int, VMMType], vcpus: List[int]) -> Dict[int, bytes]:
+        vcpu_sig, _, _ = key
+        return snp_vmsa_launch_digests(prefix.fork(), VMSA_SVSM(eip, vcpu_sig), vcpus)
+
+    return measure
+
+
+# Completes the measurement of a firmware up to the VMSA pages for the hashes
+# of a kernel, initrd and kernel command line (None without a kernel),
+# returning a Sweeper for them
+FirmwareSweeper = Callable[[Optional[SevHashes]], Sweeper]
+
+
+def make_firmware_sweeper(mode: SevMode, ovmf_file: str, snp_ovmf_hash_str: str = '', svsm_file: str = '',
+                          ovmf_vars_size: int = 0, workers: int = 1,
+                          checkpoint_cache: Optional[CheckpointCache] = None) -> FirmwareSweeper:
+    """
+    Measure the firmware of a guest, and return a function which measures the
+    rest up to the VMSA pages for the hashes of a given kernel, initrd and
+    command line.
+    The firmware (and in SNP mode the metadata sections before the kernel
+    hashes, once per VMM type) is only measured once for all the kernels;
+    the SNP:SVSM mode has no kernel hashes.
+    """
+    if snp_ovmf_hash_str and mode != SevMode.SEV_SNP:
+        raise ValueError("SNP OVMF hash only works with SNP")
+
+    if mode == SevMode.SEV_SNP:
+        return _snp_firmware_sweeper(ovmf_file, snp_ovmf_hash_str, workers, checkpoint_cache)
+    elif mode in (SevMode.SEV_ES, SevMode.SEV):
+        return _sev_firmware_sweeper(mode, ovmf_file)
+    elif mode == SevMode.SEV_SNP_SVSM:
+        sweeper = _svsm_sweeper(ovmf_file, ovmf_vars_size, svsm_file, workers, checkpoint_cache)
+        return lambda sev_hashes: sweeper
+    else:
+        raise ValueError("unknown mode")
+
+
+def _snp_firmware_sweeper(ovmf_file: str, ovmf_hash_str: str, workers: int,
+                          checkpoint_cache: Optional[CheckpointCache]) -> FirmwareSweeper:
+    if ovmf_hash_str:
+        checkpoint_cache = None
+    firmware_gctx, ovmf, firmware_key = snp_firmware_prefix(ovmf_file, ovmf_hash_str, workers, checkpoint_cache)
+    eip = ovmf.sev_es_reset_eip()
+    # The state before the kernel hashes of each VMM type, and the index of
+    # the metadata section to continue from
+    pre_kernel_hashes: Dict[VMMType, Tuple[GCTX, int]] = {}
+
+    def kernel_sweeper(sev_hashes: Optional[SevHashes]) -> Sweeper:
+        prefixes: Dict[VMMType, GCTX] = {}
+
+        def measure(key: Tuple[int, int, VMMType], vcpus: List[int]) -> Dict[int, bytes]:
+            vcpu_sig, guest_features, vmm_type = key
+            if vmm_type not in prefixes:
+                with metrics.stage('metadata_sections'):
+                    if vmm_type not in pre_kernel_hashes:
+                        pre_kernel_hashes[vmm_type] = snp_pre_kernel_hashes_gctx(firmware_gctx.fork(), ovmf, vmm_type,
+                                                                                 checkpoint_cache, firmware_key)
+                    gctx, start = pre_kernel_hashes[vmm_type]
+                    gctx = gctx.fork()
+                    snp_update_metadata_pages(gctx, ovmf, sev_hashes, vmm_type, start=start)
+                prefixes[vmm_type] = gctx
+            vmsa = VMSA(SevMode.SEV_SNP, eip, vcpu_sig, guest_features, vmm_type)
+            return snp_vmsa_launch_digests(prefixes[vmm_type].fork(), vmsa, vcpus)
+
+        return measure
+
+    return kernel_sweeper
+
+
+def _sev_firmware_sweeper(mode: SevMode, ovmf_file: str) -> FirmwareSweeper:
+    with OVMF(ovmf_file) as ovmf:
+        with metrics.stage('firmware_pages'):
+            prefix = hashlib.sha256(ovmf.data())
+    eip = ovmf.sev_es_reset_eip() if mode == SevMode.SEV_ES else 0
+
+    def kernel_sweeper(sev_hashes: Optional[SevHashes]) -> Sweeper:
+        launch_hash = prefix.copy()
+        if sev_hashes is not None:
+            if not ovmf.is_sev_hashes_table_supported():
+                raise RuntimeError("Kernel specified but OVMF doesn't support kernel/initrd/cmdline measurement")
+            launch_hash.update(sev_hashes.construct_table())
+        if mode == SevMode.SEV:
+            return _constant_sweeper(launch_hash.digest())
+        return _seves_vmsa_sweeper(launch_hash, eip)
+
+    return kernel_sweeper
+
+
+def sweep_kernel_launch_digests(mode: SevMode, kernel_inputs: Iterable[KernelInputs], vcpus: int, vcpu_sig: int,
+                                ovmf_file: str, guest_features: int = 0x1, snp_ovmf_hash_str: str = '',
+                                vmm_type: VMMType = VMMType.QEMU, workers: int = 1,
+                                digest_cache: Optional[DigestCache] = None,
+                                checkpoint_cache: Optional[CheckpointCache] = None) -> Dict[KernelInputs, bytes]:
+    """
+    Calculate the launch digest of a guest for every kernel, initrd and
+    command line in kernel_inputs.
+
+    The launch digest state just before the kernel hashes (the
+    SNP_KERNEL_HASHES section in SNP mode, the hashes table after the
+    firmware in SEV and SEV-ES mode) is computed once, and only the rest of
+    the measurement is computed for each input.  Every kernel and initrd file
+    is hashed once, and inputs with identical file contents and command line
+    share their computation.  Returns a dict mapping each input to its launch
+    digest, in the order of kernel_inputs.
+    """
+    kernel_inputs = list(kernel_inputs)
+    if snp_ovmf_hash_str and mode != SevMode.SEV_SNP:
+        raise ValueError("SNP OVMF hash only works with SNP")
+    if any(not inputs.kernel and (inputs.initrd or inputs.append) for inputs in kernel_inputs):
+        raise ValueError("initrd and append require a kernel")
+
+    if mode not in (SevMode.SEV_SNP, SevMode.SEV_ES, SevMode.SEV):
+        raise ValueError("kernel sweeps are only implemented for SEV, SEV-ES and SNP")
+    firmware_sweeper = make_firmware_sweeper(mode, ovmf_file, snp_ovmf_hash_str, workers=workers,
+                                             checkpoint_cache=checkpoint_cache)
+    vmsa_params = vmsa_key(LaunchConfig(vcpus, vcpu_sig, guest_features, vmm_type))
+
+    def measure(sev_hashes: Optional[SevHashes]) -> bytes:
+        return firmware_sweeper(sev_hashes)(vmsa_params, [vcpus])[vcpus]
+
+    hash_file = digest_cache.sha256_file if digest_cache is not None else sha256_file
+    file_digests: Dict[str, bytes] = {}
+
+    def file_digest(filename: str) -> bytes:
+        if filename not in file_digests:
+            file_digests[filename] = hash_file(filename, DEFAULT_CHUNK_SIZE)
+        return file_digests[filename]
+
+    lds: Dict[Optional[Tuple[bytes, bytes, str]], bytes] = {}
+    result = {}
+    for inputs in kernel_inputs:
+        key = None
+        if inputs.kernel:
+            initrd_digest = file_digest(inputs.initrd) if inputs.initrd else hashlib.sha256(b'').digest()
+            key = (file_digest(inputs.kernel), initrd_digest, inputs.append)
+        if key not in lds:
+            lds[key] = measure(SevHashes.from_digests(*key) if key is not None else None)
+        result[inputs] = lds[key]
+    return result
@@ -5,7 +5,10 @@
 
 import ctypes
 from ctypes import c_uint8, c_uint16, c_uint32, c_uint64
-from typing import Iterator
+import functools
+import hashlib
+import struct
+from typing import Iterator, Optional
 from .sev_mode import SevMode
 from .vmm_types import VMMType
 
@@ -139,7 +142,68 @@ class SevEsSaveArea(ctypes.Structure):
     ]
 
 
-class VMSA(object):
+# Offsets of the fields which are patched into the VMSA page templates
+_RIP_OFFSET = SevEsSaveArea.rip.offset
+_CS_BASE_OFFSET = SevEsSaveArea.cs.offset + VmcbSeg.base.offset
+_RDX_OFFSET = SevEsSaveArea.rdx.offset
+_SEV_FEATURES_OFFSET = SevEsSaveArea.sev_features.offset
+_U64 = struct.Struct('<Q')
+
+
+class VMSAPages(object):
+    """
+    Serialized VMSA pages of the BSP and the APs, and their SHA-384 digests.
+
+    All APs share the same initial state, so each distinct page is serialized
+    and hashed once no matter how many vCPUs are measured.
+    """
+
+    def __init__(self, bsp_page: bytes, ap_page: Optional[bytes]):
+        self._bsp_page = bsp_page
+        self._ap_page = ap_page
+        self._bsp_digest: Optional[bytes] = None
+        self._ap_digest: Optional[bytes] = None
+
+    def _ap(self) -> bytes:
+        if self._ap_page is None:
+            raise RuntimeError("Can't generate AP VMSA pages without an AP reset EIP")
+        return self._ap_page
+
+    def pages(self, vcpus: int) -> Iterator[bytes]:
+        """
+        Generate VMSA pages
+        """
+        for i in range(vcpus):
+            if i == 0:
+                yield self._bsp_page
+            else:
+                yield self._ap()
+
+    def page_digests(self, vcpus: int) -> Iterator[bytes]:
+        """
+        Generate the SHA-384 digests of the VMSA pages
+        """
+        for i in range(vcpus):
+            if i == 0:
+                yield self._bsp_page_digest()
+            else:
+                yield self._ap_page_digest()
+
+    def _bsp_page_digest(self) -> bytes:
+        if self._bsp_digest is None:
+            self._bsp_digest = hashlib.sha384(self._bsp_page).digest()
+        return self._bsp_digest
+
+    def _ap_page_digest(self) -> bytes:
+        if self._ap_digest is None:
+            if self._ap() is self._bsp_page:
+                self._ap_digest = self._bsp_page_digest()
+            else:
+                self._ap_digest = hashlib.sha384(self._ap()).digest()
+        return self._ap_digest
+
+
+class VMSA(VMSAPages):
     BSP_EIP = 0xfffffff0
 
     @staticmethod
@@ -199,24 +263,47 @@ class VMSA(object):
             x87_fcw=fcw
         )
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _template(vmm_type: VMMType, bsp: bool) -> bytes:
+        # Apart from the patched fields, the save area only depends on the VMM
+        # type and (for ec2) on whether this is the BSP.
+        eip = VMSA.BSP_EIP if bsp else 0
+        return bytes(VMSA.build_save_area(eip, 0, 0, vmm_type))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def build_save_area_bytes(eip: int, sev_features: int, vcpu_sig: int, vmm_type: VMMType = VMMType.QEMU) -> bytes:
+        """
+        Same as bytes(build_save_area(...)), but patches the variable fields
+        into a cached template instead of constructing the ctypes structure.
+        """
+        page = bytearray(VMSA._template(vmm_type, eip == VMSA.BSP_EIP))
+        _U64.pack_into(page, _RIP_OFFSET, eip & 0xffff)
+        _U64.pack_into(page, _CS_BASE_OFFSET, eip & 0xffff0000)
+        if vmm_type == VMMType.QEMU:
+            _U64.pack_into(page, _RDX_OFFSET, vcpu_sig)
+        _U64.pack_into(page, _SEV_FEATURES_OFFSET, sev_features)
+        return bytes(page)
+
     def __init__(self, sev_mode: SevMode, ap_eip: int, vcpu_sig: int, guest_features: int,
                  vmm_type: VMMType = VMMType.QEMU):
-        self.bsp_save_area = VMSA.build_save_area(self.BSP_EIP, guest_features, vcpu_sig, vmm_type)
+        bsp_page = VMSA.build_save_area_bytes(self.BSP_EIP, guest_features, vcpu_sig, vmm_type)
+        ap_page = None
         if ap_eip:
-            self.ap_save_area = VMSA.build_save_area(ap_eip, guest_features, vcpu_sig, vmm_type)
+            ap_page = VMSA.build_save_area_bytes(ap_eip, guest_features, vcpu_sig, vmm_type)
+        super().__init__(bsp_page, ap_page)
 
-    def pages(self, vcpus: int) -> Iterator[bytes]:
-        """
-        Generate VMSA pages
-        """
-        for i in range(vcpus):
-            if i == 0:
-                yield bytes(self.bsp_save_area)
-            else:
-                yield bytes(self.ap_save_area)
+    @property
+    def bsp_save_area(self) -> SevEsSaveArea:
+        return SevEsSaveArea.from_buffer_copy(self._bsp_page)
 
+    @property
+    def ap_save_area(self) -> SevEsSaveArea:
+        return SevEsSaveArea.from_buffer_copy(self._ap())
 
-class VMSA_SVSM(object):
+
+class VMSA_SVSM(VMSAPages):
     BSP_EIP = 0xfffffff0
 
     @staticmethod
@@ -254,13 +341,29 @@ class VMSA_SVSM(object):
             fcw=fcw
         )
 
-    def __init__(self, ap_eip: int, vcpu_sig: int, vmm_type: VMMType = VMMType.QEMU):
-        sev_features = 0x1
-        self.save_area = VMSA_SVSM.build_save_area(ap_eip, sev_features, vcpu_sig, vmm_type)
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _template(vmm_type: VMMType) -> bytes:
+        return bytes(VMSA_SVSM.build_save_area(0, 0, 0, vmm_type))
 
-    def pages(self, vcpus: int) -> Iterator[bytes]:
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def build_save_area_bytes(eip: int, sev_features: int, vcpu_sig: int, vmm_type: VMMType = VMMType.QEMU) -> bytes:
         """
-        Generate VMSA pages
+        Same as bytes(build_save_area(...)), but patches the variable fields
+        into a cached template instead of constructing the ctypes structure.
         """
-        for i in range(vcpus):
-            yield bytes(self.save_area)
+        page = bytearray(VMSA_SVSM._template(vmm_type))
+        _U64.pack_into(page, _RIP_OFFSET, eip)
+        _U64.pack_into(page, _RDX_OFFSET, vcpu_sig)
+        _U64.pack_into(page, _SEV_FEATURES_OFFSET, sev_features)
+        return bytes(page)
+
+    def __init__(self, ap_eip: int, vcpu_sig: int, vmm_type: VMMType = VMMType.QEMU):
+        sev_features = 0x1
+        page = VMSA_SVSM.build_save_area_bytes(ap_eip, sev_features, vcpu_sig, vmm_type)
+        super().__init__(page, page)
+
+    @property
+    def save_area(self) -> SevEsSaveArea:
+        return SevEsSaveArea.from_buffer_copy(self._bsp_page)
@@ -0,0 +1,100 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import unittest
+
+from sevsnpmeasure import guest
+from sevsnpmeasure import metrics
+from sevsnpmeasure import vcpu_types
+from sevsnpmeasure.aio import calc_launch_digest_async, calc_launch_digest_batch_async
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure.vmm_types import VMMType
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+SIG = vcpu_types.CPU_SIGS["EPYC-v4"]
+
+
+class BlockingExecutor(ThreadPoolExecutor):
+    """
+    Thread pool whose first task blocks until released.
+    """
+
+    def __init__(self):
+        super().__init__(1)
+        self.submitted = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        if self.submitted > 1:
+            return super().submit(fn, *args, **kwargs)
+
+        def blocked():
+            self.started.set()
+            self.release.wait()
+            return fn(*args, **kwargs)
+        return super().submit(blocked)
+
+
+class TestAio(unittest.IsolatedAsyncioTestCase):
+
+    async def test_calc_launch_digest_async(self):
+        for mode in [SevMode.SEV_SNP, SevMode.SEV_ES, SevMode.SEV]:
+            for vmm_type in [VMMType.QEMU, VMMType.ec2]:
+                ld = await calc_launch_digest_async(mode, 2, SIG, OVMF, "/dev/null", None, "console=ttyS0", 0x1,
+                                                    vmm_type=vmm_type)
+                self.assertEqual(ld, guest.calc_launch_digest(mode, 2, SIG, OVMF, "/dev/null", None,
+                                                              "console=ttyS0", 0x1, vmm_type=vmm_type))
+
+    async def test_sev_ignores_vcpus(self):
+        expected = guest.calc_launch_digest(SevMode.SEV, None, SIG, OVMF, None, None, None, 0x1)
+        for vcpus in [None, 0]:
+            self.assertEqual(await calc_launch_digest_async(SevMode.SEV, vcpus, SIG, OVMF, None, None, None, 0x1),
+                             expected)
+        lds = await calc_launch_digest_batch_async([dict(mode=SevMode.SEV, vcpus=None, vcpu_sig=SIG, ovmf_file=OVMF,
+                                                         kernel=None, initrd=None, append=None, guest_features=0x1)])
+        self.assertEqual(lds, [expected])
+        with self.assertRaises(ValueError):
+            await calc_launch_digest_async(SevMode.SEV_SNP, 0, SIG, OVMF, None, None, None, 0x1)
+
+    async def test_svsm(self):
+        ld = await calc_launch_digest_async(SevMode.SEV_SNP_SVSM, 4, SIG, 'tests/fixtures/svsm_ovmf.fd', None, None,
+                                            None, 0x21, svsm_file='tests/fixtures/svsm.bin', ovmf_vars_size=540672)
+        self.assertEqual(
+                ld.hex(),
+                '27d154c27b7b359c935e250ec6fee72aa0ae8c1225e3b0e1cf46a9567e938066d7d6f94bbdc4a857818bdb79277a44b2')
+
+    async def test_batch(self):
+        requests = [dict(mode=SevMode.SEV_SNP, vcpus=vcpus, vcpu_sig=SIG, ovmf_file=OVMF, kernel=None, initrd=None,
+                         append=None, guest_features=0x1) for vcpus in range(1, 9)]
+        lds = await calc_launch_digest_batch_async(requests, max_concurrent=2)
+        self.assertEqual(lds, [guest.calc_launch_digest(**request) for request in requests])
+
+        requests.append(dict(requests[0], vcpus=0))
+        results = await calc_launch_digest_batch_async(requests, return_exceptions=True)
+        self.assertEqual(results[:-1], lds)
+        self.assertIsInstance(results[-1], ValueError)
+
+    async def test_timings(self):
+        timings = metrics.Timings()
+        await calc_launch_digest_async(SevMode.SEV_SNP, 2, SIG, OVMF, "/dev/null", None, None, 0x1, timings=timings)
+        self.assertEqual([stage.name for stage in timings.stages if stage.name != 'metadata_section'],
+                         ['firmware_load', 'firmware_pages', 'kernel_hashes', 'metadata_sections', 'vmsa_pages'])
+
+    async def test_cancel(self):
+        with BlockingExecutor() as executor:
+            task = asyncio.ensure_future(calc_launch_digest_async(SevMode.SEV_SNP, 1, SIG, OVMF, "/dev/null", None,
+                                                                  None, 0x1, executor=executor))
+            await asyncio.get_running_loop().run_in_executor(None, executor.started.wait)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            executor.release.set()
+        # The stages after the firmware never ran
+        self.assertEqual(executor.submitted, 1)
@@ -0,0 +1,151 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import tempfile
+import threading
+import unittest
+
+from sevsnpmeasure import batch
+from sevsnpmeasure import guest
+from sevsnpmeasure import metrics
+from sevsnpmeasure import vcpu_types
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure.vmm_types import VMMType
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+
+
+class TestBatch(unittest.TestCase):
+
+    def requests(self):
+        requests = []
+        for vcpus in [1, 2, 3]:
+            for vmm_type in ['QEMU', 'ec2']:
+                requests.append({'id': f"{vcpus}-{vmm_type}", 'mode': 'snp', 'vcpus': vcpus, 'vcpu-type': 'EPYC-v4',
+                                 'vmm_type': vmm_type, 'ovmf': OVMF, 'kernel': '/dev/null', 'append': 'console=hvc0',
+                                 'guest-features': '0x21'})
+        requests.append({'mode': 'seves', 'vcpus': 2, 'vcpu_family': 25, 'vcpu_model': 1, 'vcpu_stepping': 1,
+                         'ovmf': OVMF})
+        requests.append({'mode': 'sev', 'ovmf': OVMF})
+        return requests
+
+    def expected(self, obj):
+        mode = SevMode.from_str(obj['mode'])
+        sig = vcpu_types.CPU_SIGS['EPYC-v4'] if 'vcpu-type' in obj else vcpu_types.cpu_sig(25, 1, 1)
+        return guest.calc_launch_digest(mode, obj.get('vcpus', 1), sig, OVMF, obj.get('kernel'), None,
+                                        obj.get('append'), int(obj.get('guest-features', '0x1'), 0),
+                                        vmm_type=VMMType[obj.get('vmm_type', 'QEMU')]).hex()
+
+    def test_parse_request(self):
+        request = batch.parse_request({'mode': 'snp', 'vcpus': 4, 'vcpu-sig': '0x800f12', 'ovmf': 'OVMF.fd',
+                                       'vmm-type': 'gce'})
+        self.assertEqual(request, batch.MeasurementRequest('SEV_SNP', 'OVMF.fd', 4, 0x800f12,
+                                                           vmm_type=VMMType.gce))
+        for obj in ["text", {'mode': 'foo', 'ovmf': 'OVMF.fd'}, {'mode': 'snp'},
+                    {'mode': 'snp', 'ovmf': 'OVMF.fd', 'append': 'x'},
+                    {'mode': 'snp', 'ovmf': 'OVMF.fd', 'vmm_type': 'xen'},
+                    {'mode': 'snp', 'ovmf': 'OVMF.fd', 'vcpu_type': 'EPYC-v0'},
+                    {'mode': 'snp', 'ovmf': 'OVMF.fd', 'vcpus': 0, 'vcpu_type': 'EPYC-v4'}]:
+            with self.assertRaises(ValueError):
+                batch.parse_request(obj)
+
+    def test_parse_request_missing_vcpus(self):
+        for mode in ['seves', 'snp', 'snp:svsm']:
+            with self.assertRaisesRegex(ValueError, f"missing vcpus in guest mode '{mode}'"):
+                batch.parse_request({'mode': mode, 'vcpu_type': 'EPYC-v4', 'ovmf': 'OVMF.fd'})
+        self.assertEqual(batch.parse_request({'mode': 'sev', 'ovmf': 'OVMF.fd'}).vcpus, 1)
+        self.assertEqual(batch.parse_request({'mode': 'snp:ovmf-hash', 'ovmf': 'OVMF.fd'}).vcpus, 1)
+
+    def test_parse_request_missing_vcpu_sig(self):
+        for mode in ['seves', 'snp']:
+            with self.assertRaisesRegex(ValueError, f"missing vcpu_type or vcpu_sig or vcpu_family in guest mode '{mode}'"):
+                batch.parse_request({'mode': mode, 'vcpus': 2, 'ovmf': 'OVMF.fd'})
+        # Only QEMU measures the vcpu signature
+        self.assertEqual(batch.parse_request({'mode': 'snp', 'vcpus': 2, 'ovmf': 'OVMF.fd', 'vmm_type': 'ec2'}).vcpu_sig, 0)
+        self.assertEqual(batch.parse_request({'mode': 'snp', 'vcpus': 2, 'vcpu_sig': 0, 'ovmf': 'OVMF.fd'}).vcpu_sig, 0)
+        results = list(batch.measure_requests([{'mode': 'snp', 'vcpus': 2, 'ovmf': OVMF}]))
+        self.assertIn('missing vcpu_type', results[0]['error'])
+
+    def test_measure_requests_in_process(self):
+        requests = self.requests()
+        results = list(batch.measure_requests(requests))
+        self.assertEqual([result['index'] for result in results], list(range(len(requests))))
+        for result, obj in zip(results, requests):
+            self.assertEqual(result['measurement'], self.expected(obj))
+            self.assertEqual(result.get('id'), obj.get('id'))
+
+    def test_measure_requests_process_pool(self):
+        requests = self.requests() + ["not a request"]
+        expected = list(batch.measure_requests(requests))
+        self.assertIn('error', expected[-1])
+        ordered = list(batch.measure_requests(iter(requests), processes=2, max_in_flight=3))
+        self.assertEqual(ordered, expected)
+        unordered = list(batch.measure_requests(iter(requests), processes=2, ordered=False))
+        self.assertEqual(sorted(unordered, key=lambda result: result['index']), expected)
+
+    def test_measure_requests_streams_results(self):
+        request = self.requests()[-1]
+        first_result = threading.Event()
+
+        def requests():
+            yield request
+            # The next request only arrives once the first result is out
+            if not first_result.wait(60):
+                raise RuntimeError("first result not yielded")
+            yield request
+
+        results = batch.measure_requests(requests(), processes=2)
+        self.assertEqual(next(results)['index'], 0)
+        first_result.set()
+        self.assertEqual([result['index'] for result in results], [1])
+
+    def test_measure_requests_reader_error(self):
+        def requests():
+            yield self.requests()[-1]
+            raise OSError("read error")
+
+        with self.assertRaisesRegex(OSError, "read error"):
+            list(batch.measure_requests(requests(), processes=2))
+
+    def test_measure_request_follows_file_changes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            kernel = os.path.join(tmp, 'kernel')
+            with open(kernel, 'wb') as f:
+                f.write(b'kernel 1')
+            request = batch.MeasurementRequest('SEV_SNP', OVMF, kernel=kernel)
+            batch.init_state(None)
+            ld1 = batch.measure_request(request)
+            with open(kernel, 'wb') as f:
+                f.write(b'kernel 2 is longer')
+            ld2 = batch.measure_request(request)
+            self.assertNotEqual(ld1, ld2)
+            self.assertEqual(ld2, guest.calc_launch_digest(SevMode.SEV_SNP, 1, 0, OVMF, kernel, None, None, 0x1))
+
+    def test_measure_request_reuses_firmware(self):
+        requests = [batch.MeasurementRequest(mode.name, OVMF, 2, vmm_type=vmm_type, kernel='/dev/null', append=append)
+                    for mode in [SevMode.SEV_SNP, SevMode.SEV_ES, SevMode.SEV]
+                    for vmm_type in [VMMType.QEMU, VMMType.ec2]
+                    for append in ['console=ttyS0', 'console=hvc0', 'quiet']]
+        batch.init_state(None)
+        metrics.REGISTRY.reset()
+        metrics.REGISTRY.enable()
+        try:
+            lds = [batch.measure_request(request) for request in requests]
+            values = metrics.REGISTRY.render_prometheus()
+        finally:
+            metrics.REGISTRY.disable()
+            metrics.REGISTRY.reset()
+        for ld, request in zip(lds, requests):
+            self.assertEqual(ld, guest.calc_launch_digest(SevMode[request.mode], 2, 0, OVMF, '/dev/null', None,
+                                                          request.append, 0x1, vmm_type=request.vmm_type))
+        # The firmware of each mode is measured once for all the command
+        # lines (and VMM types, which share the state up to the VMSA pages)
+        self.assertIn('sevsnpmeasure_cache_requests_total{cache="firmware",result="miss"} 3', values)
+        self.assertIn('sevsnpmeasure_cache_requests_total{cache="firmware",result="hit"} 6', values)
+        self.assertIn('sevsnpmeasure_stage_seconds_count{stage="firmware_pages"} 3', values)
+
+    def test_read_requests(self):
+        self.assertEqual(list(batch.read_requests(['{"mode": "sev"}\n', '\n', 'x\n'])), [{'mode': 'sev'}, 'x'])
@@ -0,0 +1,189 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from sevsnpmeasure import guest
+from sevsnpmeasure.cache import CheckpointCache, DigestCache, DiskCache, file_identity
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure.vcpu_types import CPU_SIGS
+from sevsnpmeasure.vmm_types import VMMType
+
+
+class TestDigestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+        self.kernel = os.path.join(self.tmpdir.name, "kernel")
+        pathlib.Path(self.kernel).write_bytes(b'kernel' * 1000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _cache_files(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_hit_and_miss(self):
+        cache = DigestCache(self.cache_dir)
+        expected = hashlib.sha256(b'kernel' * 1000).digest()
+        self.assertEqual(cache.sha256_file(self.kernel), expected)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        # A new instance (as in another process) sees the entry
+        cache = DigestCache(self.cache_dir)
+        self.assertEqual(cache.sha256_file(self.kernel), expected)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(len(self._cache_files()), 1)
+
+    def test_modified_file_is_rehashed(self):
+        cache = DigestCache(self.cache_dir)
+        cache.sha256_file(self.kernel)
+        pathlib.Path(self.kernel).write_bytes(b'other')
+        st = os.stat(self.kernel)
+        os.utime(self.kernel, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual(cache.sha256_file(self.kernel), hashlib.sha256(b'other').digest())
+        self.assertEqual(cache.misses, 2)
+
+    def test_verify_detects_change_with_same_identity(self):
+        cache = DigestCache(self.cache_dir)
+        cache.sha256_file(self.kernel)
+        identity = file_identity(self.kernel)
+        st = os.stat(self.kernel)
+        modified = b'KERNEL' * 1000
+        pathlib.Path(self.kernel).write_bytes(modified)
+        os.utime(self.kernel, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(file_identity(self.kernel), identity)
+        self.assertNotEqual(DigestCache(self.cache_dir).sha256_file(self.kernel), hashlib.sha256(modified).digest())
+        verifying = DigestCache(self.cache_dir, verify=True)
+        self.assertEqual(verifying.sha256_file(self.kernel), hashlib.sha256(modified).digest())
+        # The stale entry was replaced
+        self.assertEqual(DigestCache(self.cache_dir).sha256_file(self.kernel), hashlib.sha256(modified).digest())
+
+    def test_non_regular_files_are_not_cached(self):
+        cache = DigestCache(self.cache_dir)
+        self.assertIsNone(file_identity("/dev/null"))
+        self.assertEqual(cache.sha256_file("/dev/null"), hashlib.sha256(b'').digest())
+        self.assertEqual(self._cache_files(), [])
+
+    def test_lru_eviction(self):
+        cache = DiskCache(self.cache_dir, max_size=2000)
+        for i in range(50):
+            cache.put(f"key{i}", {'value': 'x' * 50})
+            # Keep the first entry in use
+            self.assertIsNotNone(cache.get("key0"))
+        total = sum(os.path.getsize(os.path.join(self.cache_dir, f)) for f in self._cache_files())
+        self.assertLessEqual(total, 2000)
+        self.assertIsNotNone(cache.get("key0"))
+        self.assertIsNotNone(cache.get("key49"))
+        self.assertIsNone(cache.get("key1"))
+
+    def test_corrupted_entries(self):
+        cache = DigestCache(self.cache_dir)
+        expected = cache.sha256_file(self.kernel)
+        [name] = self._cache_files()
+        path = os.path.join(self.cache_dir, name)
+        key = 'sha256:' + file_identity(self.kernel).key()
+        for corrupted in [b'{"key": ', b'[]', json.dumps({'key': key}).encode(),
+                          json.dumps({'key': key, 'value': {'digest': 'not hex'}}).encode(),
+                          json.dumps({'key': key, 'value': {}}).encode()]:
+            pathlib.Path(path).write_bytes(corrupted)
+            cache = DigestCache(self.cache_dir)
+            # Treated as a miss, and replaced by a valid entry
+            self.assertEqual(cache.sha256_file(self.kernel), expected)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            self.assertEqual(DigestCache(self.cache_dir).sha256_file(self.kernel), expected)
+        pathlib.Path(path).write_bytes(b'garbage')
+        self.assertIsNone(DiskCache(self.cache_dir).get(key))
+        self.assertEqual(self._cache_files(), [])
+
+    def test_size_is_tracked(self):
+        cache = DiskCache(self.cache_dir, max_size=2000)
+        cache.put("key0", {'value': 'x' * 50})
+        with mock.patch('os.scandir', side_effect=AssertionError("scanned")):
+            # Below max_size, and replacing an entry doesn't grow the cache
+            for _ in range(10):
+                cache.put("key1", {'value': 'x' * 50})
+            for i in range(2, 10):
+                cache.put(f"key{i}", {'value': 'x' * 50})
+
+    def test_concurrent_writers(self):
+        def worker():
+            cache = DiskCache(self.cache_dir, max_size=4000)
+            for i in range(30):
+                cache.put(f"key{i % 10}", {'i': i % 10})
+                entry = cache.get(f"key{i % 10}")
+                if entry is not None:
+                    self.assertEqual(entry, {'i': i % 10})
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse([f for f in self._cache_files() if not f.endswith('.json')])
+
+    def test_calc_launch_digest_with_cache(self):
+        args = (SevMode.SEV_SNP, 2, CPU_SIGS["EPYC-v4"], "tests/fixtures/ovmf_AmdSev_suffix.bin",
+                self.kernel, None, "console=ttyS0", 0x21)
+        expected = guest.calc_launch_digest(*args)
+        cache = DigestCache(self.cache_dir)
+        self.assertEqual(guest.calc_launch_digest(*args, digest_cache=cache), expected)
+        self.assertEqual(guest.calc_launch_digest(*args, digest_cache=cache), expected)
+        self.assertEqual(cache.hits, 1)
+
+
+class TestCheckpointCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_snp_checkpoints(self):
+        ovmf = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+        for vmm_type in VMMType:
+            for kernel, append in [(None, None), ("/dev/null", ""), ("/dev/null", "console=ttyS0")]:
+                args = (SevMode.SEV_SNP, 2, CPU_SIGS["EPYC-v4"], ovmf, kernel, None, append, 0x21)
+                expected = guest.calc_launch_digest(*args, vmm_type=vmm_type)
+                for _ in range(2):
+                    cache = CheckpointCache(self.cache_dir)
+                    self.assertEqual(guest.calc_launch_digest(*args, vmm_type=vmm_type, checkpoint_cache=cache),
+                                     expected, (vmm_type, kernel, append))
+        # The second run of each configuration only used cached checkpoints
+        self.assertEqual(cache.misses, 0)
+        self.assertEqual(cache.hits, 2)
+
+    def test_ovmf_hash_checkpoint(self):
+        ovmf = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+        expected = guest.calc_snp_ovmf_hash(ovmf)
+        cache = CheckpointCache(self.cache_dir)
+        self.assertEqual(guest.calc_snp_ovmf_hash(ovmf, checkpoint_cache=cache), expected)
+        self.assertEqual(guest.calc_snp_ovmf_hash(ovmf, checkpoint_cache=cache), expected)
+        self.assertEqual(cache.hits, 1)
+
+    def test_svsm_checkpoint(self):
+        args = (SevMode.SEV_SNP_SVSM, 2, CPU_SIGS["EPYC-v4"], 'tests/fixtures/svsm_ovmf.fd', None, None, None, 0x21,
+                None, VMMType.QEMU, False, 'tests/fixtures/svsm.bin', 540672)
+        expected = guest.calc_launch_digest(*args)
+        for _ in range(2):
+            cache = CheckpointCache(self.cache_dir)
+            self.assertEqual(guest.calc_launch_digest(*args, checkpoint_cache=cache), expected)
+        self.assertEqual(cache.hits, 1)
+
+    def test_kernel_without_kernel_hashes_section_still_fails(self):
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                guest.calc_launch_digest(SevMode.SEV_SNP, 1, CPU_SIGS["EPYC-v4"],
+                                         "tests/fixtures/ovmf_OvmfX64_suffix.bin", "/dev/null", None, None, 0x21,
+                                         checkpoint_cache=CheckpointCache(self.cache_dir))
@@ -1,6 +1,10 @@
+import contextlib
+import io
+import sys
 import unittest
-from argparse import Namespace
-from sevsnpmeasure.cli import get_vcpu_sig
+from argparse import ArgumentTypeError, Namespace
+from unittest import mock
+from sevsnpmeasure.cli import SUBCOMMANDS, get_vcpu_sig, int_list_arg, main, vcpus_arg, vcpus_list_arg
 from sevsnpmeasure.vmm_types import VMMType
 from sevsnpmeasure.vcpu_types import CPU_SIGS, cpu_sig
 
@@ -44,3 +48,28 @@ class TestCLI(unittest.TestCase):
         expected = cpu_sig(CPU_FAMILY, CPU_MODEL, CPU_STEPPING)
         sig = get_vcpu_sig(None, args, VMMType.QEMU)
         self.assertEqual(sig, expected)
+
+    def test_vcpus_arg(self):
+        self.assertEqual(vcpus_arg("4"), 4)
+        self.assertEqual(vcpus_arg("1-512"), range(1, 513))
+        self.assertEqual(vcpus_arg("3-3"), range(3, 4))
+        for s in ["4-1", "0-4", "1-", "a-b", "x"]:
+            with self.assertRaises(ArgumentTypeError):
+                vcpus_arg(s)
+
+    def test_list_args(self):
+        self.assertEqual(vcpus_list_arg("4,1-3,2"), [1, 2, 3, 4])
+        self.assertEqual(int_list_arg("0x1,33"), [1, 33])
+        for s in ["0", "1,,2"]:
+            with self.assertRaises(ArgumentTypeError):
+                vcpus_list_arg(s)
+        with self.assertRaises(ArgumentTypeError):
+            int_list_arg("1,x")
+
+    def test_help_lists_subcommands(self):
+        out = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['sev-snp-measure', '--help']), contextlib.redirect_stdout(out):
+            with self.assertRaises(SystemExit):
+                main()
+        epilog = out.getvalue().split('subcommands:\n')[1]
+        self.assertEqual([line.split()[0] for line in epilog.splitlines()[:len(SUBCOMMANDS)]], list(SUBCOMMANDS))
@@ -0,0 +1,108 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import threading
+import time
+import unittest
+
+from sevsnpmeasure import guest
+from sevsnpmeasure import metrics
+from sevsnpmeasure.concurrency import LimiterStats, MeasurementLimiter, Overloaded
+from sevsnpmeasure.sev_mode import SevMode
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+
+
+class BlockingCalc(object):
+    """
+    Stand-in for calc_launch_digest which blocks until released.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def __call__(self, mode, vcpus, *args, **kwargs):
+        self.calls.append(vcpus)
+        self.release.wait()
+        if vcpus == 0:
+            raise ValueError("no vcpus")
+        return bytes([vcpus])
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def start(self, limiter, vcpus, results):
+        def measure():
+            try:
+                results.append(limiter.calc_launch_digest(SevMode.SEV_SNP, vcpus, 0, OVMF, None, None, None, 0x1))
+            except Exception as e:
+                results.append(e)
+        thread = threading.Thread(target=measure)
+        thread.start()
+        return thread
+
+    def wait_for(self, limiter, **counters):
+        deadline = time.monotonic() + 10
+        while any(getattr(limiter.stats(), name) != value for name, value in counters.items()):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_coalesce(self):
+        calc = BlockingCalc()
+        limiter = MeasurementLimiter(calc=calc)
+        results = []
+        threads = [self.start(limiter, 3, results) for _ in range(5)]
+        self.wait_for(limiter, running=1, coalesced=4)
+        calc.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b'\x03'] * 5)
+        self.assertEqual(calc.calls, [3])
+        self.assertEqual(limiter.stats(), LimiterStats(0, 0, 1, 0, 4, 0))
+
+    def test_overloaded(self):
+        metrics.REGISTRY.reset()
+        metrics.REGISTRY.enable()
+        self.addCleanup(metrics.REGISTRY.reset)
+        self.addCleanup(metrics.REGISTRY.disable)
+        calc = BlockingCalc()
+        limiter = MeasurementLimiter(max_concurrent=1, max_queue=1, calc=calc)
+        results = []
+        threads = [self.start(limiter, 1, results)]
+        self.wait_for(limiter, running=1)
+        threads.append(self.start(limiter, 2, results))
+        self.wait_for(limiter, queued=1)
+        with self.assertRaises(Overloaded):
+            limiter.calc_launch_digest(SevMode.SEV_SNP, 4, 0, OVMF, None, None, None, 0x1)
+        # Identical requests are still coalesced
+        threads.append(self.start(limiter, 2, results))
+        self.wait_for(limiter, coalesced=1)
+        calc.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [b'\x01', b'\x02', b'\x02'])
+        self.assertEqual(limiter.stats(), LimiterStats(0, 0, 2, 0, 1, 1))
+        values = metrics.REGISTRY.render_prometheus()
+        for outcome, count in [('computed', 2), ('coalesced', 1), ('rejected', 1), ('queued', 1)]:
+            self.assertIn(f'sevsnpmeasure_limiter_requests_total{{result="{outcome}"}} {count}\n', values)
+
+    def test_error(self):
+        calc = BlockingCalc()
+        limiter = MeasurementLimiter(calc=calc)
+        results = []
+        threads = [self.start(limiter, 0, results) for _ in range(2)]
+        self.wait_for(limiter, coalesced=1)
+        calc.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([type(result) for result in results], [ValueError, ValueError])
+        self.assertEqual(limiter.stats(), LimiterStats(0, 0, 0, 1, 1, 0))
+
+    def test_calc_launch_digest(self):
+        limiter = MeasurementLimiter()
+        self.assertEqual(limiter.calc_launch_digest(SevMode.SEV_SNP, 2, 0, OVMF, None, None, None, 0x1),
+                         guest.calc_launch_digest(SevMode.SEV_SNP, 2, 0, OVMF, None, None, None, 0x1))
+        self.assertEqual(limiter.stats(), LimiterStats(0, 0, 1, 0, 0, 0))
@@ -0,0 +1,152 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from sevsnpmeasure import batch
+from sevsnpmeasure import guest
+from sevsnpmeasure import vcpu_types
+from sevsnpmeasure.daemon import MeasurementClient, MeasurementServer
+from sevsnpmeasure.sev_mode import SevMode
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'socket')
+        self.server = MeasurementServer(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.assertFalse(os.path.exists(self.path))
+        self.tmp.cleanup()
+
+    def test_live_socket_is_kept(self):
+        with self.assertRaisesRegex(RuntimeError, 'already listening'):
+            MeasurementServer(self.path)
+        with MeasurementClient(self.path) as client:
+            self.assertIn('measurement', client.measure({'mode': 'sev', 'ovmf': OVMF}))
+
+    def test_stale_socket_is_replaced(self):
+        path = os.path.join(self.tmp.name, 'stale')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.bind(path)
+        server = MeasurementServer(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with MeasurementClient(path) as client:
+                self.assertIn('measurement', client.measure({'mode': 'sev', 'ovmf': OVMF}))
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    def test_measure(self):
+        with MeasurementClient(self.path) as client:
+            for vcpus in [1, 4, 2]:
+                result = client.measure({'id': vcpus, 'mode': 'snp', 'vcpus': vcpus, 'vcpu-type': 'EPYC-v4',
+                                         'ovmf': OVMF})
+                expected = guest.calc_launch_digest(SevMode.SEV_SNP, vcpus, vcpu_types.CPU_SIGS['EPYC-v4'], OVMF,
+                                                    None, None, None, 0x1)
+                self.assertEqual(result['id'], vcpus)
+                self.assertEqual(result['measurement'], expected.hex())
+            result = client.measure({'mode': 'snp:ovmf-hash', 'ovmf': OVMF})
+            self.assertEqual(result['measurement'], guest.calc_snp_ovmf_hash(OVMF).hex())
+            self.assertIn('error', client.measure({'mode': 'snp'}))
+
+    def test_concurrent_clients(self):
+        results = {}
+
+        def measure(vcpus):
+            with MeasurementClient(self.path) as client:
+                results[vcpus] = client.measure({'mode': 'seves', 'vcpus': vcpus, 'vcpu-type': 'EPYC-v4',
+                                                 'ovmf': OVMF})['measurement']
+
+        threads = [threading.Thread(target=measure, args=(vcpus,)) for vcpus in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for vcpus, ld in results.items():
+            expected = guest.calc_launch_digest(SevMode.SEV_ES, vcpus, vcpu_types.CPU_SIGS['EPYC-v4'], OVMF,
+                                                None, None, None, 0x1)
+            self.assertEqual(ld, expected.hex())
+        self.assertEqual(len(results), 4)
+
+    def test_follows_file_changes(self):
+        kernel = os.path.join(self.tmp.name, 'kernel')
+        with MeasurementClient(self.path) as client:
+            for contents in [b'kernel 1', b'kernel 2 is longer']:
+                with open(kernel, 'wb') as f:
+                    f.write(contents)
+                result = client.measure({'mode': 'snp', 'vcpus': 1, 'vcpu-type': 'EPYC-v4', 'ovmf': OVMF,
+                                         'kernel': kernel})
+                expected = guest.calc_launch_digest(SevMode.SEV_SNP, 1, vcpu_types.CPU_SIGS['EPYC-v4'], OVMF, kernel,
+                                                    None, None, 0x1)
+                self.assertEqual(result['measurement'], expected.hex())
+
+    def test_servers_have_their_own_state(self):
+        path = os.path.join(self.tmp.name, 'other')
+        server = MeasurementServer(path, max_concurrent=4)
+        self.assertIsNot(server.state, self.server.state)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            request = {'mode': 'snp', 'vcpus': 1, 'vcpu-type': 'EPYC-v4', 'ovmf': OVMF}
+            with MeasurementClient(self.path) as client, MeasurementClient(path) as other:
+                self.assertEqual(client.measure(request), other.measure(request))
+            # Each server measured the request, and a batch run in the same
+            # process doesn't reset them
+            list(batch.measure_requests([request]))
+            for measurement_server in [self.server, server]:
+                self.assertEqual(measurement_server.limiter.stats().computed, 1)
+                self.assertEqual(len(measurement_server.state._sweepers), 1)
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    def test_overloaded(self):
+        path = os.path.join(self.tmp.name, 'overloaded')
+        server = MeasurementServer(path, max_queue=0)
+        started = threading.Event()
+        release = threading.Event()
+
+        def measure(request):
+            started.set()
+            release.wait()
+            return b'\0'
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with mock.patch.object(server.state, '_measure', side_effect=measure), \
+                    MeasurementClient(path) as client, MeasurementClient(path) as other:
+                first = threading.Thread(target=client.measure, args=({'mode': 'sev', 'ovmf': OVMF},))
+                first.start()
+                started.wait()
+                result = other.measure({'mode': 'seves', 'vcpus': 1, 'vcpu-type': 'EPYC-v4', 'ovmf': OVMF})
+                release.set()
+                first.join()
+            self.assertIn('Too many measurements', result['error'])
+            self.assertEqual(server.limiter.stats().rejected, 1)
+        finally:
+            release.set()
+            server.shutdown()
+            thread.join()
+            server.server_close()
@@ -0,0 +1,113 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from sevsnpmeasure import diff
+from sevsnpmeasure.batch import MeasurementRequest
+from sevsnpmeasure.gctx import PageType
+from sevsnpmeasure.ovmf import SectionType
+from sevsnpmeasure.vmm_types import VMMType
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+
+
+class TestDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.threads = threading.active_count()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.kernels = []
+        for name in ['kernel1', 'kernel2']:
+            path = os.path.join(self.tmp.name, name)
+            with open(path, 'wb') as f:
+                f.write(name.encode() * 1000)
+            self.kernels.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def request(self, **kwargs):
+        return MeasurementRequest(**dict(dict(mode='SEV_SNP', ovmf=OVMF, vcpus=2), **kwargs))
+
+    def test_same(self):
+        self.assertIsNone(diff.diff_measurements(self.request(), self.request()))
+
+    def test_kernel(self):
+        difference = diff.diff_measurements(self.request(kernel=self.kernels[0]),
+                                            self.request(kernel=self.kernels[1], vcpus=4))
+        self.assertEqual(difference.fields, ('contents',))
+        self.assertEqual(difference.inputs, ('kernel',))
+        for page in [difference.first, difference.second]:
+            self.assertEqual(page.record.page_type, PageType.NORMAL)
+            self.assertEqual(page.region, diff.METADATA)
+            self.assertEqual(page.section.section_type(), SectionType.SNP_KERNEL_HASHES)
+            self.assertEqual(page.record.gpa, page.section.gpa)
+        self.assertIn('SNP_KERNEL_HASHES section', str(difference))
+        self.assertEqual(difference.to_json()['first']['section']['section_type'], 'SNP_KERNEL_HASHES')
+
+    def test_vcpus(self):
+        difference = diff.diff_measurements(self.request(vcpus=3), self.request(vcpus=2))
+        self.assertEqual(difference.fields, ())
+        self.assertEqual(difference.inputs, ('vcpus',))
+        self.assertIsNone(difference.second)
+        self.assertEqual(difference.first.record.page_type, PageType.VMSA)
+        self.assertEqual(difference.first.region, diff.VMSA_REGION)
+        self.assertIn('end of measurement', str(difference))
+
+    def test_vmsa(self):
+        difference = diff.diff_measurements(self.request(guest_features=0x1), self.request(guest_features=0x21))
+        self.assertEqual(difference.fields, ('contents',))
+        self.assertEqual(difference.inputs, ('guest_features',))
+        self.assertEqual(difference.first.region, diff.VMSA_REGION)
+
+    def test_vmm_type(self):
+        difference = diff.diff_measurements(self.request(), self.request(vmm_type=VMMType.ec2))
+        self.assertEqual(difference.inputs, ('vmm_type',))
+        self.assertEqual(difference.first.section.section_type(), SectionType.CPUID)
+
+    def test_ovmf_hash(self):
+        difference = diff.diff_measurements(self.request(), self.request(snp_ovmf_hash='00' * 48))
+        self.assertEqual(difference.page_index, 0)
+        self.assertEqual(difference.first.region, diff.FIRMWARE)
+        self.assertEqual(difference.inputs, ('snp_ovmf_hash',))
+
+    def test_seed(self):
+        difference = diff.diff_measurements(self.request(snp_ovmf_hash='00' * 48),
+                                            self.request(snp_ovmf_hash='11' * 48))
+        self.assertEqual(difference.page_index, 0)
+        self.assertEqual(difference.fields, ('ld',))
+        self.assertEqual(difference.inputs, ('snp_ovmf_hash',))
+
+    def test_svsm(self):
+        request = self.request(mode='SEV_SNP_SVSM', ovmf='tests/fixtures/svsm_ovmf.fd', vcpus=1,
+                               svsm='tests/fixtures/svsm.bin', vars_size=540672)
+        difference = diff.diff_measurements(request, request._replace(vars_size=0))
+        self.assertEqual(difference.fields, ('gpa',))
+        self.assertEqual(difference.inputs, ('vars_size',))
+        self.assertEqual(difference.first.region, diff.SVSM_REGION)
+
+    def test_unsupported_mode(self):
+        with self.assertRaises(ValueError):
+            diff.diff_measurements(self.request(mode='SEV'), self.request())
+
+    def test_error(self):
+        with self.assertRaises(OSError):
+            diff.diff_measurements(self.request(), self.request(kernel=os.path.join(self.tmp.name, 'missing')))
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def test_streaming(self):
+        # Chunks of a few pages, with the measurements blocking on full
+        # queues and stopped at the first difference
+        with mock.patch.object(diff, 'CHUNK_PAGES', 2), mock.patch.object(diff, 'QUEUE_CHUNKS', 1):
+            difference = diff.diff_measurements(self.request(kernel=self.kernels[0]),
+                                                self.request(kernel=self.kernels[1]))
+            self.assertEqual(difference.first.section.section_type(), SectionType.SNP_KERNEL_HASHES)
+            self.assertIsNone(diff.diff_measurements(self.request(), self.request()))
+        self.assertEqual(threading.active_count(), self.threads)
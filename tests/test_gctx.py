@@ -0,0 +1,151 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import hashlib
+import pathlib
+import unittest
+
+from sevsnpmeasure.gctx import GCTX, GCTXSnapshot, ZEROS, LD_SIZE, le8, le16, le64
+
+
+class ReferenceGCTX(object):
+    """
+    Straightforward GCTX implementation which builds every PAGE_INFO
+    structure from scratch; used to check the optimized GCTX.
+    """
+
+    def __init__(self, seed: bytes = ZEROS):
+        self._ld = seed
+
+    def ld(self) -> bytes:
+        return self._ld
+
+    def _update(self, page_type, gpa, contents):
+        assert len(contents) == LD_SIZE
+        page_info = self._ld + contents
+        page_info += le16(0x70) + le8(page_type) + le8(0)
+        page_info += le8(0) + le8(0) + le8(0) + le8(0)
+        page_info += le64(gpa)
+        assert len(page_info) == 0x70
+        self._ld = hashlib.sha384(page_info).digest()
+
+    def update_normal_pages(self, start_gpa, data):
+        for offset in range(0, len(data), 4096):
+            self._update(0x01, start_gpa + offset, hashlib.sha384(data[offset:offset+4096]).digest())
+
+    def update_vmsa_page(self, data):
+        self._update(0x02, GCTX.VMSA_GPA, hashlib.sha384(data).digest())
+
+    def update_range(self, page_type, gpa, length_bytes):
+        for offset in range(0, length_bytes, 4096):
+            self._update(page_type, gpa + offset, ZEROS)
+
+
+class TestGCTX(unittest.TestCase):
+
+    def test_normal_pages_match_reference(self):
+        data = pathlib.Path("tests/fixtures/svsm_ovmf.fd").read_bytes()
+        gpa = 0x100000000 - len(data)
+        gctx = GCTX()
+        ref = ReferenceGCTX()
+        gctx.update_normal_pages(gpa, data)
+        ref.update_normal_pages(gpa, data)
+        self.assertEqual(gctx.ld(), ref.ld())
+
+    def test_normal_pages_accept_memoryview(self):
+        data = pathlib.Path("tests/fixtures/ovmf_AmdSev_suffix.bin").read_bytes()
+        gctx1 = GCTX()
+        gctx1.update_normal_pages(0xfffff000, data)
+        gctx2 = GCTX()
+        gctx2.update_normal_pages(0xfffff000, memoryview(bytearray(data)))
+        self.assertEqual(gctx1.ld(), gctx2.ld())
+
+    def test_range_pages_match_reference(self):
+        seed = hashlib.sha384(b"seed").digest()
+        gctx = GCTX(seed=seed)
+        ref = ReferenceGCTX(seed=seed)
+
+        gctx.update_zero_pages(0x800000, 0x9000)
+        ref.update_range(0x03, 0x800000, 0x9000)
+        gctx.update_unmeasured_pages(0x809000, 0x3000)
+        ref.update_range(0x04, 0x809000, 0x3000)
+        gctx.update_secrets_page(0x80c000)
+        ref.update_range(0x05, 0x80c000, 0x1000)
+        gctx.update_cpuid_page(0x80d000)
+        ref.update_range(0x06, 0x80d000, 0x1000)
+        gctx.update_secrets_pages(0x80e000, 0x2000)
+        ref.update_range(0x05, 0x80e000, 0x2000)
+        gctx.update_cpuid_pages(0x810000, 0x2000)
+        ref.update_range(0x06, 0x810000, 0x2000)
+        self.assertEqual(gctx.ld(), ref.ld())
+
+    def test_vmsa_pages_match_reference(self):
+        pages = [bytes([i]) * 4096 for i in range(3)]
+        gctx = GCTX()
+        ref = ReferenceGCTX()
+        gctx.update_vmsa_pages(pages)
+        for page in pages:
+            ref.update_vmsa_page(page)
+        self.assertEqual(gctx.ld(), ref.ld())
+
+    def test_pipelined_normal_pages_match_sequential(self):
+        data = pathlib.Path("tests/fixtures/svsm_ovmf.fd").read_bytes()
+        gpa = 0x100000000 - len(data)
+        sequential = GCTX()
+        sequential.update_normal_pages(gpa, data)
+        for workers in [2, 3, 8]:
+            pipelined = GCTX()
+            pipelined.update_normal_pages(gpa, data, workers=workers)
+            self.assertEqual(pipelined.ld(), sequential.ld())
+
+    def test_empty_range_keeps_digest(self):
+        gctx = GCTX()
+        gctx.update_zero_pages(0x1000, 0)
+        gctx.update_normal_pages(0x1000, b'')
+        self.assertEqual(gctx.ld(), ZEROS)
+
+    def test_fork_branches_from_shared_prefix(self):
+        prefix = GCTX()
+        prefix.update_zero_pages(0x800000, 0x3000)
+        fork = prefix.fork()
+        fork.update_secrets_page(0x803000)
+        prefix.update_cpuid_page(0x803000)
+        ref = GCTX()
+        ref.update_zero_pages(0x800000, 0x3000)
+        ref.update_secrets_page(0x803000)
+        self.assertEqual(fork.ld(), ref.ld())
+        self.assertNotEqual(prefix.ld(), fork.ld())
+        self.assertEqual(fork.pages(), 4)
+
+    def test_snapshot_records_state(self):
+        gctx = GCTX()
+        self.assertEqual(gctx.snapshot(), GCTXSnapshot(ZEROS, 0, ''))
+        gctx.update_normal_pages(0x1000, bytes(0x2000))
+        gctx.update_unmeasured_pages(0x3000, 0x1000)
+        snapshot = gctx.snapshot()
+        self.assertEqual(snapshot.ld, gctx.ld())
+        self.assertEqual(snapshot.pages, 3)
+        self.assertEqual(snapshot.last_op, "UNMEASURED gpa=0x3000 pages=1")
+
+    def test_snapshot_serialization_roundtrip(self):
+        gctx = GCTX()
+        gctx.update_vmsa_page(bytes(4096))
+        snapshot = gctx.snapshot()
+        for restored in [GCTXSnapshot.from_bytes(snapshot.to_bytes()),
+                         GCTXSnapshot.from_json(snapshot.to_json())]:
+            self.assertEqual(restored, snapshot)
+            resumed = GCTX.restore(restored)
+            resumed.update_vmsa_page(bytes(4096))
+            gctx_copy = gctx.fork()
+            gctx_copy.update_vmsa_page(bytes(4096))
+            self.assertEqual(resumed.snapshot(), gctx_copy.snapshot())
+
+    def test_invalid_snapshot(self):
+        data = GCTX().snapshot().to_bytes()
+        for buf in [b'', data[:-1], b'XXXX' + data[4:], data + b'x']:
+            with self.assertRaises(ValueError):
+                GCTXSnapshot.from_bytes(buf)
+        with self.assertRaises(ValueError):
+            GCTXSnapshot.from_json('{"version": 1, "ld": "00", "pages": 0, "last_op": ""}')
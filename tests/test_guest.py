@@ -3,7 +3,9 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
+import mmap
 import unittest
+from unittest import mock
 from sevsnpmeasure import guest
 from sevsnpmeasure import vcpu_types
 from sevsnpmeasure import vmm_types
@@ -473,6 +475,55 @@ class TestGuest(unittest.TestCase):
                 ld.hex(),
                 '9b94745036aafddf4f7f8b00c7513abb5b7703178cb95aaa57928bd963d68d3bfcb715d6019b9167ee2517b11b0d9be7')
 
+    def test_snp_svsm_4_vcpus_with_workers(self):
+        ld = guest.calc_launch_digest(
+                SevMode.SEV_SNP_SVSM,
+                4,
+                vcpu_types.CPU_SIGS["EPYC-v4"],
+                'tests/fixtures/svsm_ovmf.fd',
+                None,
+                None,
+                None,
+                0x21,
+                None,
+                vmm_types.VMMType.QEMU,
+                False,
+                'tests/fixtures/svsm.bin',
+                540672,
+                workers=4)
+        self.assertEqual(
+                ld.hex(),
+                '27d154c27b7b359c935e250ec6fee72aa0ae8c1225e3b0e1cf46a9567e938066d7d6f94bbdc4a857818bdb79277a44b2')
+
+    def test_launch_digests_range_matches_single_counts(self):
+        common = (vcpu_types.CPU_SIGS["EPYC-v4"], "tests/fixtures/ovmf_AmdSev_suffix.bin",
+                  "/dev/null", "/dev/null", "", 0x21)
+        for mode in [SevMode.SEV_SNP, SevMode.SEV_ES, SevMode.SEV]:
+            lds = guest.calc_launch_digests(mode, range(1, 6), *common)
+            self.assertEqual(list(lds), [1, 2, 3, 4, 5])
+            for vcpus in [1, 2, 5]:
+                self.assertEqual(lds[vcpus], guest.calc_launch_digest(mode, vcpus, *common))
+        lds = guest.calc_launch_digests(SevMode.SEV_SNP, range(3, 8, 2), *common)
+        self.assertEqual(list(lds), [3, 5, 7])
+        self.assertEqual(lds[7], guest.calc_launch_digest(SevMode.SEV_SNP, 7, *common))
+
+    def test_snp_svsm_launch_digests_range(self):
+        lds = guest.calc_launch_digests(
+                SevMode.SEV_SNP_SVSM, range(2, 5), vcpu_types.CPU_SIGS["EPYC-v4"], 'tests/fixtures/svsm_ovmf.fd',
+                None, None, None, 0x21, None, vmm_types.VMMType.QEMU, False, 'tests/fixtures/svsm.bin', 540672)
+        self.assertEqual(
+                lds[2].hex(),
+                '9b94745036aafddf4f7f8b00c7513abb5b7703178cb95aaa57928bd963d68d3bfcb715d6019b9167ee2517b11b0d9be7')
+        self.assertEqual(
+                lds[4].hex(),
+                '27d154c27b7b359c935e250ec6fee72aa0ae8c1225e3b0e1cf46a9567e938066d7d6f94bbdc4a857818bdb79277a44b2')
+
+    def test_launch_digests_invalid_range(self):
+        for vcpus in [range(0), range(0, 4), range(4, 1, -1)]:
+            with self.assertRaises(ValueError):
+                guest.calc_launch_digests(SevMode.SEV_SNP, vcpus, 0, "tests/fixtures/ovmf_AmdSev_suffix.bin",
+                                          None, None, None, 0x1)
+
     def test_snp_svsm_dump_vmsa(self):
         """Test that SNP-SVSM mode creates vmsa files if requrested."""
         fixtures_dir = pathlib.Path('tests/fixtures').absolute()
@@ -496,6 +547,28 @@ class TestGuest(unittest.TestCase):
                 self.assertTrue(pathlib.Path("vmsa1.bin").exists())
                 self.assertFalse(pathlib.Path("vmsa2.bin").exists())
 
+    def test_firmware_mappings_are_closed(self):
+        mappings = []
+        real_mmap = mmap.mmap
+
+        def track(*args, **kwargs):
+            mappings.append(real_mmap(*args, **kwargs))
+            return mappings[-1]
+
+        with mock.patch('sevsnpmeasure.ovmf.mmap.mmap', side_effect=track):
+            guest.calc_launch_digest(SevMode.SEV, 1, None, "tests/fixtures/ovmf_AmdSev_suffix.bin",
+                                     None, None, None, 0x21)
+            guest.calc_launch_digest(SevMode.SEV_ES, 1, vcpu_types.CPU_SIGS["EPYC-v4"],
+                                     "tests/fixtures/ovmf_AmdSev_suffix.bin", None, None, None, 0x21)
+            guest.calc_launch_digest(SevMode.SEV_SNP, 1, vcpu_types.CPU_SIGS["EPYC-v4"],
+                                     "tests/fixtures/ovmf_AmdSev_suffix.bin", None, None, None, 0x21)
+            guest.calc_launch_digest(SevMode.SEV_SNP_SVSM, 1, vcpu_types.CPU_SIGS["EPYC-v4"],
+                                     'tests/fixtures/svsm_ovmf.fd', None, None, None, 0x21, None,
+                                     vmm_types.VMMType.QEMU, False, 'tests/fixtures/svsm.bin', 540672)
+            guest.calc_snp_ovmf_hash("tests/fixtures/ovmf_AmdSev_suffix.bin")
+        self.assertEqual(len(mappings), 6)
+        self.assertTrue(all(m.closed for m in mappings))
+
 
 @contextlib.contextmanager
 def push_dir(dir: str):
@@ -0,0 +1,84 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import io
+import os
+import unittest
+
+from sevsnpmeasure import gctx
+from sevsnpmeasure import guest
+from sevsnpmeasure.gctx import GCTX, PageType
+from sevsnpmeasure.journal import JournalWriter, MeasurementJournal, read_journal
+from sevsnpmeasure.sev_mode import SevMode
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+
+
+class TestJournal(unittest.TestCase):
+
+    def measure(self, **kwargs):
+        return guest.calc_launch_digest(SevMode.SEV_SNP, 2, 0, OVMF, "/dev/null", None, None, 0x1, **kwargs)
+
+    def test_journal(self):
+        journal = MeasurementJournal()
+        with gctx.observing(journal):
+            ld = self.measure()
+        self.assertEqual(journal[-1].ld, ld)
+        self.assertEqual(journal[0].page_type, PageType.NORMAL)
+        self.assertEqual([record.page_type for record in journal][-2:], [PageType.VMSA, PageType.VMSA])
+        self.assertEqual(journal[-1].gpa, GCTX.VMSA_GPA)
+        # Every firmware page is measured, then the metadata sections
+        self.assertGreater(len(journal), os.path.getsize(OVMF) // 4096 + 2)
+        with self.assertRaises(IndexError):
+            journal[len(journal)]
+
+    def test_no_observer_by_default(self):
+        self.assertIsNone(GCTX().observer)
+        with gctx.observing(MeasurementJournal()):
+            self.assertIsNotNone(GCTX().observer)
+        self.assertIsNone(GCTX().observer)
+
+    def test_workers(self):
+        journal = MeasurementJournal()
+        with gctx.observing(journal):
+            self.measure()
+        pipelined = MeasurementJournal()
+        with gctx.observing(pipelined):
+            self.measure(workers=4)
+        self.assertEqual(list(pipelined), list(journal))
+
+    def test_write_read(self):
+        journal = MeasurementJournal()
+        with gctx.observing(journal):
+            self.measure()
+        f = io.BytesIO()
+        with gctx.observing(JournalWriter(f)):
+            self.measure()
+        streamed = f.getvalue()
+        f = io.BytesIO()
+        journal.write(f)
+        self.assertEqual(f.getvalue(), streamed)
+        self.assertEqual(list(MeasurementJournal.read(io.BytesIO(streamed))), list(journal))
+        self.assertEqual(list(read_journal(io.BytesIO(streamed))), list(journal))
+
+    def test_invalid(self):
+        f = io.BytesIO()
+        MeasurementJournal().write(f)
+        self.assertEqual(list(read_journal(io.BytesIO(f.getvalue()))), [])
+        with self.assertRaisesRegex(RuntimeError, "Invalid"):
+            list(read_journal(io.BytesIO(b'not a journal')))
+        with self.assertRaisesRegex(RuntimeError, "Invalid"):
+            list(read_journal(io.BytesIO(b'')))
+        journal = MeasurementJournal()
+        journal(PageType.NORMAL, 0x1000, bytes(48), bytes(48))
+        f = io.BytesIO()
+        journal.write(f)
+        with self.assertRaisesRegex(RuntimeError, "Truncated"):
+            list(read_journal(io.BytesIO(f.getvalue()[:-1])))
+
+    def test_str(self):
+        journal = MeasurementJournal()
+        journal(PageType.ZERO, 0x1000, bytes(48), bytes(48))
+        self.assertTrue(str(journal[0]).startswith('ZERO gpa=0x1000 contents=00'))
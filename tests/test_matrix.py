@@ -0,0 +1,84 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import tempfile
+import unittest
+
+from sevsnpmeasure import vcpu_types
+from sevsnpmeasure.matrix import (MeasurementIndex, SQLiteMeasurementIndex, open_index, write_index,
+                                  write_sqlite_index)
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure.sweep import LaunchConfig, launch_configs, sweep_launch_digests
+from sevsnpmeasure.vmm_types import VMMType
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+SIGS = [vcpu_types.CPU_SIGS["EPYC-v4"], vcpu_types.CPU_SIGS["EPYC-Milan"]]
+
+
+class TestMatrix(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        configs = launch_configs(range(1, 17), SIGS, [0x1, 0x21], [VMMType.QEMU, VMMType.ec2])
+        cls.lds = sweep_launch_digests(SevMode.SEV_SNP, configs, OVMF, "/dev/null", None, None)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_index(self, index):
+        self.assertEqual(len(index), len(self.lds))
+        self.assertEqual(index.metadata(), {'mode': 'SEV_SNP'})
+        for config, ld in self.lds.items():
+            configs = index.lookup(ld)
+            self.assertIn(config, configs)
+            if config.vmm_type == VMMType.QEMU:
+                self.assertEqual(configs, [config])
+            else:
+                # EC2 doesn't measure the vCPU signature
+                self.assertEqual(configs, [config._replace(vcpu_sig=sig) for sig in SIGS])
+        self.assertEqual(index.lookup(bytes(48)), [])
+        self.assertEqual(index.lookup(b'\xff' * 48), [])
+        self.assertEqual(index.lookup(b'short'), [])
+
+    def test_index(self):
+        path = os.path.join(self.tmp.name, 'index')
+        write_index(path, self.lds, {'mode': 'SEV_SNP'})
+        with open_index(path) as index:
+            self.assertIsInstance(index, MeasurementIndex)
+            self.check_index(index)
+
+    def test_sqlite_index(self):
+        path = os.path.join(self.tmp.name, 'index.db')
+        write_sqlite_index(path, self.lds, {'mode': 'SEV_SNP'})
+        with open_index(path) as index:
+            self.assertIsInstance(index, SQLiteMeasurementIndex)
+            self.check_index(index)
+
+    def test_empty_index(self):
+        path = os.path.join(self.tmp.name, 'index')
+        write_index(path, {})
+        with MeasurementIndex(path) as index:
+            self.assertEqual(len(index), 0)
+            self.assertEqual(index.lookup(bytes(48)), [])
+
+    def test_invalid_index(self):
+        path = os.path.join(self.tmp.name, 'index')
+        write_index(path, {LaunchConfig(1, 0, 1, VMMType.QEMU): bytes(48)})
+        with open(path, 'rb') as f:
+            data = f.read()
+        for corrupt in [b'', b'x' * 16, b'X' + data[1:], data[:-1]]:
+            with open(path, 'wb') as f:
+                f.write(corrupt)
+            with self.assertRaises(RuntimeError):
+                MeasurementIndex(path)
+
+    def test_mixed_digest_sizes(self):
+        with self.assertRaises(ValueError):
+            write_index(os.path.join(self.tmp.name, 'index'), {LaunchConfig(1, 0, 1, VMMType.QEMU): bytes(48),
+                                                               LaunchConfig(2, 0, 1, VMMType.QEMU): bytes(32)})
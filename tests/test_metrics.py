@@ -0,0 +1,139 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+from sevsnpmeasure import guest
+from sevsnpmeasure import metrics
+from sevsnpmeasure import ovmf
+from sevsnpmeasure.cache import DigestCache
+from sevsnpmeasure.sev_mode import SevMode
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.reset()
+        metrics.REGISTRY.enable()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.kernel = os.path.join(self.tmp.name, 'kernel')
+        with open(self.kernel, 'wb') as f:
+            f.write(b'kernel' * 1000)
+
+    def tearDown(self):
+        metrics.REGISTRY.disable()
+        metrics.REGISTRY.reset()
+        self.tmp.cleanup()
+
+    def measure(self, **kwargs):
+        return guest.calc_launch_digest(SevMode.SEV_SNP, 2, 0, OVMF, self.kernel, None, None, 0x1, **kwargs)
+
+    def metric_values(self):
+        values = {}
+        for line in metrics.REGISTRY.render_prometheus().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+        return values
+
+    def test_measurement(self):
+        self.measure()
+        values = self.metric_values()
+        for stage in metrics.STAGES:
+            self.assertEqual(values[f'sevsnpmeasure_stage_seconds_count{{stage="{stage}"}}'], 1)
+            self.assertEqual(values[f'sevsnpmeasure_stage_seconds_bucket{{stage="{stage}",le="+Inf"}}'], 1)
+        # The firmware pages and the kernel hashes page
+        self.assertEqual(values['sevsnpmeasure_pages_total{page_type="NORMAL"}'], os.path.getsize(OVMF) // 4096 + 1)
+        self.assertEqual(values['sevsnpmeasure_pages_total{page_type="VMSA"}'], 2)
+        # The firmware is mapped, and the kernel read
+        self.assertEqual(values['sevsnpmeasure_mapped_bytes_total'], os.path.getsize(OVMF))
+        self.assertEqual(values['sevsnpmeasure_read_bytes_total'], 6000)
+
+    def test_cache(self):
+        digest_cache = DigestCache(os.path.join(self.tmp.name, 'cache'))
+        self.measure(digest_cache=digest_cache)
+        self.measure(digest_cache=digest_cache)
+        values = self.metric_values()
+        self.assertEqual(values['sevsnpmeasure_cache_requests_total{cache="digest",result="miss"}'], 1)
+        self.assertEqual(values['sevsnpmeasure_cache_requests_total{cache="digest",result="hit"}'], 1)
+
+    def test_disabled(self):
+        metrics.REGISTRY.disable()
+        self.measure()
+        values = self.metric_values()
+        self.assertEqual(values['sevsnpmeasure_read_bytes_total'], 0)
+        self.assertFalse(any('pages_total{' in name for name in values))
+        self.assertEqual(values['sevsnpmeasure_stage_seconds_count{stage="firmware_load"}'], 0)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+
+    def test_handler(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), metrics.MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}'
+            with urllib.request.urlopen(url + '/metrics') as response:
+                self.assertEqual(response.headers['Content-Type'], metrics.PROMETHEUS_CONTENT_TYPE)
+                self.assertIn('# TYPE sevsnpmeasure_stage_seconds histogram', response.read().decode())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(url + '/other')
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_timings(self):
+        timings = metrics.Timings()
+        ld = guest.calc_launch_digest(SevMode.SEV_SNP, 4, 0, OVMF, "/dev/null", None, None, 0x1, timings=timings)
+        self.assertEqual(ld, guest.calc_launch_digest(SevMode.SEV_SNP, 4, 0, OVMF, "/dev/null", None, None, 0x1))
+        report = timings.to_json()
+        names = [stage['stage'] for stage in report['stages']]
+        self.assertEqual([name for name in names if name != 'metadata_section'],
+                         ['firmware_load', 'firmware_pages', 'kernel_hashes', 'metadata_sections', 'vmsa_pages'])
+        sections = [stage for stage in report['stages'] if stage['stage'] == 'metadata_section']
+        self.assertIn('SNP_KERNEL_HASHES gpa=0x', ' '.join(section['detail'] for section in sections))
+        metadata = report['stages'][names.index('metadata_sections')]
+        self.assertEqual(metadata['pages'], sum(section['pages'] for section in sections))
+        vmsa = report['stages'][names.index('vmsa_pages')]
+        self.assertEqual(vmsa['pages'], 4)
+        self.assertEqual(vmsa['bytes'], 4 * 4096)
+        firmware = report['stages'][names.index('firmware_pages')]
+        self.assertEqual(firmware['pages'], os.path.getsize(OVMF) // 4096)
+        self.assertEqual(report['total']['pages'], firmware['pages'] + metadata['pages'] + vmsa['pages'])
+        for stage in report['stages'] + [report['total']]:
+            self.assertGreaterEqual(stage['wall_s'], 0)
+            self.assertGreaterEqual(stage['cpu_s'], 0)
+
+    def test_timings_mapped_firmware(self):
+        timings = metrics.Timings()
+        with metrics.record_timings(timings):
+            ovmf.OVMF(OVMF)
+            ovmf.OVMF(OVMF, use_mmap=False)
+        mapped, read = [stage.to_json() for stage in timings.stages]
+        self.assertEqual((mapped['bytes'], mapped['mapped_bytes'], mapped['mib_per_s']), (0, os.path.getsize(OVMF), 0))
+        self.assertEqual((read['bytes'], read['mapped_bytes']), (os.path.getsize(OVMF), 0))
+
+    def test_timings_only_record_their_measurements(self):
+        timings = metrics.Timings()
+        guest.calc_launch_digest(SevMode.SEV, 1, 0, OVMF, None, None, None, 0x1, timings=timings)
+        guest.calc_launch_digest(SevMode.SEV, 1, 0, OVMF, None, None, None, 0x1)
+        self.assertEqual([stage.name for stage in timings.stages], ['firmware_load', 'firmware_pages'])
@@ -0,0 +1,217 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import pathlib
+import random
+import struct
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+from sevsnpmeasure import ovmf as ovmf_module
+from sevsnpmeasure.gctx import GCTX
+from sevsnpmeasure.ovmf import OVMF, SVSM, SectionType, guid_bytes
+
+
+class TestOVMF(unittest.TestCase):
+
+    def test_mmap_matches_read(self):
+        for path in ["tests/fixtures/ovmf_AmdSev_suffix.bin", "tests/fixtures/svsm_ovmf.fd"]:
+            with OVMF(path) as mapped:
+                loaded = OVMF(path, use_mmap=False)
+                self.assertIsInstance(mapped.data(), memoryview)
+                self.assertIsInstance(loaded.data(), bytes)
+                self.assertEqual(bytes(mapped.data()), pathlib.Path(path).read_bytes())
+                self.assertEqual(mapped.gpa(), loaded.gpa())
+                self.assertEqual(mapped.sev_es_reset_eip(), loaded.sev_es_reset_eip())
+                self.assertEqual([bytes(d) for d in mapped.metadata_items()],
+                                 [bytes(d) for d in loaded.metadata_items()])
+
+    def test_mmap_update_normal_pages(self):
+        path = "tests/fixtures/svsm_ovmf.fd"
+        with OVMF(path) as ovmf:
+            mapped = GCTX()
+            mapped.update_normal_pages(ovmf.gpa(), ovmf.data())
+        copied = GCTX()
+        copied.update_normal_pages(ovmf.gpa(), pathlib.Path(path).read_bytes())
+        self.assertEqual(mapped.ld(), copied.ld())
+
+    def test_close_releases_mapping(self):
+        ovmf = OVMF("tests/fixtures/ovmf_AmdSev_suffix.bin")
+        view = ovmf.data()
+        ovmf.close()
+        with self.assertRaises(ValueError):
+            view[0]
+        ovmf.close()
+        self.assertTrue(ovmf.has_metadata_section(SectionType.SNP_KERNEL_HASHES))
+        # The file is mapped again when needed
+        self.assertEqual(bytes(ovmf.data()), pathlib.Path("tests/fixtures/ovmf_AmdSev_suffix.bin").read_bytes())
+        ovmf.close()
+
+    def test_svsm_mmap(self):
+        ovmf = OVMF("tests/fixtures/svsm_ovmf.fd")
+        with SVSM("tests/fixtures/svsm.bin", end_at=ovmf.gpa() - 540672) as svsm:
+            self.assertIsInstance(svsm.data(), memoryview)
+            self.assertEqual(svsm.end_gpa(), ovmf.gpa() - 540672)
+
+    def test_lazy_reads_only_tail(self):
+        path = "tests/fixtures/svsm_ovmf.fd"
+        eager = OVMF(path)
+        lazy = OVMF(path, lazy=True)
+        self.assertIsNone(lazy._data)
+        self.assertLessEqual(len(lazy._tail), OVMF.LAZY_TAIL_SIZE)
+        self.assertEqual(lazy.size(), eager.size())
+        self.assertEqual(lazy.gpa(), eager.gpa())
+        self.assertEqual(lazy.sev_es_reset_eip(), eager.sev_es_reset_eip())
+        self.assertEqual([bytes(d) for d in lazy.metadata_items()],
+                         [bytes(d) for d in eager.metadata_items()])
+        self.assertEqual(bytes(lazy.data()), bytes(eager.data()))
+
+    def test_lazy_small_file(self):
+        path = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+        lazy = OVMF(path, lazy=True, use_mmap=False)
+        self.assertEqual(lazy.sev_hashes_table_gpa(), OVMF(path).sev_hashes_table_gpa())
+        self.assertEqual(lazy.data(), pathlib.Path(path).read_bytes())
+
+
+def _footer_entry(guid: str, data: bytes) -> bytes:
+    return data + struct.pack('<H', len(data) + 18) + guid_bytes(guid)
+
+
+def _build_firmware(entries, size: int = 4096, footer_size=None) -> bytes:
+    """
+    Build a firmware image whose footer table holds the given (guid, data)
+    entries, the first one being closest to the end of the image.
+    """
+    table = b''.join(_footer_entry(guid, data) for guid, data in reversed(entries))
+    if footer_size is None:
+        footer_size = len(table) + 18
+    tail = table + struct.pack('<H', footer_size) + guid_bytes(OVMF.OVMF_TABLE_FOOTER_GUID) + bytes(32)
+    return bytes(size - len(tail)) + tail
+
+
+def _build_metadata(items, num_items=None, size=None) -> bytes:
+    body = b''.join(struct.pack('<III', *item) for item in items)
+    if num_items is None:
+        num_items = len(items)
+    if size is None:
+        size = 16 + len(body)
+    return b'ASEV' + struct.pack('<III', size, 1, num_items) + body
+
+
+def _fuzz_corpus():
+    """
+    Crafted malformed footers, plus seeded random mutations of the tails of
+    the firmware fixtures.
+    """
+    metadata = _build_metadata([(0x800000, 0x1000, 1), (0x801000, 0x1000, 0x10)])
+    meta_offset = struct.pack('<I', 2048)
+
+    def with_metadata(image: bytes, blob: bytes) -> bytes:
+        return image[:2048] + blob + image[2048 + len(blob):]
+
+    corpus = [
+        bytes(64),
+        bytes(4096),
+        _build_firmware([], footer_size=0),
+        _build_firmware([], footer_size=0xffff),
+        _build_firmware([(OVMF.SEV_ES_RESET_BLOCK_GUID, b'\x00' * 4)], footer_size=17),
+        _build_firmware([(OVMF.SEV_ES_RESET_BLOCK_GUID, b'\x00' * 4)], footer_size=0xffff),
+        _build_firmware([], size=64, footer_size=0x100),
+        _build_firmware([(OVMF.OVMF_SEV_META_DATA_GUID, struct.pack('<I', 0xffffffff))]),
+        _build_firmware([(OVMF.OVMF_SEV_META_DATA_GUID, struct.pack('<I', 4))]),
+        with_metadata(_build_firmware([(OVMF.OVMF_SEV_META_DATA_GUID, meta_offset)]), metadata),
+        with_metadata(_build_firmware([(OVMF.OVMF_SEV_META_DATA_GUID, meta_offset)]),
+                      _build_metadata([(0, 0x1000, 1)], num_items=0xffffffff)),
+        with_metadata(_build_firmware([(OVMF.OVMF_SEV_META_DATA_GUID, meta_offset)]),
+                      _build_metadata([(0, 0x1000, 1)], size=4)),
+        with_metadata(_build_firmware([(OVMF.OVMF_SEV_META_DATA_GUID, meta_offset)]),
+                      _build_metadata([(0, 0x1000, 77)])),
+    ]
+    # An entry whose size field claims more than the remaining table
+    bad_entry = bytearray(_build_firmware([(OVMF.SEV_ES_RESET_BLOCK_GUID, b'\x00' * 4)]))
+    struct.pack_into('<H', bad_entry, 4096 - 32 - 18 - 18, 0x400)
+    corpus.append(bytes(bad_entry))
+
+    rng = random.Random(0x5e5)
+    for fixture in ["tests/fixtures/ovmf_AmdSev_suffix.bin", "tests/fixtures/ovmf_OvmfX64_suffix.bin"]:
+        image = pathlib.Path(fixture).read_bytes()
+        for _ in range(200):
+            mutated = bytearray(image)
+            for _ in range(rng.randint(1, 8)):
+                mutated[rng.randrange(len(mutated) - 1024, len(mutated))] = rng.randrange(256)
+            corpus.append(bytes(mutated))
+        for cut in [50, 51, 100, 1000, 4000]:
+            corpus.append(image[-cut:])
+    return corpus
+
+
+class TestOVMFParser(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, data: bytes) -> str:
+        path = os.path.join(self.tmpdir.name, "fw.bin")
+        pathlib.Path(path).write_bytes(data)
+        return path
+
+    def test_table_entries(self):
+        path = self._write(_build_firmware([(OVMF.SEV_ES_RESET_BLOCK_GUID, struct.pack('<I', 0xffff1234)),
+                                            (OVMF.SEV_HASH_TABLE_RV_GUID, struct.pack('<II', 0x80e000, 0x400))]))
+        ovmf = OVMF(path)
+        self.assertEqual(ovmf.sev_es_reset_eip(), 0xffff1234)
+        self.assertEqual(ovmf.sev_hashes_table_gpa(), 0x80e000)
+        self.assertEqual(ovmf.table_item(OVMF.SEV_HASH_TABLE_RV_GUID), struct.pack('<II', 0x80e000, 0x400))
+        self.assertEqual(ovmf.metadata_items(), [])
+        self.assertFalse(ovmf.has_metadata_section(SectionType.SNP_SEC_MEM))
+
+    def test_metadata_section_index(self):
+        ovmf = OVMF("tests/fixtures/ovmf_AmdSev_suffix.bin")
+        for section_type in SectionType:
+            expected = [bytes(d) for d in ovmf.metadata_items() if d.section_type_int == section_type.value]
+            self.assertEqual([bytes(d) for d in ovmf.metadata_items_of_type(section_type)], expected)
+            self.assertEqual(ovmf.has_metadata_section(section_type), bool(expected))
+
+    def test_fuzz_corpus(self):
+        for data in _fuzz_corpus():
+            path = self._write(data)
+            for lazy in [False, True]:
+                try:
+                    OVMF(path, lazy=lazy)
+                except RuntimeError:
+                    pass
+
+    def test_pathological_footer_size_parses_in_bounded_work(self):
+        # The largest possible table, made of the smallest possible entries
+        entries = [(str(uuid.UUID(int=i)), b'') for i in range(0xffff // 18 - 1)]
+        path = self._write(_build_firmware(entries, size=128 * 1024))
+        visited = []
+
+        class CountingStruct(struct.Struct):
+            def unpack_from(self, buffer, offset=0):
+                visited.append(offset)
+                return super().unpack_from(buffer, offset)
+
+        read = []
+        real_read = OVMF._read
+
+        def counting_read(ovmf, offset, length):
+            read.append(length)
+            return real_read(ovmf, offset, length)
+
+        with mock.patch.object(ovmf_module, '_FOOTER_ENTRY', CountingStruct('<H16s')), \
+                mock.patch.object(OVMF, '_read', counting_read):
+            ovmf = OVMF(path, lazy=True)
+        self.assertEqual(len(ovmf._table), len(entries))
+        # Every entry is visited once, and the table read once
+        self.assertEqual(len(visited), len(entries))
+        self.assertEqual(len(set(visited)), len(entries))
+        self.assertLessEqual(sum(read), 2 * 0xffff)
@@ -0,0 +1,68 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import base64
+import unittest
+
+from sevsnpmeasure import guest
+from sevsnpmeasure import vcpu_types
+from sevsnpmeasure.search import feature_masks, parse_measurement, search_launch_config
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure.sweep import LaunchConfig
+from sevsnpmeasure.vmm_types import VMMType
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+SIGS = [vcpu_types.CPU_SIGS["EPYC-v4"], vcpu_types.CPU_SIGS["EPYC-Milan"], vcpu_types.CPU_SIGS["EPYC-Genoa"]]
+
+
+class TestSearch(unittest.TestCase):
+
+    def test_parse_measurement(self):
+        ld = bytes(range(48))
+        self.assertEqual(parse_measurement(ld.hex()), ld)
+        self.assertEqual(parse_measurement(base64.b64encode(ld).decode() + "\n"), ld)
+        self.assertEqual(parse_measurement(ld[:32].hex()), ld[:32])
+        with self.assertRaises(ValueError):
+            parse_measurement("not a measurement")
+        for wrong in [ld[:47].hex(), ld[:33].hex(), base64.b64encode(ld[:20]).decode(), ""]:
+            with self.assertRaisesRegex(ValueError, "bytes long"):
+                parse_measurement(wrong)
+
+    def test_feature_masks(self):
+        self.assertEqual(feature_masks(0), [0])
+        self.assertEqual(sorted(feature_masks(0x6, base=0x1)), [0x1, 0x3, 0x5, 0x7])
+        self.assertEqual(len(feature_masks(0x3f)), 64)
+
+    def test_search_finds_config(self):
+        target = guest.calc_launch_digest(SevMode.SEV_SNP, 7, SIGS[1], OVMF, "/dev/null", None, None, 0x21)
+        for processes in [1, 2]:
+            progress = []
+            result = search_launch_config(target, SevMode.SEV_SNP, OVMF, "/dev/null", None, None, range(1, 9), SIGS,
+                                          feature_masks(0x20, base=0x1), list(VMMType), processes=processes,
+                                          progress=lambda *args: progress.append(args))
+            self.assertEqual(result.config, LaunchConfig(7, SIGS[1], 0x21, VMMType.QEMU))
+            self.assertEqual(progress[-1][0], result.tried)
+            self.assertEqual(progress[-1][1], 8 * len(SIGS) * 2 + 8 * 2 * 2)
+
+    def test_search_non_qemu_ignores_vcpu_sig(self):
+        target = guest.calc_launch_digest(SevMode.SEV_SNP, 2, SIGS[2], OVMF, None, None, None, 0x1, vmm_type=VMMType.gce)
+        result = search_launch_config(target, SevMode.SEV_SNP, OVMF, None, None, None, [1, 2], SIGS, [0x1],
+                                      [VMMType.QEMU, VMMType.gce])
+        self.assertEqual(result.config, LaunchConfig(2, 0, 0x1, VMMType.gce))
+
+    def test_search_without_match(self):
+        result = search_launch_config(bytes(32), SevMode.SEV_ES, OVMF, None, None, None, [1, 2, 3], SIGS, [0x1],
+                                      [VMMType.QEMU], processes=2)
+        self.assertIsNone(result.config)
+        self.assertEqual(result.tried, 9)
+
+    def test_search_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            search_launch_config(bytes(48), SevMode.SEV_SNP, OVMF, None, None, None, [0, 1], SIGS, [0x1], [VMMType.QEMU])
+        with self.assertRaises(ValueError):
+            search_launch_config(bytes(48), SevMode.SEV_SNP, OVMF, None, None, None, [1], SIGS, [0x1], [VMMType.QEMU],
+                                 processes=0)
+        with self.assertRaises(ValueError):
+            search_launch_config(bytes(32), SevMode.SEV_SNP, OVMF, None, None, None, [1], SIGS, [0x1], [VMMType.QEMU])
@@ -0,0 +1,68 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import hashlib
+import os
+import tempfile
+import tracemalloc
+import unittest
+
+from sevsnpmeasure.sev_hashes import SevHashes, sha256_file
+
+
+class TestSevHashes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _make_file(self, name: str, size: int) -> str:
+        path = os.path.join(self.tmpdir.name, name)
+        block = bytes(range(256)) * 4096
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        return path
+
+    def test_sha256_file_matches_hashlib(self):
+        for size in [0, 1, 4095, 4096, 65537]:
+            path = self._make_file(f"f{size}", size)
+            with open(path, 'rb') as f:
+                expected = hashlib.sha256(f.read()).digest()
+            for chunk_size in [1, 4096, 1 << 20]:
+                self.assertEqual(sha256_file(path, chunk_size), expected)
+
+    def test_sha256_file_rejects_bad_chunk_size(self):
+        with self.assertRaises(ValueError):
+            sha256_file("/dev/null", 0)
+
+    def test_sev_hashes_without_initrd(self):
+        kernel = self._make_file("kernel", 10000)
+        h = SevHashes(kernel, None, "console=ttyS0", chunk_size=4096)
+        with open(kernel, 'rb') as f:
+            self.assertEqual(h.kernel_hash, hashlib.sha256(f.read()).digest())
+        self.assertEqual(h.initrd_hash, hashlib.sha256(b'').digest())
+        self.assertEqual(h.cmdline_hash, hashlib.sha256(b'console=ttyS0\x00').digest())
+
+    def _peak_memory(self, kernel: str, initrd: str, chunk_size: int) -> int:
+        tracemalloc.start()
+        try:
+            SevHashes(kernel, initrd, "", chunk_size=chunk_size)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_peak_memory_does_not_grow_with_input_size(self):
+        chunk_size = 64 * 1024
+        small = self._make_file("small", 256 * 1024)
+        large = self._make_file("large", 16 * 1024 * 1024)
+        small_peak = self._peak_memory(small, small, chunk_size)
+        large_peak = self._peak_memory(large, large, chunk_size)
+        self.assertLess(large_peak, 4 * chunk_size)
+        self.assertLess(large_peak - small_peak, chunk_size)
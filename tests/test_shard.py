@@ -0,0 +1,153 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sevsnpmeasure import cli, vcpu_types
+from sevsnpmeasure.matrix import open_index
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure.shard import merge_shards, parse_shard, progress_path, read_progress, run_shard, shard_groups
+from sevsnpmeasure.sweep import launch_configs, sweep_launch_digests
+from sevsnpmeasure.vmm_types import VMMType
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+SIGS = [vcpu_types.CPU_SIGS["EPYC-v4"], vcpu_types.CPU_SIGS["EPYC-Milan"]]
+
+
+class TestShard(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.configs = launch_configs(range(1, 5), SIGS, [0x1, 0x21], [VMMType.QEMU, VMMType.ec2])
+        cls.lds = sweep_launch_digests(SevMode.SEV_SNP, cls.configs, OVMF, "/dev/null", None, None)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_shard(self, shard, shards, output):
+        return run_shard(SevMode.SEV_SNP, self.configs, shard, shards, output, OVMF, "/dev/null", None, None,
+                         metadata={'mode': 'SEV_SNP'})
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('1/1'), (1, 1))
+        self.assertEqual(parse_shard('3/4'), (3, 4))
+        for s in ['0/4', '5/4', '1', '1/', 'a/b', '']:
+            with self.assertRaises(ValueError):
+                parse_shard(s)
+
+    def test_shard_groups(self):
+        groups = [shard_groups(self.configs, i, 3) for i in range(1, 4)]
+        # Every configuration is in exactly one shard
+        configs = [config for shard in groups for group in shard for config in group]
+        self.assertCountEqual(configs, self.configs)
+        self.assertEqual(groups, [shard_groups(self.configs, i, 3) for i in range(1, 4)])
+        for shard in groups:
+            for group in shard:
+                self.assertEqual(len({(c.guest_features, c.vmm_type) for c in group}), 1)
+
+    def test_merge(self):
+        outputs = [os.path.join(self.tmp.name, f'shard{i}') for i in range(1, 4)]
+        for i, output in enumerate(outputs, 1):
+            self.assertTrue(self.run_shard(i, 3, output).complete)
+        lds, metadata = merge_shards(outputs)
+        self.assertEqual(lds, self.lds)
+        self.assertEqual(metadata, {'mode': 'SEV_SNP'})
+        # Duplicate outputs are merged
+        self.assertEqual(merge_shards(outputs + outputs[:1])[0], self.lds)
+
+    def test_merge_missing_shard(self):
+        outputs = [os.path.join(self.tmp.name, f'shard{i}') for i in range(1, 4)]
+        for i, output in enumerate(outputs[:2], 1):
+            self.run_shard(i, 3, output)
+        with self.assertRaisesRegex(RuntimeError, 'Missing shards 3/3'):
+            merge_shards(outputs[:2])
+        with self.assertRaisesRegex(RuntimeError, 'not complete'):
+            merge_shards(outputs)
+
+    def test_merge_different_jobs(self):
+        output1 = os.path.join(self.tmp.name, 'shard1')
+        output2 = os.path.join(self.tmp.name, 'shard2')
+        self.run_shard(1, 2, output1)
+        run_shard(SevMode.SEV_SNP, self.configs[:4], 2, 2, output2, OVMF, "/dev/null", None, None,
+                  metadata={'mode': 'SEV_SNP'})
+        with self.assertRaisesRegex(RuntimeError, 'different job'):
+            merge_shards([output1, output2])
+
+    def test_resume(self):
+        output = os.path.join(self.tmp.name, 'shard')
+        self.run_shard(1, 2, output)
+        with open(output, 'rb') as f:
+            expected = f.read()
+        # Simulate an interruption after the first group, in the middle of
+        # writing the second one
+        progress = read_progress(output)
+        first_group = expected.index(b'\n', expected.index(b'"vcpus": 4')) + 1
+        with open(progress_path(output), 'w') as f:
+            json.dump(progress._replace(groups_done=1, output_size=first_group, complete=False)._asdict(), f)
+        with open(output, 'wb') as f:
+            f.write(expected[:first_group + 10])
+        self.assertTrue(self.run_shard(1, 2, output).complete)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_resume_different_job(self):
+        output = os.path.join(self.tmp.name, 'shard')
+        self.run_shard(1, 2, output)
+        with self.assertRaisesRegex(RuntimeError, 'different shard or job'):
+            self.run_shard(2, 2, output)
+
+    def interrupt(self, output):
+        progress = read_progress(output)
+        with open(progress_path(output), 'w') as f:
+            json.dump(progress._replace(groups_done=0, output_size=0, complete=False)._asdict(), f)
+
+    def test_resume_changed_inputs(self):
+        output = os.path.join(self.tmp.name, 'shard')
+        kernel = os.path.join(self.tmp.name, 'kernel')
+        with open(kernel, 'wb') as f:
+            f.write(b'kernel')
+        run_shard(SevMode.SEV_SNP, self.configs, 1, 2, output, OVMF, kernel, None, None)
+        self.interrupt(output)
+        with self.assertRaisesRegex(RuntimeError, 'different shard or job'):
+            run_shard(SevMode.SEV_SNP, self.configs, 1, 2, output, OVMF, kernel, None, None,
+                      snp_ovmf_hash_str='00' * 48)
+        # The kernel changed in place
+        with open(kernel, 'wb') as f:
+            f.write(b'other kernel')
+        with self.assertRaisesRegex(RuntimeError, 'different shard or job'):
+            run_shard(SevMode.SEV_SNP, self.configs, 1, 2, output, OVMF, kernel, None, None)
+
+    def test_merge_inputs_at_other_paths(self):
+        ovmf = os.path.join(self.tmp.name, 'OVMF.fd')
+        with open(OVMF, 'rb') as src, open(ovmf, 'wb') as dst:
+            dst.write(src.read())
+        output1 = os.path.join(self.tmp.name, 'shard1')
+        output2 = os.path.join(self.tmp.name, 'shard2')
+        self.run_shard(1, 2, output1)
+        run_shard(SevMode.SEV_SNP, self.configs, 2, 2, output2, ovmf, "/dev/null", None, None,
+                  metadata={'mode': 'SEV_SNP'})
+        self.assertEqual(merge_shards([output1, output2])[0], self.lds)
+
+    def test_cli(self):
+        outputs = [os.path.join(self.tmp.name, f'shard{i}') for i in range(1, 3)]
+        index = os.path.join(self.tmp.name, 'index')
+        for i, output in enumerate(outputs, 1):
+            argv = ['sev-snp-measure', 'matrix', '--mode', 'snp', '--vcpus', '1-4', '--vcpu-type', 'EPYC-v4,EPYC-Milan',
+                    '--guest-features', '0x1,0x21', '--vmm-type', 'QEMU,ec2', '--ovmf', OVMF, '--kernel', '/dev/null',
+                    '--no-cache', '--output', output, '--shard', f'{i}/2']
+            with mock.patch('sys.argv', argv):
+                self.assertEqual(cli.main(), 0)
+        with mock.patch('sys.argv', ['sev-snp-measure', 'merge', '--output', index] + outputs):
+            self.assertEqual(cli.main(), 0)
+        with open_index(index) as lookup:
+            for config, ld in self.lds.items():
+                self.assertIn(config, lookup.lookup(ld))
@@ -0,0 +1,135 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sevsnpmeasure import guest
+from sevsnpmeasure import metrics
+from sevsnpmeasure import vcpu_types
+from sevsnpmeasure.cache import CheckpointCache
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure import sweep
+from sevsnpmeasure.sweep import KernelInputs, LaunchConfig, launch_configs, sweep_launch_digests
+from sevsnpmeasure.vmm_types import VMMType
+
+OVMF = "tests/fixtures/ovmf_AmdSev_suffix.bin"
+SIGS = [vcpu_types.CPU_SIGS["EPYC-v4"], vcpu_types.CPU_SIGS["EPYC-Milan"]]
+
+
+class TestSweep(unittest.TestCase):
+
+    def assert_matches_single(self, mode, lds, kernel, snp_ovmf_hash_str='', svsm_file='', ovmf_vars_size=0,
+                              ovmf_file=OVMF):
+        for config, ld in lds.items():
+            expected = guest.calc_launch_digest(mode, config.vcpus, config.vcpu_sig, ovmf_file, kernel, None, None,
+                                                config.guest_features, snp_ovmf_hash_str, config.vmm_type,
+                                                svsm_file=svsm_file, ovmf_vars_size=ovmf_vars_size)
+            self.assertEqual(ld, expected, config)
+
+    def test_launch_configs(self):
+        configs = launch_configs([1, 2], [0x10], [0x1, 0x21], [VMMType.QEMU])
+        self.assertEqual(configs, [LaunchConfig(1, 0x10, 0x1, VMMType.QEMU), LaunchConfig(2, 0x10, 0x1, VMMType.QEMU),
+                                   LaunchConfig(1, 0x10, 0x21, VMMType.QEMU), LaunchConfig(2, 0x10, 0x21, VMMType.QEMU)])
+
+    def test_snp_sweep_matches_single(self):
+        configs = launch_configs([1, 3, 2], SIGS, [0x1, 0x21], list(VMMType))
+        lds = sweep_launch_digests(SevMode.SEV_SNP, configs, OVMF, "/dev/null", None, None)
+        self.assertEqual(list(lds), configs)
+        self.assert_matches_single(SevMode.SEV_SNP, lds, "/dev/null")
+
+    def test_snp_sweep_with_ovmf_hash(self):
+        ovmf_hash = guest.calc_snp_ovmf_hash(OVMF).hex()
+        configs = launch_configs([2], SIGS, [0x1], [VMMType.QEMU, VMMType.gce])
+        lds = sweep_launch_digests(SevMode.SEV_SNP, configs, OVMF, None, None, None, snp_ovmf_hash_str=ovmf_hash)
+        self.assert_matches_single(SevMode.SEV_SNP, lds, None, snp_ovmf_hash_str=ovmf_hash)
+
+    def test_snp_sweep_with_checkpoint_cache(self):
+        configs = launch_configs([1, 4], SIGS, [0x1], [VMMType.QEMU, VMMType.ec2])
+        with tempfile.TemporaryDirectory() as tmp:
+            for _ in range(2):
+                lds = sweep_launch_digests(SevMode.SEV_SNP, configs, OVMF, "/dev/null", None, None,
+                                           checkpoint_cache=CheckpointCache(tmp))
+                self.assert_matches_single(SevMode.SEV_SNP, lds, "/dev/null")
+
+    def test_seves_and_sev_sweep_match_single(self):
+        configs = launch_configs([1, 2, 4], SIGS, [0x0], [VMMType.QEMU, VMMType.ec2])
+        for mode in [SevMode.SEV_ES, SevMode.SEV]:
+            lds = sweep_launch_digests(mode, configs, OVMF, "/dev/null", None, None)
+            self.assert_matches_single(mode, lds, "/dev/null")
+
+    def test_svsm_sweep_matches_single(self):
+        configs = launch_configs([2, 4], SIGS, [0x1], [VMMType.QEMU])
+        lds = sweep_launch_digests(SevMode.SEV_SNP_SVSM, configs, 'tests/fixtures/svsm_ovmf.fd', None, None, None,
+                                   svsm_file='tests/fixtures/svsm.bin', ovmf_vars_size=540672)
+        self.assert_matches_single(SevMode.SEV_SNP_SVSM, lds, None, svsm_file='tests/fixtures/svsm.bin',
+                                   ovmf_vars_size=540672, ovmf_file='tests/fixtures/svsm_ovmf.fd')
+
+    def test_invalid_vcpus(self):
+        with self.assertRaises(ValueError):
+            sweep_launch_digests(SevMode.SEV_SNP, [LaunchConfig(0, 0, 0x1, VMMType.QEMU)], OVMF, None, None, None)
+
+
+class TestKernelSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = {}
+        for name, contents in [('kernel1', b'kernel'), ('kernel2', b'kernel'), ('kernel3', b'other kernel'),
+                               ('initrd', b'initrd')]:
+            self.files[name] = os.path.join(self.tmp.name, name)
+            with open(self.files[name], 'wb') as f:
+                f.write(contents)
+        self.inputs = [
+            KernelInputs(self.files['kernel1'], self.files['initrd'], 'console=ttyS0'),
+            KernelInputs(self.files['kernel2'], self.files['initrd'], 'console=ttyS0'),
+            KernelInputs(self.files['kernel3'], '', 'console=ttyS0'),
+            KernelInputs(self.files['kernel1'], self.files['initrd'], 'console=hvc0'),
+            KernelInputs(''),
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_kernel_sweep_matches_single(self):
+        for mode in [SevMode.SEV_SNP, SevMode.SEV_ES, SevMode.SEV]:
+            for vmm_type in [VMMType.QEMU, VMMType.ec2]:
+                lds = sweep.sweep_kernel_launch_digests(mode, self.inputs, 2, SIGS[0], OVMF, 0x21,
+                                                        vmm_type=vmm_type)
+                self.assertEqual(list(lds), self.inputs)
+                for inputs, ld in lds.items():
+                    expected = guest.calc_launch_digest(mode, 2, SIGS[0], OVMF, inputs.kernel, inputs.initrd,
+                                                        inputs.append, 0x21, vmm_type=vmm_type)
+                    self.assertEqual(ld, expected, (mode, inputs))
+
+    def test_kernel_sweep_dedupes_by_content(self):
+        with mock.patch.object(sweep, 'sha256_file', wraps=sweep.sha256_file) as hash_file, \
+                mock.patch.object(sweep.SevHashes, 'construct_table', autospec=True,
+                                  side_effect=sweep.SevHashes.construct_table) as construct_table:
+            lds = sweep.sweep_kernel_launch_digests(SevMode.SEV_SNP, self.inputs, 1, SIGS[0], OVMF)
+        # Each file is hashed once, and kernel1 and kernel2 have the same contents
+        self.assertEqual(hash_file.call_count, 4)
+        self.assertEqual(construct_table.call_count, 3)
+        self.assertEqual(lds[self.inputs[0]], lds[self.inputs[1]])
+
+    def test_kernel_sweep_measures_firmware_once(self):
+        metrics.REGISTRY.reset()
+        metrics.REGISTRY.enable()
+        try:
+            for mode in [SevMode.SEV_SNP, SevMode.SEV_ES, SevMode.SEV]:
+                sweep.sweep_kernel_launch_digests(mode, self.inputs, 1, SIGS[0], OVMF)
+            values = metrics.REGISTRY.render_prometheus()
+        finally:
+            metrics.REGISTRY.disable()
+            metrics.REGISTRY.reset()
+        self.assertIn('sevsnpmeasure_stage_seconds_count{stage="firmware_pages"} 3', values)
+
+    def test_kernel_sweep_invalid_inputs(self):
+        with self.assertRaises(ValueError):
+            sweep.sweep_kernel_launch_digests(SevMode.SEV_SNP, [KernelInputs('', self.files['initrd'])], 1, 0, OVMF)
+        with self.assertRaises(ValueError):
+            sweep.sweep_kernel_launch_digests(SevMode.SEV_SNP_SVSM, self.inputs, 1, 0, OVMF)
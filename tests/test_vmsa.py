@@ -0,0 +1,75 @@
+#
+# Copyright 2022- IBM Inc. All rights reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import hashlib
+import unittest
+
+from sevsnpmeasure.gctx import GCTX
+from sevsnpmeasure.sev_mode import SevMode
+from sevsnpmeasure.vcpu_types import CPU_SIGS
+from sevsnpmeasure.vmm_types import VMMType
+from sevsnpmeasure.vmsa import VMSA, VMSA_SVSM
+
+
+class TestVMSA(unittest.TestCase):
+
+    def test_page_digests(self):
+        vmsa = VMSA(SevMode.SEV_SNP, 0xffffe000, CPU_SIGS["EPYC-v4"], 0x21, VMMType.QEMU)
+        pages = list(vmsa.pages(4))
+        digests = list(vmsa.page_digests(4))
+        self.assertEqual(digests, [hashlib.sha384(p).digest() for p in pages])
+        self.assertNotEqual(digests[0], digests[1])
+        # AP pages are serialized and hashed only once
+        self.assertIs(pages[1], pages[3])
+        self.assertIs(digests[1], digests[3])
+
+    def test_svsm_page_digests(self):
+        vmsa = VMSA_SVSM(0xffe00000, CPU_SIGS["EPYC-v4"])
+        digests = list(vmsa.page_digests(3))
+        self.assertEqual(digests, [hashlib.sha384(p).digest() for p in vmsa.pages(3)])
+        self.assertIs(digests[0], digests[2])
+
+    def test_gctx_vmsa_page_digest(self):
+        vmsa = VMSA(SevMode.SEV_SNP, 0xffffe000, CPU_SIGS["EPYC-v4"], 0x1, VMMType.ec2)
+        by_page = GCTX()
+        for page in vmsa.pages(3):
+            by_page.update_vmsa_page(page)
+        by_digest = GCTX()
+        for digest in vmsa.page_digests(3):
+            by_digest.update_vmsa_page_digest(digest)
+        self.assertEqual(by_page.ld(), by_digest.ld())
+
+    def test_ap_pages_require_ap_eip(self):
+        vmsa = VMSA(SevMode.SEV_SNP, 0, CPU_SIGS["EPYC-v4"], 0x1, VMMType.QEMU)
+        self.assertEqual(len(list(vmsa.page_digests(1))), 1)
+        with self.assertRaises(RuntimeError):
+            list(vmsa.page_digests(2))
+
+    def test_templates_match_ctypes_reference(self):
+        for vmm_type in VMMType:
+            for eip in [VMSA.BSP_EIP, 0xffffe000, 0x0080b004, 0]:
+                for vcpu_sig in [0, CPU_SIGS["EPYC-v4"], CPU_SIGS["EPYC-Genoa"]]:
+                    for sev_features in [0x1, 0x21, 0xffff]:
+                        self.assertEqual(
+                            VMSA.build_save_area_bytes(eip, sev_features, vcpu_sig, vmm_type),
+                            bytes(VMSA.build_save_area(eip, sev_features, vcpu_sig, vmm_type)),
+                            (vmm_type, hex(eip), vcpu_sig, sev_features))
+
+    def test_svsm_templates_match_ctypes_reference(self):
+        for vmm_type in VMMType:
+            for eip in [0xffe00000, 0x8000000, 0]:
+                for vcpu_sig in [0, CPU_SIGS["EPYC-v4"]]:
+                    for sev_features in [0x1, 0x21]:
+                        self.assertEqual(
+                            VMSA_SVSM.build_save_area_bytes(eip, sev_features, vcpu_sig, vmm_type),
+                            bytes(VMSA_SVSM.build_save_area(eip, sev_features, vcpu_sig, vmm_type)),
+                            (vmm_type, hex(eip), vcpu_sig, sev_features))
+
+    def test_save_area_properties(self):
+        vmsa = VMSA(SevMode.SEV_SNP, 0xffffe000, CPU_SIGS["EPYC-v4"], 0x21, VMMType.QEMU)
+        self.assertEqual(vmsa.bsp_save_area.rip, 0xfff0)
+        self.assertEqual(vmsa.ap_save_area.cs.base, 0xffff0000)
+        self.assertEqual(vmsa.ap_save_area.rdx, CPU_SIGS["EPYC-v4"])
+        self.assertEqual(VMSA_SVSM(0xffe00000, 0x800f12).save_area.rip, 0xffe00000)